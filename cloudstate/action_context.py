@@ -5,19 +5,17 @@ Licensed under the Apache License, Version 2.0.
 
 import random
 import sys
-from dataclasses import dataclass, field
-from typing import List
+from typing import Sequence
 
 from cloudstate.contexts import ClientActionContext
-from cloudstate.entity_pb2 import Forward, SideEffect
+
+# todo: is this correct? there is no command_id on the stateless function requests.
+COMMAND_ID = random.randint(0, sys.maxsize)
 
 
-@dataclass
 class ActionContext(ClientActionContext):
-    command_name: str
-    errors: List[str] = field(default_factory=list)
-    effects: List[SideEffect] = field(default_factory=list)
-    forward: Forward = None
+    __slots__ = ("command_name",)
 
-    # todo: is this correct? there is no command_id on the stateless function requests.
-    command_id = random.randint(0, sys.maxsize)
+    def __init__(self, command_name: str, reply_to=None, effects: Sequence = None):
+        super().__init__(COMMAND_ID, reply_to, effects)
+        self.command_name = command_name
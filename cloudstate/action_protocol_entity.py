@@ -3,15 +3,21 @@ Copyright 2020 Lightbend Inc.
 Licensed under the Apache License, Version 2.0.
 """
 
-import inspect
 import logging
 from dataclasses import dataclass, field
-from typing import Callable, List, MutableMapping
+from typing import Callable, List, MutableMapping, Optional, Set
 
 from google.protobuf import descriptor as _descriptor
+from google.protobuf.message import Message
 
 from cloudstate.action_context import ActionContext
 from cloudstate.action_pb2 import _ACTIONPROTOCOL
+from cloudstate.batching import UnaryBatcher
+from cloudstate.contexts import Context
+from cloudstate.utils.chunks import Chunks
+from cloudstate.utils.handler_utils import HandlerPlan, Slot, compile_handler
+from cloudstate.utils.ordered_pool import OrderedPool
+from cloudstate.utils.payload_utils import TypeRegistry
 
 
 @dataclass
@@ -22,6 +28,31 @@ class Action:
     stream_handlers: MutableMapping[str, Callable] = field(default_factory=dict)
     stream_in_handlers: MutableMapping[str, Callable] = field(default_factory=dict)
     stream_out_handlers: MutableMapping[str, Callable] = field(default_factory=dict)
+    unary_handler_plans: MutableMapping[str, HandlerPlan] = field(default_factory=dict)
+    stream_handler_plans: MutableMapping[str, HandlerPlan] = field(default_factory=dict)
+    stream_in_handler_plans: MutableMapping[str, HandlerPlan] = field(
+        default_factory=dict
+    )
+    stream_out_handler_plans: MutableMapping[str, HandlerPlan] = field(
+        default_factory=dict
+    )
+    # The commands of the unary handlers run in worker processes.
+    process_handlers: Set[str] = field(default_factory=set)
+    # The pools of the stream handlers handling elements concurrently.
+    stream_handler_pools: MutableMapping[str, OrderedPool] = field(default_factory=dict)
+    # The batchers of the unary handlers handling batches of commands.
+    unary_batchers: MutableMapping[str, UnaryBatcher] = field(default_factory=dict)
+    # How the stream and stream in handlers receive their commands in chunks.
+    stream_handler_chunks: MutableMapping[str, Chunks] = field(default_factory=dict)
+    stream_in_handler_chunks: MutableMapping[str, Chunks] = field(default_factory=dict)
+    # The commands of the stream handlers replying to every chunk.
+    chunk_reply_handlers: Set[str] = field(default_factory=set)
+    type_registry: TypeRegistry = field(init=False, default=None)
+
+    def __post_init__(self):
+        self.type_registry = TypeRegistry.for_service(
+            self.service_descriptor, self.file_descriptors
+        )
 
     @property
     def persistence_id(self):
@@ -30,10 +61,15 @@ class Action:
     def entity_type(self):
         return _ACTIONPROTOCOL.full_name
 
-    def unary_handler(self, name: str):
+    def unary_handler(self, name: str, lazy: bool = False, executor: str = "thread"):
         def register_unary_handler(function):
             """
             Register the function to handle commands
+            With lazy, payloads are passed as LazyMessages, parsed on first access
+            With executor="process", the function runs in one of the handler worker
+            processes, for CPU bound handlers not to hold the interpreter lock of the
+            user function. It has to be defined at the top level of its module, and
+            its payload is parsed in the worker process
             """
             if name in self.unary_handlers:
                 raise Exception(
@@ -41,74 +77,206 @@ class Action:
                         self.unary_handlers[name], name
                     )
                 )
+            self._check_method(name, function)
             if function.__code__.co_argcount > 2:
                 raise Exception(
                     "At most two parameters, the command and the context, should be "
                     "accepted by the command_handler function"
                 )
+            if executor not in ("thread", "process"):
+                raise Exception(
+                    f"Unknown executor {executor} of command handler function "
+                    f"{function}, either thread or process"
+                )
+            if executor == "process" and "<" in function.__qualname__:
+                raise Exception(
+                    f"Command handler function {function} cannot run in a worker "
+                    "process: it has to be defined at the top level of its module"
+                )
+            self.unary_handler_plans[name] = compile_handler(
+                function,
+                [self._command_slot(name), Slot("context", ActionContext, Context)],
+                allow_async=executor == "thread",
+            )
+            if executor == "process":
+                self.process_handlers.add(name)
+            self.unary_handler_plans[name].lazy = lazy
+            self.unary_handler_plans[name].decode = self.type_registry.method_decoder(
+                name, lazy
+            )
             self.unary_handlers[name] = function
             return function
 
         return register_unary_handler
 
-    def stream_handler(self, name: str):
+    def batch_unary_handler(
+        self, name: str, max_batch: int = 64, max_wait_ms: float = 5, lazy: bool = False
+    ):
+        def register_batch_unary_handler(function):
+            """
+            Register the function to handle batches of concurrent commands
+            The function is passed the list of the commands and the list of their
+            contexts, in that order, and returns the list of their replies, in the
+            same order. A batch is handled once max_batch commands are waiting, or
+            once its first command waited for max_wait_ms milliseconds
+            With lazy, payloads are passed as LazyMessages, parsed on first access
+            """
+            if name in self.unary_handlers:
+                raise Exception(
+                    "Command handler function {} already defined for command {}".format(
+                        self.unary_handlers[name], name
+                    )
+                )
+            self._check_method(name, function)
+            if function.__code__.co_argcount > 2:
+                raise Exception(
+                    "At most two parameters, the commands and the contexts, should be "
+                    "accepted by the batch_unary_handler function"
+                )
+            plan = compile_handler(
+                function, [Slot("commands", list), Slot("contexts", list)]
+            )
+            plan.lazy = lazy
+            plan.decode = self.type_registry.method_decoder(name, lazy)
+            self.unary_batchers[name] = UnaryBatcher(
+                plan, max_batch, max_wait_ms / 1000, self.name(), name
+            )
+            self.unary_handler_plans[name] = plan
+            self.unary_handlers[name] = function
+            return function
+
+        return register_batch_unary_handler
+
+    def stream_handler(
+        self,
+        name: str,
+        lazy: bool = False,
+        parallelism: int = 0,
+        window: int = 0,
+        chunks: Optional[Chunks] = None,
+        reply_per_chunk: bool = False,
+    ):
         def register_stream_handler(function):
             """
             Register the function to handle commands
+            With lazy, payloads are passed as LazyMessages, parsed on first access
+            With parallelism, the function handles a single element of the stream,
+            with its own context, and returns its reply, or None for no reply.
+            Elements are handled concurrently on a pool of that many threads, at
+            most window of them at once (twice the parallelism by default), and
+            their replies are sent in the order of the elements
+            With chunks, the elements of the stream are lists of commands, and with
+            reply_per_chunk, the function handles a single list as above
             """
             if name in self.stream_handlers:
                 raise Exception(
                     "Command handler function {} already defined for command {}".format(
-                        self.unary_handlers[name], name
+                        self.stream_handlers[name], name
                     )
                 )
+            self._check_method(name, function)
             if function.__code__.co_argcount > 2:
                 raise Exception(
                     "At most two parameters, the command and the context, should be "
                     "accepted by the command_handler function"
                 )
+            if reply_per_chunk and chunks is None:
+                raise Exception(
+                    f"Command handler function {function} cannot reply per chunk "
+                    "without chunks"
+                )
+            if parallelism:
+                self.stream_handler_pools[name] = OrderedPool(
+                    parallelism, window, f"{self.name()}/{name}"
+                )
+            if parallelism or reply_per_chunk:
+                command_slot = (
+                    Slot("commands", list) if chunks else self._command_slot(name)
+                )
+                self.stream_handler_plans[name] = compile_handler(
+                    function,
+                    [command_slot, Slot("context", ActionContext, Context)],
+                    allow_async=False,
+                )
+            else:
+                self.stream_handler_plans[name] = compile_handler(
+                    function,
+                    [Slot("commands"), Slot("context", ActionContext, Context)],
+                )
+            if chunks is not None:
+                self.stream_handler_chunks[name] = chunks
+            if reply_per_chunk:
+                self.chunk_reply_handlers.add(name)
+            self.stream_handler_plans[name].lazy = lazy
+            self.stream_handler_plans[name].decode = self.type_registry.method_decoder(
+                name, lazy
+            )
             self.stream_handlers[name] = function
             return function
 
         return register_stream_handler
 
-    def stream_in_handler(self, name: str):
+    def stream_in_handler(
+        self, name: str, lazy: bool = False, chunks: Optional[Chunks] = None
+    ):
         def register_stream_in_handler(function):
             """
             Register the function to handle commands
+            With lazy, payloads are passed as LazyMessages, parsed on first access
+            With chunks, the elements of the stream are lists of commands
             """
             if name in self.stream_in_handlers:
                 raise Exception(
                     "Command handler function {} already defined for command {}".format(
-                        self.unary_handlers[name], name
+                        self.stream_in_handlers[name], name
                     )
                 )
+            self._check_method(name, function)
             if function.__code__.co_argcount > 2:
                 raise Exception(
                     "At most two parameters, the command and the context, should be "
                     "accepted by the command_handler function"
                 )
+            self.stream_in_handler_plans[name] = compile_handler(
+                function, [Slot("commands"), Slot("context", ActionContext, Context)]
+            )
+            if chunks is not None:
+                self.stream_in_handler_chunks[name] = chunks
+            self.stream_in_handler_plans[name].lazy = lazy
+            self.stream_in_handler_plans[name].decode = (
+                self.type_registry.method_decoder(name, lazy)
+            )
             self.stream_in_handlers[name] = function
             return function
 
         return register_stream_in_handler
 
-    def stream_out_handler(self, name: str):
+    def stream_out_handler(self, name: str, lazy: bool = False):
         def register_stream_out_handler(function):
             """
             Register the function to handle commands
+            With lazy, payloads are passed as LazyMessages, parsed on first access
             """
             if name in self.stream_out_handlers:
                 raise Exception(
                     "Command handler function {} already defined for command {}".format(
-                        self.unary_handlers[name], name
+                        self.stream_out_handlers[name], name
                     )
                 )
+            self._check_method(name, function)
             if function.__code__.co_argcount > 2:
                 raise Exception(
                     "At most two parameters, the command and the context, should be "
                     "accepted by the command_handler function"
                 )
+            self.stream_out_handler_plans[name] = compile_handler(
+                function,
+                [self._command_slot(name), Slot("context", ActionContext, Context)],
+            )
+            self.stream_out_handler_plans[name].lazy = lazy
+            self.stream_out_handler_plans[name].decode = (
+                self.type_registry.method_decoder(name, lazy)
+            )
             self.stream_out_handlers[name] = function
             return function
 
@@ -117,28 +285,30 @@ class Action:
     def name(self):
         return self.service_descriptor.full_name
 
+    def command_decoder(self, plans: MutableMapping[str, HandlerPlan], name: str):
+        """The decoder of the payloads of the given command, handled by one of the
+        given plans."""
+        plan = plans.get(name)
+        return plan.decode if plan else self.type_registry.decode
 
-def invoke(function, parameters):
-    ordered_parameters = []
-    for parameter_definition in inspect.signature(function).parameters.values():
-        annotation = parameter_definition.annotation
-        if annotation == inspect._empty:
-            raise Exception(
-                f"Cannot inject parameter {parameter_definition.name} of function "
-                f"{function}: Missing type annotation"
-            )
-        match_found = False
-        for param in parameters:
-            if isinstance(param, annotation):
-                match_found = True
-                ordered_parameters.append(param)
-        if not match_found:
+    def handler_plans(self) -> List[HandlerPlan]:
+        """The plans of all the handlers registered for this action."""
+        return (
+            list(self.unary_handler_plans.values())
+            + list(self.stream_handler_plans.values())
+            + list(self.stream_in_handler_plans.values())
+            + list(self.stream_out_handler_plans.values())
+        )
+
+    def _check_method(self, name: str, function: Callable):
+        if name not in self.service_descriptor.methods_by_name:
             raise Exception(
-                "Cannot inject parameter {} of function {}: No matching value".format(
-                    parameter_definition.name, function
-                )
+                f"Command handler function {function} registered for unknown "
+                f"command {name} of service {self.name()}"
             )
-    return function(*ordered_parameters)
+
+    def _command_slot(self, name: str) -> Slot:
+        return Slot("command", self.type_registry.input_types.get(name), Message)
 
 
 class ActionHandler:
@@ -153,7 +323,7 @@ class ActionHandler:
                     self.function.name(), ctx.command_name
                 )
             )
-        return invoke(self.function.unary_handlers[ctx.command_name], [command, ctx])
+        return self.function.unary_handler_plans[ctx.command_name].invoke(command, ctx)
 
     def handle_stream(self, command, ctx: ActionContext):
         self.logger.info(f"handling stream: {command} {ctx}")
@@ -163,7 +333,17 @@ class ActionHandler:
                     self.function.name(), ctx.command_name
                 )
             )
-        return invoke(self.function.stream_handlers[ctx.command_name], [command, ctx])
+        return self.function.stream_handler_plans[ctx.command_name].invoke(command, ctx)
+
+    def input_type(self, name: str, payload) -> type:
+        """The message class of the payloads of the given command."""
+        registry = self.function.type_registry
+        return registry.input_types.get(name) or registry.resolve(payload.type_url)
+
+    def handle_stream_element(self, command, ctx: ActionContext):
+        """Handle an element, or a chunk, of a stream replied to element by
+        element."""
+        return self.function.stream_handler_plans[ctx.command_name].invoke(command, ctx)
 
     def handle_stream_in(self, command, ctx: ActionContext):
         if ctx.command_name not in self.function.stream_in_handlers:
@@ -172,8 +352,8 @@ class ActionHandler:
                     self.function.name(), ctx.command_name
                 )
             )
-        return invoke(
-            self.function.stream_in_handlers[ctx.command_name], [command, ctx]
+        return self.function.stream_in_handler_plans[ctx.command_name].invoke(
+            command, ctx
         )
 
     def handle_stream_out(self, command, ctx: ActionContext):
@@ -183,6 +363,6 @@ class ActionHandler:
                     self.function.name(), ctx.command_name
                 )
             )
-        return invoke(
-            self.function.stream_out_handlers[ctx.command_name], [command, ctx]
+        return self.function.stream_out_handler_plans[ctx.command_name].invoke(
+            command, ctx
         )
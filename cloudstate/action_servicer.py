@@ -4,24 +4,159 @@ Licensed under the Apache License, Version 2.0.
 """
 
 import logging
-from typing import List
+from time import perf_counter
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
 
 import grpc
 from google.protobuf import symbol_database as _symbol_database
 from grpc._server import _RequestIterator
 
+from cloudstate import tracing
 from cloudstate.action_context import ActionContext
 from cloudstate.action_pb2 import ActionCommand, ActionResponse
 from cloudstate.action_pb2_grpc import ActionProtocolServicer
 from cloudstate.action_protocol_entity import Action, ActionHandler
 from cloudstate.entity_pb2 import ClientAction
-from cloudstate.utils.payload_utils import get_payload
+from cloudstate.metrics import METRICS, CommandMetrics, timed
+from cloudstate.process_pool import PROCESS_POOL
+from cloudstate.utils.chunks import chunked
+from cloudstate.utils.ordered_pool import OrderedPool
 
 _sym_db = _symbol_database.Default()
 
 TYPE_URL_PREFIX = "type.googleapis.com/"
 
 
+def create_action_response(ctx: ActionContext, result) -> ActionResponse:
+    """Build the response to the proxy out of a handler result and its context.
+    Contexts of a single response write it in place, while those of streamed
+    responses are copied into a new one for each."""
+    if ctx.reply_to.__class__ is ActionResponse:
+        ctx.write_client_action(result, False)
+        return ctx.reply_to
+    client_action: ClientAction = ctx.create_client_action(result, False)
+    action_reply = ActionResponse()
+
+    if not ctx.has_errors():
+        action_reply.side_effects.extend(ctx.effects)
+        if client_action.HasField("reply"):
+            action_reply.reply.CopyFrom(client_action.reply)
+        elif client_action.HasField("forward"):
+            action_reply.forward.CopyFrom(client_action.forward)
+    else:
+        action_reply.failure.CopyFrom(client_action.failure)
+    return action_reply
+
+
+def encode_action_response(
+    command_metrics: CommandMetrics,
+    ctx: ActionContext,
+    result,
+    span: Optional[tracing.Span] = None,
+) -> ActionResponse:
+    start = perf_counter()
+    action_reply = create_action_response(ctx, result)
+    command_metrics.encode.observe(perf_counter() - start)
+    if ctx.has_errors():
+        command_metrics.failures.inc()
+    if span is not None:
+        span.add_event("cloudstate.reply")
+    return action_reply
+
+
+def handle_elements(
+    handler: ActionHandler,
+    pool: Optional[OrderedPool],
+    commands: Iterable,
+    ctx: ActionContext,
+    span: Optional[tracing.Span] = None,
+) -> Iterator[Tuple[ActionContext, Any]]:
+    """Handle the commands of a stream, concurrently on the pool if any, each with
+    its own context replying in place, and within a child span of the span of the
+    stream if any, and yield the contexts and results of those which reply, in the
+    order of the commands."""
+    command_name, trace_context = ctx.command_name, ctx.trace_context
+
+    def handle(indexed):
+        index, command = indexed
+        response = ActionResponse()
+        element_ctx = ActionContext(command_name, response, response.side_effects)
+        element_ctx.trace_context = trace_context
+        element_span = None
+        if span is not None:
+            element_span = start_element_span(span, element_ctx, index)
+        try:
+            return element_ctx, handler.handle_stream_element(command, element_ctx)
+        except Exception as ex:
+            element_ctx.fail(str(ex))
+            if element_span is not None:
+                element_span.record_exception(ex)
+            logging.exception("Failed to execute command:" + str(ex))
+            return element_ctx, None
+        finally:
+            if element_span is not None:
+                tracing.end_span(element_span, element_ctx)
+
+    indexed = enumerate(commands)
+    results = map(handle, indexed) if pool is None else pool.map(handle, indexed)
+    for element_ctx, result in results:
+        if (
+            result is not None
+            or element_ctx.has_errors()
+            or element_ctx.forward is not None
+        ):
+            yield element_ctx, result
+
+
+def start_action_span(
+    command: ActionCommand, ctx: ActionContext
+) -> Optional[tracing.Span]:
+    """The span of the given command, or None when tracing is disabled."""
+    tracer = tracing.TRACER
+    if not tracer.enabled:
+        return None
+    return tracing.start_span(
+        tracer,
+        ctx,
+        f"{command.service_name}/{command.name}",
+        command.metadata,
+        {"cloudstate.command": command.name},
+    )
+
+
+def start_element_span(
+    span: tracing.Span, ctx: ActionContext, index: int
+) -> tracing.Span:
+    """The child span of the element at the given index of a stream."""
+    return tracing.start_child_span(
+        tracing.TRACER,
+        span,
+        ctx,
+        f"{ctx.command_name}/element",
+        {"cloudstate.command": ctx.command_name, "cloudstate.element": index},
+    )
+
+
+def traced_elements(
+    elements: Iterable, span: tracing.Span, ctx: ActionContext
+) -> Iterator:
+    """The elements of a stream handled by a single call, each within a child span
+    of the span of the stream, from its reception to that of the next one, while
+    which the context propagates it."""
+    trace_context = ctx.trace_context
+    element_span = None
+    try:
+        for index, element in enumerate(elements):
+            if element_span is not None:
+                element_span.end()
+            element_span = start_element_span(span, ctx, index)
+            yield element
+    finally:
+        if element_span is not None:
+            element_span.end()
+        ctx.trace_context = trace_context
+
+
 class CloudStateActionProtocolServicer(ActionProtocolServicer):
     def __init__(self, action_protocol_entities: List[Action]):
         self.action_protocol_entities = {
@@ -34,28 +169,46 @@ class CloudStateActionProtocolServicer(ActionProtocolServicer):
         if request.service_name in self.action_protocol_entities:
             service = self.action_protocol_entities[request.service_name]
             handler = ActionHandler(service)
-            ctx = ActionContext(request.name)
+            response = ActionResponse()
+            ctx = ActionContext(request.name, response, response.side_effects)
+            span = start_action_span(request, ctx)
+            decode = service.command_decoder(service.unary_handler_plans, request.name)
+            command_metrics = METRICS.command(request.service_name, request.name)
             result = None
             try:
-                result = handler.handle_unary(
-                    get_payload(request), ctx
-                )  # the proto the user defined function returned.
+                start = perf_counter()
+                if request.name in service.process_handlers:
+                    # Decoded in the worker process, and replied serialized.
+                    result = PROCESS_POOL.run(
+                        service.unary_handlers[request.name],
+                        handler.input_type(request.name, request.payload),
+                        ctx,
+                        request.payload,
+                    )
+                    command_metrics.handler.observe(perf_counter() - start)
+                else:
+                    command = decode(request.payload)
+                    decoded = perf_counter()
+                    command_metrics.decode.observe(decoded - start)
+                    batcher = service.unary_batchers.get(request.name)
+                    if batcher is not None:
+                        # Waits for the batch of the command to be handled.
+                        result = batcher.call(command, ctx)
+                    else:
+                        result = handler.handle_unary(
+                            command, ctx
+                        )  # the proto the user defined function returned.
+                    command_metrics.handler.observe(perf_counter() - decoded)
             except Exception as ex:
                 ctx.fail(str(ex))
+                if span is not None:
+                    span.record_exception(ex)
                 logging.exception("Failed to execute command:" + str(ex))
 
-            client_action: ClientAction = ctx.create_client_action(result, False)
-            action_reply = ActionResponse()
-
-            if not ctx.has_errors():
-                action_reply.side_effects.extend(ctx.effects)
-                if client_action.HasField("reply"):
-                    action_reply.reply.CopyFrom(client_action.reply)
-                elif client_action.HasField("forward"):
-                    action_reply.forward.CopyFrom(client_action.forward)
-            else:
-                action_reply.failure.CopyFrom(client_action.failure)
-            return action_reply
+            response = encode_action_response(command_metrics, ctx, result)
+            if span is not None:
+                tracing.end_span(span, ctx)
+            return response
 
     def handleStreamed(self, request_iterator: _RequestIterator, context):
         peek = request_iterator.next()  # evidently, the first message has no payload
@@ -68,28 +221,49 @@ class CloudStateActionProtocolServicer(ActionProtocolServicer):
             context.set_details("Method not implemented!")
             raise NotImplementedError("Method not implemented!")
 
-        reconstructed = (get_payload(x) for x in request_iterator)
+        command_metrics = METRICS.command(peek.service_name, peek.name)
+        decode = timed(
+            handler.function.command_decoder(
+                handler.function.stream_handler_plans, peek.name
+            ),
+            command_metrics.decode,
+        )
+        reconstructed = (decode(x.payload) for x in request_iterator)
+        chunks = handler.function.stream_handler_chunks.get(peek.name)
+        if chunks is not None:
+            reconstructed = chunked(reconstructed, chunks)
         ctx = ActionContext(peek.name)
+        span = start_action_span(peek, ctx)
+        active_streams = METRICS.entity(peek.service_name).active_streams
+        active_streams.inc()
+        start = perf_counter()
+        pool = handler.function.stream_handler_pools.get(peek.name)
         try:
+            if pool is not None or peek.name in handler.function.chunk_reply_handlers:
+                for element_ctx, r in handle_elements(
+                    handler, pool, reconstructed, ctx, span
+                ):
+                    yield encode_action_response(command_metrics, element_ctx, r, span)
+                return
+            if span is not None:
+                reconstructed = traced_elements(reconstructed, span, ctx)
             result = handler.handle_stream(
                 reconstructed, ctx
             )  # the proto the user defined function returned.
             for r in result:
-                client_action = ctx.create_client_action(r, False)
-                action_reply = ActionResponse()
-                if not ctx.has_errors():
-                    action_reply.side_effects.extend(ctx.effects)
-                    if client_action.HasField("reply"):
-                        action_reply.reply.CopyFrom(client_action.reply)
-                    elif client_action.HasField("forward"):
-                        action_reply.forward.CopyFrom(client_action.forward)
-                else:
-                    action_reply.failure.CopyFrom(client_action.failure)
-                yield action_reply
+                yield encode_action_response(command_metrics, ctx, r, span)
 
         except Exception as ex:
             ctx.fail(str(ex))
+            if span is not None:
+                span.record_exception(ex)
+            command_metrics.failures.inc()
             logging.exception("Failed to execute command:" + str(ex))
+        finally:
+            command_metrics.handler.observe(perf_counter() - start)
+            active_streams.dec()
+            if span is not None:
+                tracing.end_span(span, ctx)
 
     def handleStreamedIn(self, request_iterator, context):
         peek = request_iterator.next()  # evidently, the first message has no payload
@@ -103,27 +277,40 @@ class CloudStateActionProtocolServicer(ActionProtocolServicer):
             context.set_details("Method not implemented!")
             raise NotImplementedError("Method not implemented!")
 
-        reconstructed = (get_payload(x) for x in request_iterator)
-        ctx = ActionContext(peek.name)
+        command_metrics = METRICS.command(peek.service_name, peek.name)
+        decode = timed(
+            handler.function.command_decoder(
+                handler.function.stream_in_handler_plans, peek.name
+            ),
+            command_metrics.decode,
+        )
+        reconstructed = (decode(x.payload) for x in request_iterator)
+        chunks = handler.function.stream_in_handler_chunks.get(peek.name)
+        if chunks is not None:
+            reconstructed = chunked(reconstructed, chunks)
+        response = ActionResponse()
+        ctx = ActionContext(peek.name, response, response.side_effects)
+        span = start_action_span(peek, ctx)
+        active_streams = METRICS.entity(peek.service_name).active_streams
+        active_streams.inc()
+        start = perf_counter()
         try:
             result = handler.handle_stream_in(
                 reconstructed, ctx
             )  # the proto the user defined function returned.
-            client_action = ctx.create_client_action(result, False)
-            action_reply = ActionResponse()
-            if not ctx.has_errors():
-                action_reply.side_effects.extend(ctx.effects)
-                if client_action.HasField("reply"):
-                    action_reply.reply.CopyFrom(client_action.reply)
-                elif client_action.HasField("forward"):
-                    action_reply.forward.CopyFrom(client_action.forward)
-            else:
-                action_reply.failure.CopyFrom(client_action.failure)
-            return action_reply
+            command_metrics.handler.observe(perf_counter() - start)
+            return encode_action_response(command_metrics, ctx, result)
 
         except Exception as ex:
             ctx.fail(str(ex))
+            if span is not None:
+                span.record_exception(ex)
             logging.exception("Failed to execute command:" + str(ex))
+            return encode_action_response(command_metrics, ctx, None)
+        finally:
+            active_streams.dec()
+            if span is not None:
+                tracing.end_span(span, ctx)
 
     def handleStreamedOut(self, request, context):
         if request.service_name in self.action_protocol_entities:
@@ -133,22 +320,31 @@ class CloudStateActionProtocolServicer(ActionProtocolServicer):
             context.set_details("Method not implemented!")
             raise NotImplementedError("Method not implemented!")
 
-        reconstructed = get_payload(request)
+        command_metrics = METRICS.command(request.service_name, request.name)
+        decode = timed(
+            handler.function.command_decoder(
+                handler.function.stream_out_handler_plans, request.name
+            ),
+            command_metrics.decode,
+        )
+        reconstructed = decode(request.payload)
         ctx = ActionContext(request.name)
+        span = start_action_span(request, ctx)
+        active_streams = METRICS.entity(request.service_name).active_streams
+        active_streams.inc()
+        start = perf_counter()
         try:
             for result in handler.handle_stream_out(reconstructed, ctx):
-                client_action = ctx.create_client_action(result, False)
-                action_reply = ActionResponse()
-                if not ctx.has_errors():
-                    action_reply.side_effects.extend(ctx.effects)
-                    if client_action.HasField("reply"):
-                        action_reply.reply.CopyFrom(client_action.reply)
-                    elif client_action.HasField("forward"):
-                        action_reply.forward.CopyFrom(client_action.forward)
-                else:
-                    action_reply.failure.CopyFrom(client_action.failure)
-                yield action_reply
+                yield encode_action_response(command_metrics, ctx, result, span)
 
         except Exception as ex:
             ctx.fail(str(ex))
+            if span is not None:
+                span.record_exception(ex)
+            command_metrics.failures.inc()
             logging.exception("Failed to execute command:" + str(ex))
+        finally:
+            command_metrics.handler.observe(perf_counter() - start)
+            active_streams.dec()
+            if span is not None:
+                tracing.end_span(span, ctx)
@@ -0,0 +1,263 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import asyncio
+import inspect
+import logging
+from time import perf_counter
+from typing import Mapping
+
+import grpc
+
+from cloudstate import action_servicer, tracing
+from cloudstate.action_context import ActionContext
+from cloudstate.action_pb2 import ActionCommand, ActionResponse
+from cloudstate.action_protocol_entity import ActionHandler
+from cloudstate.action_servicer import (
+    encode_action_response,
+    handle_elements,
+    start_action_span,
+    start_element_span,
+    traced_elements,
+)
+from cloudstate.aio.iterators import BlockingIterator, iterate_in_executor
+from cloudstate.metrics import METRICS, timed
+from cloudstate.process_pool import PROCESS_POOL, apply_outcome
+from cloudstate.utils.chunks import Chunks, chunked
+from cloudstate.utils.handler_utils import HandlerPlan
+
+
+def _chunked(reconstructed, chunks: Chunks, loop):
+    """The chunks of the request stream, as an asynchronous iterator. They are
+    gathered in the default executor of the loop, as timed chunks wait for the
+    next element and the end of their time at once."""
+    return iterate_in_executor(
+        chunked(BlockingIterator(reconstructed, loop), chunks), loop
+    )
+
+
+async def _traced(elements, span: tracing.Span, ctx: ActionContext):
+    """The elements of the request stream within child spans of the span of the
+    stream, as traced_elements does for synchronous iterators."""
+    trace_context = ctx.trace_context
+    element_span = None
+    index = 0
+    try:
+        async for element in elements:
+            if element_span is not None:
+                element_span.end()
+            element_span = start_element_span(span, ctx, index)
+            index += 1
+            yield element
+    finally:
+        if element_span is not None:
+            element_span.end()
+        ctx.trace_context = trace_context
+
+
+def _is_async(plans: Mapping[str, HandlerPlan], name: str) -> bool:
+    plan = plans.get(name)
+    return plan is not None and plan.is_async
+
+
+class CloudStateActionProtocolServicer(
+    action_servicer.CloudStateActionProtocolServicer
+):
+    """Serves actions on the running event loop. Handlers may be coroutines or
+    asynchronous generators. Synchronous handlers run on the event loop as well,
+    except for those consuming a request stream, which run in the default executor
+    of the loop since they block while waiting for the next element."""
+
+    def _handler(self, request: ActionCommand, context) -> ActionHandler:
+        if request.service_name in self.action_protocol_entities:
+            return ActionHandler(self.action_protocol_entities[request.service_name])
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details("Method not implemented!")
+        raise NotImplementedError("Method not implemented!")
+
+    async def handleUnary(self, request: ActionCommand, context):
+        if request.service_name in self.action_protocol_entities:
+            service = self.action_protocol_entities[request.service_name]
+            handler = ActionHandler(service)
+            response = ActionResponse()
+            ctx = ActionContext(request.name, response, response.side_effects)
+            span = start_action_span(request, ctx)
+            decode = service.command_decoder(service.unary_handler_plans, request.name)
+            command_metrics = METRICS.command(request.service_name, request.name)
+            result = None
+            try:
+                start = perf_counter()
+                if request.name in service.process_handlers:
+                    # Decoded in the worker process, and replied serialized.
+                    outcome = await asyncio.wrap_future(
+                        PROCESS_POOL.submit_command(
+                            service.unary_handlers[request.name],
+                            handler.input_type(request.name, request.payload),
+                            ctx,
+                            request.payload,
+                        )
+                    )
+                    result = apply_outcome(ctx, outcome)
+                    command_metrics.handler.observe(perf_counter() - start)
+                else:
+                    command = decode(request.payload)
+                    decoded = perf_counter()
+                    command_metrics.decode.observe(decoded - start)
+                    batcher = service.unary_batchers.get(request.name)
+                    if batcher is not None:
+                        result = await batcher.call_async(command, ctx)
+                    else:
+                        result = handler.handle_unary(command, ctx)
+                        if inspect.isawaitable(result):
+                            result = await result
+                    command_metrics.handler.observe(perf_counter() - decoded)
+            except Exception as ex:
+                ctx.fail(str(ex))
+                if span is not None:
+                    span.record_exception(ex)
+                logging.exception("Failed to execute command:" + str(ex))
+            response = encode_action_response(command_metrics, ctx, result)
+            if span is not None:
+                tracing.end_span(span, ctx)
+            return response
+
+    async def handleStreamed(self, request_iterator, context):
+        peek = await request_iterator.__anext__()  # the first message has no payload
+        handler = self._handler(peek, context)
+        command_metrics = METRICS.command(peek.service_name, peek.name)
+        decode = timed(
+            handler.function.command_decoder(
+                handler.function.stream_handler_plans, peek.name
+            ),
+            command_metrics.decode,
+        )
+        reconstructed = (decode(x.payload) async for x in request_iterator)
+        chunks = handler.function.stream_handler_chunks.get(peek.name)
+        if chunks is not None:
+            reconstructed = _chunked(reconstructed, chunks, asyncio.get_running_loop())
+        ctx = ActionContext(peek.name)
+        span = start_action_span(peek, ctx)
+        active_streams = METRICS.entity(peek.service_name).active_streams
+        active_streams.inc()
+        start = perf_counter()
+        pool = handler.function.stream_handler_pools.get(peek.name)
+        try:
+            if pool is not None or peek.name in handler.function.chunk_reply_handlers:
+                loop = asyncio.get_running_loop()
+                elements = handle_elements(
+                    handler, pool, BlockingIterator(reconstructed, loop), ctx, span
+                )
+                async for element_ctx, r in iterate_in_executor(elements, loop):
+                    yield encode_action_response(command_metrics, element_ctx, r, span)
+            elif _is_async(handler.function.stream_handler_plans, peek.name):
+                if span is not None:
+                    reconstructed = _traced(reconstructed, span, ctx)
+                async for r in handler.handle_stream(reconstructed, ctx):
+                    yield encode_action_response(command_metrics, ctx, r, span)
+            else:
+                loop = asyncio.get_running_loop()
+                elements = BlockingIterator(reconstructed, loop)
+                if span is not None:
+                    elements = traced_elements(elements, span, ctx)
+                result = await loop.run_in_executor(
+                    None, handler.handle_stream, elements, ctx
+                )
+                async for r in iterate_in_executor(result, loop):
+                    yield encode_action_response(command_metrics, ctx, r, span)
+
+        except Exception as ex:
+            ctx.fail(str(ex))
+            if span is not None:
+                span.record_exception(ex)
+            command_metrics.failures.inc()
+            logging.exception("Failed to execute command:" + str(ex))
+        finally:
+            command_metrics.handler.observe(perf_counter() - start)
+            active_streams.dec()
+            if span is not None:
+                tracing.end_span(span, ctx)
+
+    async def handleStreamedIn(self, request_iterator, context):
+        peek = await request_iterator.__anext__()  # the first message has no payload
+        handler = self._handler(peek, context)
+        command_metrics = METRICS.command(peek.service_name, peek.name)
+        decode = timed(
+            handler.function.command_decoder(
+                handler.function.stream_in_handler_plans, peek.name
+            ),
+            command_metrics.decode,
+        )
+        reconstructed = (decode(x.payload) async for x in request_iterator)
+        chunks = handler.function.stream_in_handler_chunks.get(peek.name)
+        if chunks is not None:
+            reconstructed = _chunked(reconstructed, chunks, asyncio.get_running_loop())
+        response = ActionResponse()
+        ctx = ActionContext(peek.name, response, response.side_effects)
+        span = start_action_span(peek, ctx)
+        active_streams = METRICS.entity(peek.service_name).active_streams
+        active_streams.inc()
+        start = perf_counter()
+        try:
+            if _is_async(handler.function.stream_in_handler_plans, peek.name):
+                result = await handler.handle_stream_in(reconstructed, ctx)
+            else:
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(
+                    None,
+                    handler.handle_stream_in,
+                    BlockingIterator(reconstructed, loop),
+                    ctx,
+                )
+            command_metrics.handler.observe(perf_counter() - start)
+            return encode_action_response(command_metrics, ctx, result)
+
+        except Exception as ex:
+            ctx.fail(str(ex))
+            if span is not None:
+                span.record_exception(ex)
+            logging.exception("Failed to execute command:" + str(ex))
+            return encode_action_response(command_metrics, ctx, None)
+        finally:
+            active_streams.dec()
+            if span is not None:
+                tracing.end_span(span, ctx)
+
+    async def handleStreamedOut(self, request: ActionCommand, context):
+        handler = self._handler(request, context)
+        command_metrics = METRICS.command(request.service_name, request.name)
+        decode = timed(
+            handler.function.command_decoder(
+                handler.function.stream_out_handler_plans, request.name
+            ),
+            command_metrics.decode,
+        )
+        reconstructed = decode(request.payload)
+        ctx = ActionContext(request.name)
+        span = start_action_span(request, ctx)
+        active_streams = METRICS.entity(request.service_name).active_streams
+        active_streams.inc()
+        start = perf_counter()
+        try:
+            results = handler.handle_stream_out(reconstructed, ctx)
+            if inspect.isawaitable(results):
+                results = await results
+            if hasattr(results, "__aiter__"):
+                async for result in results:
+                    yield encode_action_response(command_metrics, ctx, result, span)
+            else:
+                for result in results:
+                    yield encode_action_response(command_metrics, ctx, result, span)
+
+        except Exception as ex:
+            ctx.fail(str(ex))
+            if span is not None:
+                span.record_exception(ex)
+            command_metrics.failures.inc()
+            logging.exception("Failed to execute command:" + str(ex))
+        finally:
+            command_metrics.handler.observe(perf_counter() - start)
+            active_streams.dec()
+            if span is not None:
+                tracing.end_span(span, ctx)
@@ -0,0 +1,19 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+from cloudstate import discovery_servicer
+
+
+class CloudStateEntityDiscoveryServicer(
+    discovery_servicer.CloudStateEntityDiscoveryServicer
+):
+    async def discover(self, request, context):
+        return super().discover(request, context)
+
+    async def discover_serialized(self, request, context) -> bytes:
+        return super().discover_serialized(request, context)
+
+    async def reportError(self, request, context):
+        return super().reportError(request, context)
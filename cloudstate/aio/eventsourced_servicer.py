@@ -0,0 +1,59 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import inspect
+from time import perf_counter
+
+from cloudstate import eventsourced_servicer
+from cloudstate.entity_pb2 import Command
+from cloudstate.event_sourced_pb2 import EventSourcedStreamOut
+from cloudstate.eventsourced_servicer import EventSourcedStream
+
+
+class CloudStateEventSourcedServicer(
+    eventsourced_servicer.CloudStateEventSourcedServicer
+):
+    """Serves every entity stream as a task of the running event loop. Command
+    handlers may be coroutines, events and snapshots are always handled
+    synchronously."""
+
+    async def handle(self, request_iterator, context):
+        stream = EventSourcedStream(self.event_sourced_entities, self.state_cache)
+        try:
+            async for request in request_iterator:
+                # Dispatch on the field set, commands and events first.
+                message = request.WhichOneof("message")
+                if message == "command" and stream.initiated:
+                    yield await handle_command(stream, request.command)
+                elif message == "event" and stream.initiated:
+                    stream.apply_event(request.event)
+                elif message == "init" and not stream.initiated:
+                    stream.init(request.init)
+                elif stream.initiated:
+                    raise Exception(
+                        "Cannot handle {} after initialization".format(type(request))
+                    )
+                else:
+                    raise Exception(
+                        "Cannot handle {} before initialization".format(request)
+                    )
+        finally:
+            stream.close()
+
+
+async def handle_command(
+    stream: EventSourcedStream, command: Command
+) -> EventSourcedStreamOut:
+    cmd, ctx = stream.begin_command(command)
+    result = None
+    start = perf_counter()
+    try:
+        result = stream.invoke_command(cmd, ctx)
+        if inspect.isawaitable(result):
+            result = await result
+    except Exception as ex:
+        stream.command_failed(ctx, ex)
+    stream.command_metrics.handler.observe(perf_counter() - start)
+    return stream.complete_command(command, ctx, result)
@@ -0,0 +1,49 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import asyncio
+from typing import AsyncIterator, Iterator
+
+_DONE = object()
+
+
+async def _next(iterator: AsyncIterator):
+    return await iterator.__anext__()
+
+
+class BlockingIterator:
+    """Iterates over an asynchronous iterator from a worker thread, waiting on the
+    event loop for every element. Lets synchronous handlers consume request
+    streams of the asyncio servicers."""
+
+    def __init__(self, iterator: AsyncIterator, loop: asyncio.AbstractEventLoop):
+        self.iterator = iterator.__aiter__()
+        self.loop = loop
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        future = asyncio.run_coroutine_threadsafe(_next(self.iterator), self.loop)
+        try:
+            return future.result()
+        except StopAsyncIteration:
+            raise StopIteration
+
+    # grpc's request iterators expose next() as well.
+    next = __next__
+
+
+async def iterate_in_executor(
+    iterator: Iterator, loop: asyncio.AbstractEventLoop
+) -> AsyncIterator:
+    """Iterates over a synchronous iterator in the default executor of the loop, so
+    that the loop is never blocked while it computes the next element."""
+    iterator = iter(iterator)
+    while True:
+        element = await loop.run_in_executor(None, next, iterator, _DONE)
+        if element is _DONE:
+            return
+        yield element
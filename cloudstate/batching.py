@@ -0,0 +1,169 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import asyncio
+import inspect
+import threading
+from time import monotonic, perf_counter
+from typing import Any, List, Optional
+
+from cloudstate.action_context import ActionContext
+from cloudstate.metrics import METRICS
+from cloudstate.utils.handler_utils import HandlerPlan
+
+
+class _Call:
+    __slots__ = ("command", "ctx", "result", "error", "done")
+
+    def __init__(self, command, ctx: ActionContext, done):
+        self.command = command
+        self.ctx = ctx
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.done = done
+
+
+class _Batch:
+    __slots__ = ("calls", "closed", "opened")
+
+    def __init__(self):
+        self.calls: List[_Call] = []
+        self.closed = False
+        self.opened = perf_counter()
+
+
+class UnaryBatcher:
+    """Collects the concurrent calls of a unary command into batches of at most
+    max_batch calls, each handled by a single call of the batch handler once it is
+    full or its first call waited for max_wait seconds.
+
+    With the threaded server, the thread of the first call of a batch waits for the
+    others and handles the batch, while the threads of the others wait for their
+    results, so batches are at most as large as the gRPC thread pool. With the
+    asyncio server, calls wait on the event loop."""
+
+    def __init__(
+        self,
+        plan: HandlerPlan,
+        max_batch: int,
+        max_wait: float,
+        entity: str,
+        command: str,
+    ):
+        if max_batch < 1:
+            raise Exception(f"Batches of {entity}/{command} must hold a command")
+        self.plan = plan
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.size = METRICS.batch_size.labels(entity, command)
+        self.wait = METRICS.batch_wait_seconds.labels(entity, command)
+        self._lock = threading.Lock()
+        self._closed = threading.Condition(self._lock)
+        self._batch: Optional[_Batch] = None
+        self._async_batch: Optional[_Batch] = None
+
+    def call(self, command, ctx: ActionContext):
+        """Handle the command as part of a batch, from a thread of the server."""
+        call = _Call(command, ctx, threading.Event())
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            batch.calls.append(call)
+            if len(batch.calls) >= self.max_batch:
+                self._close(batch)
+                self._closed.notify_all()
+            elif leader:
+                deadline = monotonic() + self.max_wait
+                while not batch.closed:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._closed.wait(remaining)
+                self._close(batch)
+        if leader:
+            try:
+                results = self.plan.invoke(*self._arguments(batch))
+            except Exception as ex:
+                results = ex
+            self._handle(batch, results)
+        else:
+            call.done.wait()
+        return self._result(call)
+
+    async def call_async(self, command, ctx: ActionContext):
+        """Handle the command as part of a batch, on the running event loop."""
+        loop = asyncio.get_running_loop()
+        call = _Call(command, ctx, loop.create_future())
+        batch = self._async_batch
+        if batch is None:
+            batch = self._async_batch = _Batch()
+            loop.call_later(self.max_wait, self._flush_async, batch)
+        batch.calls.append(call)
+        if len(batch.calls) >= self.max_batch:
+            self._flush_async(batch)
+        await call.done
+        return self._result(call)
+
+    def _flush_async(self, batch: _Batch):
+        if batch.closed:
+            return
+        batch.closed = True
+        if self._async_batch is batch:
+            self._async_batch = None
+        asyncio.ensure_future(self._handle_async(batch))
+
+    async def _handle_async(self, batch: _Batch):
+        try:
+            results = self.plan.invoke(*self._arguments(batch))
+            if inspect.isawaitable(results):
+                results = await results
+        except Exception as ex:
+            results = ex
+        self._handle(batch, results)
+
+    def _close(self, batch: _Batch):
+        batch.closed = True
+        if self._batch is batch:
+            self._batch = None
+
+    def _arguments(self, batch: _Batch):
+        self.size.observe(len(batch.calls))
+        self.wait.observe(perf_counter() - batch.opened)
+        return [call.command for call in batch.calls], [
+            call.ctx for call in batch.calls
+        ]
+
+    def _handle(self, batch: _Batch, results: Any):
+        """Hand the results of the batch handler, or the exception it raised, out to
+        the calls."""
+        calls = batch.calls
+        if not isinstance(results, BaseException):
+            try:
+                results = list(results)
+                if len(results) != len(calls):
+                    raise Exception(
+                        f"Batch handler {self.plan.function} returned {len(results)} "
+                        f"results for {len(calls)} commands"
+                    )
+            except Exception as ex:
+                results = ex
+        for index, call in enumerate(calls):
+            if isinstance(results, BaseException):
+                call.error = results
+            else:
+                call.result = results[index]
+            done = call.done
+            if isinstance(done, threading.Event):
+                done.set()
+            elif not done.done():
+                done.set_result(None)
+
+    @staticmethod
+    def _result(call: _Call):
+        if call.error is not None:
+            raise call.error
+        return call.result
@@ -0,0 +1,10 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import sys
+
+from cloudstate.bench.load import main
+
+sys.exit(main())
@@ -0,0 +1,482 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+
+Load generator playing the role of the proxy against a running user function which
+serves the shopping cart and action demo entities, such as the TCK server:
+
+    python -m cloudstate.test.tck_services server shoppingcart ActionDemo
+    python -m cloudstate.bench --target localhost:8080 --concurrency 32
+"""
+
+import argparse
+import json
+import queue
+import random
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+import grpc
+from google.protobuf.any_pb2 import Any
+
+from cloudstate.action_pb2 import ActionCommand
+from cloudstate.action_pb2_grpc import ActionProtocolStub
+from cloudstate.bench.stats import latency_summary
+from cloudstate.entity_pb2 import Command, ProxyInfo
+from cloudstate.entity_pb2_grpc import EntityDiscoveryStub
+from cloudstate.event_sourced_pb2 import (
+    EventSourcedInit,
+    EventSourcedStreamIn,
+    EventSourcedStreamOut,
+)
+from cloudstate.event_sourced_pb2_grpc import EventSourcedStub
+from cloudstate.test.actiondemo.actiondemo_pb2 import _ACTIONDEMO, FunctionRequest
+from cloudstate.test.shoppingcart.shoppingcart_pb2 import (
+    _SHOPPINGCART,
+    AddLineItem,
+    GetShoppingCart,
+    RemoveLineItem,
+)
+
+CART_SERVICE = _SHOPPINGCART.full_name
+ACTION_SERVICE = _ACTIONDEMO.full_name
+DEFAULT_MIX = "cart.add=4,cart.get=2,cart.remove=1,action.unary=2,action.streamed=1"
+PRODUCTS = 10
+
+_CLOSE = object()
+
+
+def packed(message) -> Any:
+    payload = Any()
+    payload.Pack(message)
+    return payload
+
+
+class StreamCall:
+    """A bidirectional streaming call, one request and reply at a time."""
+
+    def __init__(self, method: Callable, *requests):
+        self.requests: queue.Queue = queue.Queue()
+        for request in requests:
+            self.requests.put(request)
+        self.responses = method(iter(self.requests.get, _CLOSE))
+
+    def call(self, request):
+        self.requests.put(request)
+        return next(self.responses)
+
+    def close(self):
+        self.requests.put(_CLOSE)
+        self.responses.cancel()
+
+
+class Client:
+    """One simulated proxy connection, owning an entity stream for its own shopping
+    cart and a streamed action call, both opened on first use."""
+
+    def __init__(
+        self, channel: grpc.Channel, entity_id: str, seed: int, timeout: float = 10.0
+    ):
+        self.timeout = timeout
+        self.event_sourced = EventSourcedStub(channel)
+        self.actions = ActionProtocolStub(channel)
+        self.entity_id = entity_id
+        self.random = random.Random(seed)
+        self.cart: Optional[StreamCall] = None
+        self.streamed: Optional[StreamCall] = None
+        self.command_id = 0
+        self.products: List[str] = []
+
+    def cart_command(self, name: str, message) -> bool:
+        if self.cart is None:
+            self.cart = StreamCall(
+                self.event_sourced.handle,
+                EventSourcedStreamIn(
+                    init=EventSourcedInit(
+                        service_name=CART_SERVICE, entity_id=self.entity_id
+                    )
+                ),
+            )
+        self.command_id += 1
+        output: EventSourcedStreamOut = self.cart.call(
+            EventSourcedStreamIn(
+                command=Command(
+                    entity_id=self.entity_id,
+                    id=self.command_id,
+                    name=name,
+                    payload=packed(message),
+                )
+            )
+        )
+        return output.HasField("failure") or output.reply.client_action.HasField(
+            "failure"
+        )
+
+    def add_item(self) -> bool:
+        product = f"product-{self.random.randrange(PRODUCTS)}"
+        if product not in self.products:
+            self.products.append(product)
+        return self.cart_command(
+            "AddItem",
+            AddLineItem(
+                user_id=self.entity_id, product_id=product, name=product, quantity=1
+            ),
+        )
+
+    def get_cart(self) -> bool:
+        return self.cart_command("GetCart", GetShoppingCart(user_id=self.entity_id))
+
+    def remove_item(self) -> bool:
+        if not self.products:
+            return self.add_item()
+        product = self.products.pop(self.random.randrange(len(self.products)))
+        return self.cart_command(
+            "RemoveItem", RemoveLineItem(user_id=self.entity_id, product_id=product)
+        )
+
+    def action_unary(self) -> bool:
+        response = self.actions.handleUnary(
+            ActionCommand(
+                service_name=ACTION_SERVICE,
+                name="ReverseString",
+                payload=packed(FunctionRequest(foo=self.entity_id)),
+            ),
+            timeout=self.timeout,
+        )
+        return response.HasField("failure")
+
+    def action_streamed(self) -> bool:
+        if self.streamed is None:
+            self.streamed = StreamCall(
+                self.actions.handleStreamed,
+                ActionCommand(service_name=ACTION_SERVICE, name="ReverseStrings"),
+            )
+        response = self.streamed.call(
+            ActionCommand(payload=packed(FunctionRequest(foo=self.entity_id)))
+        )
+        return response.HasField("failure")
+
+    def reset(self):
+        """Drop the streams after an error, to open new ones on the next call."""
+        for call in (self.cart, self.streamed):
+            if call is not None:
+                call.close()
+        self.cart = self.streamed = None
+
+    close = reset
+
+    def cancel(self):
+        """Cancel the streams from another thread, failing the calls waiting on
+        them."""
+        for call in (self.cart, self.streamed):
+            if call is not None:
+                call.responses.cancel()
+
+
+OPERATIONS: Dict[str, Callable[[Client], bool]] = {
+    "cart.add": Client.add_item,
+    "cart.get": Client.get_cart,
+    "cart.remove": Client.remove_item,
+    "action.unary": Client.action_unary,
+    "action.streamed": Client.action_streamed,
+}
+
+
+def parse_mix(text: str) -> List[Tuple[str, float]]:
+    """Parse a command mix such as "cart.add=4,action.unary=1" into weights."""
+    mix = []
+    for part in text.split(","):
+        name, _, weight = part.strip().partition("=")
+        if name not in OPERATIONS:
+            raise ValueError(
+                f"Unknown operation {name}, expected one of {', '.join(OPERATIONS)}"
+            )
+        mix.append((name, float(weight or 1)))
+    if not any(weight > 0 for _, weight in mix):
+        raise ValueError("The command mix has no operation with a positive weight")
+    return mix
+
+
+@dataclass
+class OperationStats:
+    latencies: List[float] = field(default_factory=list)
+    errors: int = 0
+    failures: int = 0
+
+    def merge(self, other: "OperationStats"):
+        self.latencies.extend(other.latencies)
+        self.errors += other.errors
+        self.failures += other.failures
+
+
+def run_client(
+    client: Client,
+    mix: List[Tuple[str, float]],
+    interval: float,
+    first_at: float,
+    measure_from: float,
+    end_at: float,
+    stats: Dict[str, OperationStats],
+):
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    scheduled = first_at
+    try:
+        while True:
+            if interval:
+                # Open loop: latencies are measured from the scheduled time, so that
+                # the time spent queued behind slow calls is accounted for.
+                delay = scheduled - perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                start = scheduled
+                scheduled += interval
+            else:
+                start = perf_counter()
+            if start >= end_at:
+                break
+            name = client.random.choices(names, weights)[0]
+            operation_stats = stats[name]
+            failed = False
+            error = False
+            try:
+                failed = OPERATIONS[name](client)
+            except grpc.RpcError:
+                error = True
+                client.reset()
+            now = perf_counter()
+            if start < measure_from:
+                continue
+            if error:
+                operation_stats.errors += 1
+            else:
+                operation_stats.latencies.append(now - start)
+                if failed:
+                    operation_stats.failures += 1
+    finally:
+        client.close()
+
+
+def discover(channel: grpc.Channel) -> List[str]:
+    """The services served by the user function, as the proxy would discover."""
+    spec = EntityDiscoveryStub(channel).discover(
+        ProxyInfo(
+            protocol_major_version=0,
+            protocol_minor_version=1,
+            proxy_name="cloudstate-bench",
+            proxy_version="0",
+        )
+    )
+    return [entity.service_name for entity in spec.entities]
+
+
+def run_load(
+    target: str,
+    mix: List[Tuple[str, float]],
+    concurrency: int,
+    rate: float,
+    duration: float,
+    warmup: float,
+    connections: int = 1,
+    timeout: float = 10.0,
+) -> Dict[str, object]:
+    channels = [grpc.insecure_channel(target) for _ in range(max(1, connections))]
+    run_id = f"{int(time.time())}"
+    stats: List[Dict[str, OperationStats]] = []
+    clients = []
+    threads = []
+    interval = concurrency / rate if rate else 0.0
+    started = perf_counter()
+    measure_from = started + warmup
+    end_at = measure_from + duration
+    for index in range(concurrency):
+        client_stats = {name: OperationStats() for name, _ in mix}
+        stats.append(client_stats)
+        client = Client(
+            channels[index % len(channels)],
+            f"bench-{run_id}-{index}",
+            seed=index,
+            timeout=timeout,
+        )
+        clients.append(client)
+        thread = threading.Thread(
+            target=run_client,
+            args=(
+                client,
+                mix,
+                interval,
+                started + index * interval / concurrency,
+                measure_from,
+                end_at,
+                client_stats,
+            ),
+            name=f"cloudstate-bench-{index}",
+            daemon=True,
+        )
+        threads.append(thread)
+        thread.start()
+    for thread in threads:
+        thread.join(max(0.0, end_at + timeout - perf_counter()))
+    # Streamed calls cannot time out by themselves, such as when the streams of the
+    # clients outnumber the threads of the user function.
+    for client, thread in zip(clients, threads):
+        if thread.is_alive():
+            client.cancel()
+    for thread in threads:
+        thread.join()
+    for channel in channels:
+        channel.close()
+
+    merged = {name: OperationStats() for name, _ in mix}
+    for client_stats in stats:
+        for name, operation_stats in client_stats.items():
+            merged[name].merge(operation_stats)
+    return summarize(merged, duration)
+
+
+def summarize(stats: Dict[str, OperationStats], seconds: float) -> Dict[str, object]:
+    operations = {}
+    total = OperationStats()
+    for name, operation_stats in stats.items():
+        total.merge(operation_stats)
+        operations[name] = _summary(operation_stats, seconds)
+    return {
+        "seconds": seconds,
+        "operations": operations,
+        "total": _summary(total, seconds),
+    }
+
+
+def _summary(stats: OperationStats, seconds: float) -> Dict[str, float]:
+    summary = {
+        "count": len(stats.latencies),
+        "throughput": len(stats.latencies) / seconds if seconds else 0.0,
+        "errors": stats.errors,
+        "failures": stats.failures,
+    }
+    summary.update(latency_summary(stats.latencies))
+    return summary
+
+
+ROW = "{:<18} {:>9} {:>10} {:>7} {:>8} {:>9} {:>9} {:>9} {:>9}"
+
+
+def report(results: Dict[str, object]) -> str:
+    lines = [
+        ROW.format(
+            "operation",
+            "count",
+            "ops/s",
+            "errors",
+            "failed",
+            "p50 ms",
+            "p99 ms",
+            "p999 ms",
+            "max ms",
+        )
+    ]
+    rows = list(results["operations"].items()) + [("total", results["total"])]
+    for name, summary in rows:
+        lines.append(
+            ROW.format(
+                name,
+                summary["count"],
+                f"{summary['throughput']:,.1f}",
+                summary["errors"],
+                summary["failures"],
+                *(
+                    f"{summary[percentile] / 1000:.2f}"
+                    for percentile in ("p50_us", "p99_us", "p999_us", "max_us")
+                ),
+            )
+        )
+    return "\n".join(lines)
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m cloudstate.bench",
+        description="Drive a user function serving the shopping cart and action demo "
+        "entities over gRPC, playing the role of the proxy.",
+    )
+    parser.add_argument("--target", default="localhost:8080", help="host:port")
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=16,
+        help="simulated clients, each with its own entity and streams",
+    )
+    parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        default=0.0,
+        help="target rate in commands per second over all clients, or 0 for a "
+        "closed loop where each client sends as soon as it has a reply",
+    )
+    parser.add_argument("-d", "--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument(
+        "-w", "--warmup", type=float, default=2.0, help="seconds not measured"
+    )
+    parser.add_argument(
+        "--connections", type=int, default=1, help="gRPC channels shared by clients"
+    )
+    parser.add_argument(
+        "-m",
+        "--mix",
+        default=DEFAULT_MIX,
+        help=f"weighted operations, among {', '.join(OPERATIONS)} "
+        f"(default {DEFAULT_MIX})",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=10.0,
+        help="seconds after which calls still waiting are failed as errors",
+    )
+    parser.add_argument("-o", "--output", help="write the results to a JSON file")
+    options = parser.parse_args(args)
+    try:
+        mix = parse_mix(options.mix)
+    except ValueError as error:
+        parser.error(str(error))
+
+    with grpc.insecure_channel(options.target) as channel:
+        services = discover(channel)
+    required = {
+        CART_SERVICE if name.startswith("cart.") else ACTION_SERVICE for name, _ in mix
+    }
+    missing = required - set(services)
+    if missing:
+        print(f"{options.target} does not serve {', '.join(sorted(missing))}")
+        return 2
+
+    mode = f"{options.rate:g} commands/s" if options.rate else "closed loop"
+    print(
+        f"Driving {options.target} with {options.concurrency} clients, {mode}, "
+        f"for {options.duration:g}s after {options.warmup:g}s of warmup"
+    )
+    results = run_load(
+        options.target,
+        mix,
+        options.concurrency,
+        options.rate,
+        options.duration,
+        options.warmup,
+        options.connections,
+        options.timeout,
+    )
+    print(report(results))
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(results, output, indent=2)
+    return 1 if results["total"]["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
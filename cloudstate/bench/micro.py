@@ -0,0 +1,430 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+
+Microbenchmarks of the servicers, driven in-process with synthetic requests for the
+shopping cart and action demo entities, without a proxy or a network.
+
+    python -m cloudstate.bench.micro --output before.json
+    python -m cloudstate.bench.micro --compare before.json
+"""
+
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from google.protobuf.any_pb2 import Any as AnyMessage
+
+from cloudstate.action_pb2 import ActionCommand
+from cloudstate.action_servicer import CloudStateActionProtocolServicer
+from cloudstate.bench.stats import latency_summary
+from cloudstate.entity_pb2 import Command
+from cloudstate.event_sourced_pb2 import (
+    EventSourcedEvent,
+    EventSourcedInit,
+    EventSourcedStreamIn,
+)
+from cloudstate.eventsourced_servicer import CloudStateEventSourcedServicer
+from cloudstate.test.actiondemo.action_definition import definition
+from cloudstate.test.actiondemo.actiondemo_pb2 import AddToSum, FunctionRequest
+from cloudstate.test.shoppingcart.persistence.domain_pb2 import ItemAdded, LineItem
+from cloudstate.test.shoppingcart.shopping_cart_entity import entity
+from cloudstate.test.shoppingcart.shoppingcart_pb2 import (
+    AddLineItem,
+    GetShoppingCart,
+)
+from cloudstate.version import __version__
+
+# The number of distinct products added to the carts, which bounds their size.
+PRODUCTS = 10
+
+
+class RequestIterator:
+    """Stands in for the request iterator of a streamed call."""
+
+    def __init__(self, requests: Iterable):
+        self._requests = iter(requests)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._requests)
+
+    def next(self):
+        return next(self._requests)
+
+
+def packed(message) -> AnyMessage:
+    payload = AnyMessage()
+    payload.Pack(message)
+    return payload
+
+
+# A benchmark is set up with a size, and returns the steps to run, each of which is
+# timed by a call to next(), along with the number of operations they perform.
+Setup = Callable[[int], Tuple[Iterator, int]]
+
+
+@dataclass
+class Benchmark:
+    name: str
+    unit: str
+    setup: Setup
+    description: str
+
+
+def eventsourced_commands(size: int) -> Tuple[Iterator, int]:
+    servicer = CloudStateEventSourcedServicer([entity])
+    requests = [
+        EventSourcedStreamIn(
+            init=EventSourcedInit(service_name=entity.name(), entity_id="cart")
+        )
+    ]
+    for number in range(size):
+        product = f"product-{number % PRODUCTS}"
+        requests.append(
+            EventSourcedStreamIn(
+                command=Command(
+                    entity_id="cart",
+                    id=number,
+                    name="AddItem",
+                    payload=packed(
+                        AddLineItem(
+                            user_id="cart", product_id=product, name=product, quantity=1
+                        )
+                    ),
+                )
+            )
+        )
+    return servicer.handle(RequestIterator(requests), None), size
+
+
+def eventsourced_replay(size: int) -> Tuple[Iterator, int]:
+    servicer = CloudStateEventSourcedServicer([entity])
+    requests = [
+        EventSourcedStreamIn(
+            init=EventSourcedInit(service_name=entity.name(), entity_id="cart")
+        )
+    ]
+    for number in range(size):
+        product = f"product-{number % PRODUCTS}"
+        requests.append(
+            EventSourcedStreamIn(
+                event=EventSourcedEvent(
+                    sequence=number + 1,
+                    payload=packed(
+                        ItemAdded(
+                            item=LineItem(productId=product, name=product, quantity=1)
+                        )
+                    ),
+                )
+            )
+        )
+    requests.append(
+        EventSourcedStreamIn(
+            command=Command(
+                entity_id="cart",
+                id=0,
+                name="GetCart",
+                payload=packed(GetShoppingCart(user_id="cart")),
+            )
+        )
+    )
+    # A single step, recovering the entity then replying to the command.
+    return servicer.handle(RequestIterator(requests), None), size
+
+
+def action_unary(size: int) -> Tuple[Iterator, int]:
+    servicer = CloudStateActionProtocolServicer([definition])
+    requests = [
+        ActionCommand(
+            service_name=definition.name(),
+            name="ReverseString",
+            payload=packed(FunctionRequest(foo=f"request {number}")),
+        )
+        for number in range(size)
+    ]
+
+    def calls():
+        for request in requests:
+            yield servicer.handleUnary(request, None)
+
+    return calls(), size
+
+
+def action_streamed(size: int) -> Tuple[Iterator, int]:
+    servicer = CloudStateActionProtocolServicer([definition])
+    requests = [ActionCommand(service_name=definition.name(), name="ReverseStrings")]
+    requests.extend(
+        ActionCommand(payload=packed(FunctionRequest(foo=f"request {number}")))
+        for number in range(size)
+    )
+    return servicer.handleStreamed(RequestIterator(requests), None), size
+
+
+def action_streamed_in(size: int) -> Tuple[Iterator, int]:
+    servicer = CloudStateActionProtocolServicer([definition])
+    requests = [ActionCommand(service_name=definition.name(), name="SumStream")]
+    requests.extend(
+        ActionCommand(payload=packed(AddToSum(quantity=1))) for number in range(size)
+    )
+
+    def call():
+        yield servicer.handleStreamedIn(RequestIterator(requests), None)
+
+    return call(), size
+
+
+BENCHMARKS = [
+    Benchmark(
+        "eventsourced_commands",
+        "commands",
+        eventsourced_commands,
+        "AddItem commands on a single shopping cart stream, each emitting an event",
+    ),
+    Benchmark(
+        "eventsourced_replay",
+        "events",
+        eventsourced_replay,
+        "Recovery of a shopping cart from its journal, per step",
+    ),
+    Benchmark(
+        "action_unary",
+        "commands",
+        action_unary,
+        "Unary ReverseString calls",
+    ),
+    Benchmark(
+        "action_streamed",
+        "commands",
+        action_streamed,
+        "Elements of a single ReverseStrings stream",
+    ),
+    Benchmark(
+        "action_streamed_in",
+        "commands",
+        action_streamed_in,
+        "Elements summed by a single SumStream call, per step",
+    ),
+]
+
+
+@dataclass
+class Result:
+    name: str
+    unit: str
+    operations: int = 0
+    seconds: float = 0.0
+    latencies: List[float] = field(default_factory=list)
+    # The mean of the memory allocated at the peak of a step, above what was
+    # allocated when it started, a proxy for the allocations of a call.
+    peak_alloc_bytes: Optional[float] = None
+    # The memory still allocated after the last step, per operation.
+    retained_bytes: Optional[float] = None
+
+    def summary(self) -> Dict[str, Any]:
+        summary = {
+            "unit": self.unit,
+            "operations": self.operations,
+            "seconds": self.seconds,
+            "throughput": self.operations / self.seconds if self.seconds else 0.0,
+            "steps": len(self.latencies),
+        }
+        summary.update(latency_summary(self.latencies))
+        summary["peak_alloc_bytes"] = self.peak_alloc_bytes
+        summary["retained_bytes"] = self.retained_bytes
+        return summary
+
+
+def run(benchmark: Benchmark, size: int, repeat: int, warmup: int = 1) -> Result:
+    result = Result(benchmark.name, benchmark.unit)
+    for _ in range(warmup):
+        steps, _ = benchmark.setup(min(size, 100))
+        for _ in steps:
+            pass
+    for _ in range(repeat):
+        steps, operations = benchmark.setup(size)
+        gc.collect()
+        start = previous = perf_counter()
+        for _ in steps:
+            now = perf_counter()
+            result.latencies.append(now - previous)
+            previous = now
+        result.seconds += previous - start
+        result.operations += operations
+    measure_allocations(benchmark, size, result)
+    return result
+
+
+def measure_allocations(benchmark: Benchmark, size: int, result: Result):
+    if not hasattr(tracemalloc, "reset_peak"):  # Python < 3.9
+        return
+    steps, operations = benchmark.setup(size)
+    steps = iter(steps)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        started, _ = tracemalloc.get_traced_memory()
+        peaks = 0
+        count = 0
+        while True:
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            try:
+                next(steps)
+            except StopIteration:
+                break
+            peaks += tracemalloc.get_traced_memory()[1] - current
+            count += 1
+        del steps
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - started
+    finally:
+        tracemalloc.stop()
+    result.peak_alloc_bytes = peaks / count if count else 0.0
+    result.retained_bytes = retained / operations if operations else 0.0
+
+
+def run_all(
+    size: int, repeat: int, names: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    results = {}
+    for benchmark in BENCHMARKS:
+        if names and benchmark.name not in names:
+            continue
+        results[benchmark.name] = run(benchmark, size, repeat).summary()
+    return {
+        "version": __version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "timestamp": time.time(),
+        "size": size,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def report(run_results: Dict[str, Any]) -> str:
+    lines = [
+        f"cloudstate {run_results['version']} on "
+        f"{run_results['implementation']} {run_results['python']}",
+        "{:<24} {:>14} {:>10} {:>10} {:>10} {:>10} {:>12}".format(
+            "benchmark", "ops/s", "p50 us", "p99 us", "p999 us", "max us", "alloc B"
+        ),
+    ]
+    for name, summary in run_results["results"].items():
+        alloc = summary["peak_alloc_bytes"]
+        lines.append(
+            "{:<24} {:>14,.0f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>12}".format(
+                name,
+                summary["throughput"],
+                summary["p50_us"],
+                summary["p99_us"],
+                summary["p999_us"],
+                summary["max_us"],
+                "-" if alloc is None else f"{alloc:,.0f}",
+            )
+        )
+    return "\n".join(lines)
+
+
+# Metrics compared between runs, and whether higher values are better.
+COMPARED = {
+    "throughput": True,
+    "p50_us": False,
+    "p99_us": False,
+    "peak_alloc_bytes": False,
+}
+
+
+def compare(
+    baseline: Dict[str, Any], current: Dict[str, Any], threshold: float
+) -> Tuple[str, List[str]]:
+    """A report of the changes from the baseline run to the current one, along with
+    the regressions worse than the threshold, a fraction of the baseline value."""
+    lines = [
+        f"cloudstate {baseline['version']} -> {current['version']}",
+        "{:<24} {:<18} {:>14} {:>14} {:>9}".format(
+            "benchmark", "metric", "baseline", "current", "change"
+        ),
+    ]
+    regressions = []
+    for name, summary in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        for metric, higher_is_better in COMPARED.items():
+            old, new = before.get(metric), summary.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > threshold:
+                flag = " !"
+                regressions.append(f"{name} {metric} {change:+.1%}")
+            lines.append(
+                "{:<24} {:<18} {:>14,.1f} {:>14,.1f} {:>+8.1%}{}".format(
+                    name, metric, old, new, change, flag
+                )
+            )
+    return "\n".join(lines), regressions
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m cloudstate.bench.micro",
+        description="Benchmark the servicers in-process.",
+    )
+    parser.add_argument(
+        "-n", "--size", type=int, default=10000, help="operations per repetition"
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        action="append",
+        choices=[benchmark.name for benchmark in BENCHMARKS],
+        help="run only the given benchmarks",
+    )
+    parser.add_argument("-o", "--output", help="write the results to a JSON file")
+    parser.add_argument(
+        "-c", "--compare", help="compare with the results of a previous run"
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="change of a compared metric counted as a regression (default 0.1)",
+    )
+    options = parser.parse_args(args)
+
+    results = run_all(options.size, options.repeat, options.benchmark)
+    print(report(results))
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if options.compare:
+        with open(options.compare) as baseline:
+            comparison, regressions = compare(
+                json.load(baseline), results, options.threshold
+            )
+        print()
+        print(comparison)
+        if regressions:
+            print("\nRegressions: " + ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
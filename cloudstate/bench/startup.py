@@ -0,0 +1,122 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+
+Startup benchmark of a user function serving the shopping cart and action demo
+entities: the time importing cloudstate.cloudstate takes, the modules it loads and
+the time start() takes until the port accepts traffic, each measured in a fresh
+interpreter.
+
+    python -m cloudstate.bench.startup
+    python -m cloudstate.bench.startup --budget-ms 100
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List
+
+from cloudstate.version import __version__
+
+# Run in a fresh interpreter, printing its measurements as JSON.
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+from cloudstate.cloudstate import CloudState
+imported = time.perf_counter()
+loaded = sorted(sys.modules)
+from cloudstate.test.actiondemo.action_definition import definition
+from cloudstate.test.shoppingcart.shopping_cart_entity import entity
+defined = time.perf_counter()
+server = (
+    CloudState()
+    .host("127.0.0.1")
+    .port("0")
+    .register_event_sourced_entity(entity)
+    .register_action_entity(definition)
+    .start()
+)
+started = time.perf_counter()
+server.stop(None)
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "start_ms": (started - defined) * 1000,
+    "modules": len(loaded),
+    "grpc_imported": "grpc" in loaded,
+}))
+"""
+
+
+def probe() -> Dict[str, Any]:
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def run_startup(repeat: int) -> Dict[str, Any]:
+    """The median of the measurements of the given number of fresh interpreters."""
+    probes: List[Dict[str, Any]] = [probe() for _ in range(repeat)]
+    return {
+        "version": __version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "repeat": repeat,
+        "import_ms": statistics.median(p["import_ms"] for p in probes),
+        "start_ms": statistics.median(p["start_ms"] for p in probes),
+        "modules": probes[-1]["modules"],
+        "grpc_imported": probes[-1]["grpc_imported"],
+    }
+
+
+def report(results: Dict[str, Any]) -> str:
+    return "\n".join(
+        [
+            f"cloudstate {results['version']} on "
+            f"{results['implementation']} {results['python']}, median of "
+            f"{results['repeat']}",
+            f"import cloudstate.cloudstate {results['import_ms']:>10.1f} ms, "
+            f"{results['modules']} modules loaded, grpc "
+            + ("imported" if results["grpc_imported"] else "not imported"),
+            f"start()                      {results['start_ms']:>10.1f} ms",
+        ]
+    )
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m cloudstate.bench.startup",
+        description="Benchmark the startup of a user function.",
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument(
+        "-b",
+        "--budget-ms",
+        type=float,
+        help="fail when importing cloudstate.cloudstate takes longer",
+    )
+    parser.add_argument("-o", "--output", help="write the results to a JSON file")
+    options = parser.parse_args(args)
+
+    results = run_startup(options.repeat)
+    print(report(results))
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if options.budget_ms is not None and results["import_ms"] > options.budget_ms:
+        print(
+            f"import took {results['import_ms']:.1f} ms, over the budget of "
+            f"{options.budget_ms:.1f} ms"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
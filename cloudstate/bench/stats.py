@@ -0,0 +1,29 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import math
+from typing import Dict, Sequence
+
+PERCENTILES = {"p50": 0.5, "p90": 0.9, "p99": 0.99, "p999": 0.999}
+
+
+def percentile(sorted_samples: Sequence[float], fraction: float) -> float:
+    """The nearest-rank percentile of already sorted samples."""
+    if not sorted_samples:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sorted_samples)))
+    return sorted_samples[rank - 1]
+
+
+def latency_summary(latencies: Sequence[float]) -> Dict[str, float]:
+    """The mean, percentiles and maximum of latencies in seconds, in microseconds."""
+    samples = sorted(latencies)
+    summary = {
+        "mean_us": (sum(samples) / len(samples) if samples else 0.0) * 1e6,
+    }
+    for name, fraction in PERCENTILES.items():
+        summary[name + "_us"] = percentile(samples, fraction) * 1e6
+    summary["max_us"] = (samples[-1] if samples else 0.0) * 1e6
+    return summary
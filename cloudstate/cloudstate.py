@@ -2,41 +2,48 @@
 Copyright 2020 Lightbend Inc.
 Licensed under the Apache License, Version 2.0.
 """
+
 import logging
-import multiprocessing
 import os
-from concurrent import futures
 from dataclasses import dataclass, field
-from typing import List, Optional
-
-import grpc
+from importlib import import_module
+from typing import TYPE_CHECKING, Dict, List, Optional
 
-from cloudstate.action_pb2_grpc import add_ActionProtocolServicer_to_server
-from cloudstate.action_protocol_entity import Action
-from cloudstate.action_servicer import CloudStateActionProtocolServicer
-from cloudstate.discovery_servicer import CloudStateEntityDiscoveryServicer
-from cloudstate.entity_pb2_grpc import add_EntityDiscoveryServicer_to_server
-from cloudstate.event_sourced_entity import EventSourcedEntity
-from cloudstate.event_sourced_pb2_grpc import add_EventSourcedServicer_to_server
-from cloudstate.eventsourced_servicer import CloudStateEventSourcedServicer
+# grpc, the servicers and the generated modules of the protocols are imported when
+# the user function starts, and only for the protocols of the registered entities,
+# for importing this module to stay cheap.
+if TYPE_CHECKING:
+    from cloudstate import tracing
+    from cloudstate.action_protocol_entity import Action
+    from cloudstate.event_sourced_entity import EventSourcedEntity
+    from cloudstate.protocol_executor import ProtocolExecutor
+    from cloudstate.state_cache import StateCache
 
 # from grpc_reflection.v1alpha import reflection
 
 
+def configure_logging():
+    """Log at DEBUG level, unless the application configured logging itself."""
+    if not logging.root.handlers:
+        logging.basicConfig(
+            format="%(asctime)s - %(filename)s - %(levelname)s: %(message)s",
+            level=logging.DEBUG,
+        )
+
+
 @dataclass
 class CloudState:
-    logging.basicConfig(
-        format="%(asctime)s - %(filename)s - %(levelname)s: %(message)s",
-        level=logging.DEBUG,
-    )
-    logging.root.setLevel(logging.DEBUG)
-
     __address: str = ""
     __host = "127.0.0.1"
     __port = "8080"
-    __workers = multiprocessing.cpu_count()
-    __event_sourced_entities: List[EventSourcedEntity] = field(default_factory=list)
-    __action_protocol_entities: List[Action] = field(default_factory=list)
+    __workers = os.cpu_count()
+    __processes = 1
+    __protocol_workers: Dict[str, int] = field(default_factory=dict)
+    __starvation_ms = 1000.0
+    __metrics_port: Optional[int] = None
+    __state_cache: Optional["StateCache"] = None
+    __event_sourced_entities: List["EventSourcedEntity"] = field(default_factory=list)
+    __action_protocol_entities: List["Action"] = field(default_factory=list)
 
     def host(self, address: str):
         """Set the address of the network Host.
@@ -52,52 +59,276 @@ class CloudState:
         self.__port = port
         return self
 
-    def max_workers(self, workers: Optional[int] = multiprocessing.cpu_count()):
+    def max_workers(self, workers: Optional[int] = os.cpu_count()):
         """Set the gRPC Server number of Workers.
         Default is equal to the number of CPU Cores in the machine.
         """
         self.__workers = workers
         return self
 
-    def register_event_sourced_entity(self, entity: EventSourcedEntity):
+    def protocol_workers(
+        self,
+        event_sourced: int = 0,
+        action_unary: int = 0,
+        action_streamed: int = 0,
+        discovery: int = 0,
+    ):
+        """Set the number of Workers of the gRPC Server dedicated to the calls of
+        each protocol: event sourced entity streams, unary action calls, streamed
+        action calls and discovery, so that long lived streams cannot take the
+        Workers every other call waits for.
+        Default is for all of them to share the max_workers Workers. The asyncio
+        server of start_async() has no Workers to share.
+        """
+        self.__protocol_workers = {
+            "event_sourced": event_sourced,
+            "action_unary": action_unary,
+            "action_streamed": action_streamed,
+            "discovery": discovery,
+        }
+        return self
+
+    def starvation_ms(self, ms: float):
+        """Set how long a call may wait for a Worker of the gRPC Server before
+        being counted as starved, and a warning logged.
+        Default is 1000 milliseconds.
+        """
+        self.__starvation_ms = ms
+        return self
+
+    def processes(self, processes: int):
+        """Set the number of worker processes serving the user function.
+        Default is 1. With more, start() forks the worker processes, which each bind
+        the port with SO_REUSEPORT and run their own gRPC Server, and supervises
+        them. Registered entities and imported modules are inherited by the workers.
+        The handler worker processes set with handler_processes() are shared between
+        them: each forks its own, as many as the number set divided by processes.
+        """
+        self.__processes = processes
+        return self
+
+    def metrics_port(self, port: int):
+        """Serve the metrics of the user function in the Prometheus text format on
+        the given HTTP port, which may also be set with the METRICS_PORT environment
+        variable. Worker processes each serve their own metrics, worker n on the
+        given port plus n.
+        Default is not to serve them.
+        """
+        self.__metrics_port = port
+        return self
+
+    def tracer(self, tracer: "tracing.Tracer"):
+        """Set the tracer opening a span around every command handled, such as a
+        tracing.OpenTelemetryTracer.
+        Default is not to trace commands.
+        """
+        from cloudstate import tracing
+
+        tracing.set_tracer(tracer)
+        return self
+
+    def state_cache(self, max_entries: int = 10000, max_bytes: Optional[int] = None):
+        """Keep the state of event sourced entities once their stream ends, up to
+        the given number of entities and approximate size in bytes, so that when
+        the proxy opens a new stream for one of them, the events it already applied
+        are not replayed again.
+        Default is not to keep them.
+        """
+        from cloudstate.metrics import METRICS
+        from cloudstate.state_cache import StateCache
+
+        self.__state_cache = StateCache(max_entries, max_bytes)
+        METRICS.monitor_state_cache(self.__state_cache)
+        return self
+
+    def handler_processes(self, workers: Optional[int] = None, max_queue: int = 0):
+        """Set the number of worker processes running the action handlers registered
+        with executor="process", and of commands submitted to them at once, beyond
+        which commands fail right away.
+        Default is as many processes as CPU Cores, and eight commands per process.
+        Both are shared between the worker processes set with processes().
+        """
+        from cloudstate.process_pool import PROCESS_POOL
+
+        PROCESS_POOL.configure(workers, max_queue)
+        return self
+
+    def register_event_sourced_entity(self, entity: "EventSourcedEntity"):
         """Registry the user EventSourced entity."""
         self.__event_sourced_entities.append(entity)
         return self
 
-    def register_action_entity(self, entity: Action):
+    def register_action_entity(self, entity: "Action"):
         """Registry the user Stateless Function entity."""
         self.__action_protocol_entities.append(entity)
         return self
 
     def start(self):
         """Start the user function and gRPC Server."""
+        configure_logging()
+        self.__warm_up(allow_async=False)
 
-        self.__address = "{}:{}".format(
-            os.environ.get("HOST", self.__host), os.environ.get("PORT", self.__port)
-        )
+        if self.__processes > 1:
+            from cloudstate.supervisor import WorkerSupervisor
 
-        server = grpc.server(futures.ThreadPoolExecutor(max_workers=self.__workers))
+            logging.info("Starting %s Cloudstate worker processes", self.__processes)
+            if self.__has_process_handlers():
+                from cloudstate.process_pool import PROCESS_POOL
 
-        # event sourced
-        add_EntityDiscoveryServicer_to_server(
-            CloudStateEntityDiscoveryServicer(
-                self.__event_sourced_entities, self.__action_protocol_entities
-            ),
-            server,
-        )
-        add_EventSourcedServicer_to_server(
-            CloudStateEventSourcedServicer(self.__event_sourced_entities), server
-        )
-        add_ActionProtocolServicer_to_server(
-            CloudStateActionProtocolServicer(self.__action_protocol_entities),
-            server,
+                PROCESS_POOL.divide(self.__processes)
+            return WorkerSupervisor(self.__serve, self.__processes).start()
+        return self.__serve()
+
+    def __serve(self, worker: int = 0):
+        self.__start_handler_processes()
+
+        import grpc
+
+        from cloudstate.protocol_executor import MonitoredPool, ProtocolExecutor
+
+        executor = ProtocolExecutor(
+            MonitoredPool("grpc", self.__workers, self.__starvation_ms / 1000)
         )
+        server = grpc.server(executor, options=[("grpc.so_reuseport", 1)])
+        self.__add_servicers(server, "cloudstate", executor)
 
         logging.info("Starting Cloudstate on address %s", self.__address)
         try:
             server.add_insecure_port(self.__address)
             server.start()
+            self.__serve_metrics(worker)
+        except IOError as e:
+            logging.error("Error on start Cloudstate %s", e.__cause__)
+
+        return server
+
+    async def start_async(self):
+        """Start the user function and an asyncio gRPC Server on the running event
+        loop. Entity streams are served as tasks rather than pinning a worker thread,
+        and handlers may be coroutines or asynchronous generators.
+        Await wait_for_termination() on the returned server to keep serving.
+        """
+        if self.__processes > 1:
+            raise Exception("Worker processes are only supported by start()")
+        configure_logging()
+        self.__warm_up(allow_async=True)
+
+        from grpc import aio
+
+        self.__start_handler_processes()
+        server = aio.server()
+        self.__add_servicers(server, "cloudstate.aio")
+
+        logging.info("Starting Cloudstate asyncio server on address %s", self.__address)
+        try:
+            server.add_insecure_port(self.__address)
+            await server.start()
+            self.__serve_metrics()
         except IOError as e:
             logging.error("Error on start Cloudstate %s", e.__cause__)
 
         return server
+
+    def __warm_up(self, allow_async: bool):
+        """Prepare what serving the registered entities needs, before the port
+        accepts traffic rather than on the first commands."""
+        from cloudstate.metrics import METRICS
+
+        for entity in self.__event_sourced_entities + self.__action_protocol_entities:
+            for plan in entity.handler_plans():
+                if plan.is_async and not allow_async:
+                    raise Exception(
+                        f"Handler {plan.function} of {entity.name()} is asynchronous, "
+                        "start the user function with start_async() instead"
+                    )
+            METRICS.entity(entity.name())
+            for method in entity.service_descriptor.methods:
+                METRICS.command(entity.name(), method.name)
+        for entity in self.__event_sourced_entities:
+            for event_type in entity.event_handler_plans:
+                entity.event_handler_plan(event_type)
+
+    def __start_handler_processes(self):
+        """Fork the handler worker processes, if any handler runs in them, before
+        the gRPC server starts its threads."""
+        if self.__has_process_handlers():
+            from cloudstate.process_pool import PROCESS_POOL
+
+            PROCESS_POOL.start()
+
+    def __has_process_handlers(self) -> bool:
+        return any(
+            entity.process_handlers for entity in self.__action_protocol_entities
+        )
+
+    def __add_servicers(
+        self, server, package: str, executor: Optional["ProtocolExecutor"] = None
+    ):
+        """Add the servicers of the given package, cloudstate or cloudstate.aio, of
+        the protocols of the registered entities, and route their calls to their
+        Workers on the executor of the threaded server."""
+        from cloudstate.discovery_servicer import add_entity_discovery_to_server
+
+        self.__address = "{}:{}".format(
+            os.environ.get("HOST", self.__host), os.environ.get("PORT", self.__port)
+        )
+
+        discovery_servicer = import_module(f"{package}.discovery_servicer")
+        entity_discovery = discovery_servicer.CloudStateEntityDiscoveryServicer(
+            self.__event_sourced_entities, self.__action_protocol_entities
+        )
+        # Build the spec served to the proxy before serving, rather than on the
+        # first discovery.
+        entity_discovery.entity_spec()
+        add_entity_discovery_to_server(entity_discovery, server)
+        self.__route(executor, entity_discovery, "discovery")
+
+        # The proxy only uses the protocols of the entities discovered.
+        if self.__event_sourced_entities:
+            from cloudstate.event_sourced_pb2_grpc import (
+                add_EventSourcedServicer_to_server,
+            )
+
+            eventsourced_servicer = import_module(f"{package}.eventsourced_servicer")
+            eventsourced = eventsourced_servicer.CloudStateEventSourcedServicer(
+                self.__event_sourced_entities, self.__state_cache
+            )
+            add_EventSourcedServicer_to_server(eventsourced, server)
+            self.__route(executor, eventsourced, "event_sourced")
+        if self.__action_protocol_entities:
+            from cloudstate.action_pb2_grpc import add_ActionProtocolServicer_to_server
+
+            action_servicer = import_module(f"{package}.action_servicer")
+            action = action_servicer.CloudStateActionProtocolServicer(
+                self.__action_protocol_entities
+            )
+            add_ActionProtocolServicer_to_server(action, server)
+            self.__route(executor, action, "action_streamed")
+            self.__route(executor, action, "action_unary", "handleUnary")
+
+    def __route(
+        self,
+        executor: Optional["ProtocolExecutor"],
+        servicer,
+        protocol: str,
+        method: Optional[str] = None,
+    ):
+        workers = self.__protocol_workers.get(protocol)
+        if executor is None or not workers:
+            return
+        from cloudstate.protocol_executor import MonitoredPool
+
+        pool = executor.pools.get(protocol) or MonitoredPool(
+            protocol, workers, self.__starvation_ms / 1000
+        )
+        executor.route(servicer, pool, method)
+
+    def __serve_metrics(self, worker: int = 0):
+        port = os.environ.get("METRICS_PORT", self.__metrics_port)
+        if port is None:
+            return
+        from cloudstate.metrics import METRICS, MetricsServer
+
+        MetricsServer(
+            METRICS.registry, os.environ.get("HOST", self.__host), int(port) + worker
+        ).start()
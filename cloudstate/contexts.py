@@ -3,58 +3,181 @@ Copyright 2020 Lightbend Inc.
 Licensed under the Apache License, Version 2.0.
 """
 
-from typing import List
+from typing import List, Optional, Sequence
 
-from cloudstate.entity_pb2 import ClientAction, Failure, Forward, Reply, SideEffect
+from cloudstate.entity_pb2 import ClientAction, Forward, MetadataEntry, SideEffect
+from cloudstate.utils.payload_utils import pack_into
 
 
 class Context:
-    """Root class of all contexts."""
+    """Root class of all contexts. Contexts are created for every command or event
+    handled, so they declare their attributes in __slots__, which is what they are
+    compared and shown by."""
 
-    pass
+    __slots__ = ()
+
+    def _fields(self):
+        return [
+            (name, getattr(self, name))
+            for cls in reversed(type(self).__mro__)
+            for name in getattr(cls, "__slots__", ())
+        ]
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __repr__(self):
+        return "{}({})".format(
+            type(self).__name__,
+            ", ".join(f"{name}={value!r}" for name, value in self._fields()),
+        )
 
 
 class ClientActionContext(Context):
     """Context that provides client actions, which include failing and forwarding.
-    These contexts are typically made available in response to commands."""
+    These contexts are typically made available in response to commands.
+
+    The reply, forward or failure is written in place into reply_to, and side
+    effects are added to effects, which the servicers set to the message sent to
+    the proxy and its side effects field, for payloads to be packed only once.
+    Otherwise reply_to is a ClientAction created on first use, and the lists of
+    errors and effects are only allocated once they are used."""
+
+    __slots__ = (
+        "command_id",
+        "_errors",
+        "_effects",
+        "forward",
+        "trace_context",
+        "reply_to",
+    )
 
-    def __init__(self, command_id: int):
+    def __init__(self, command_id: int, reply_to=None, effects: Sequence = None):
         self.command_id: int = command_id
-        self.errors: List[str] = []
-        self.effects: List[SideEffect] = []
+        self._errors: Optional[List[str]] = None
+        self._effects: Optional[Sequence[SideEffect]] = effects
         self.forward: Forward = None
+        # The trace context of the command, set by the servicers when tracing is
+        # enabled and added to the metadata of the forwards and side effects created.
+        self.trace_context: List[MetadataEntry] = None
+        # A ClientAction, or an ActionResponse which has the same fields.
+        self.reply_to = reply_to
+
+    @property
+    def errors(self) -> List[str]:
+        if self._errors is None:
+            self._errors = []
+        return self._errors
+
+    @errors.setter
+    def errors(self, errors: List[str]):
+        self._errors = errors
+
+    @property
+    def effects(self) -> Sequence[SideEffect]:
+        if self._effects is None:
+            self._effects = []
+        return self._effects
+
+    @effects.setter
+    def effects(self, effects: Sequence[SideEffect]):
+        self._effects = effects
 
     def fail(self, error_message: str):
         """Fail the command with the given message"""
-        self.errors.append(error_message)
+        if self._errors is None:
+            self._errors = [error_message]
+        else:
+            self._errors.append(error_message)
 
     def has_errors(self):
-        return len(self.errors) > 0
+        return bool(self._errors)
 
-    def create_client_action(self, result, allow_reply):
-        client_action = ClientAction()
-        if self.has_errors():
-            failure = Failure()
-            failure.command_id = self.command_id
-            failure.description = str(self.errors)
-            client_action.failure.CopyFrom(failure)
+    def forward_to(self, service_name: str, command_name: str, payload):
+        """Forward the command to the given command of another service instead of
+        replying to it. The payload may be a message, a lazy payload received by
+        the handler, or a serialized payload: an Any or a (type URL, bytes) pair."""
+        forward = self.new_forward()
+        forward.service_name = service_name
+        forward.command_name = command_name
+        pack_into(forward.payload, payload)
+        if self.trace_context:
+            forward.metadata.entries.extend(self.trace_context)
 
-            return client_action
+    def new_forward(self) -> Forward:
+        """The forward of the command, cleared, for it to be set in place."""
+        if self.reply_to is None:
+            self.reply_to = ClientAction()
+        forward = self.reply_to.forward
+        if self.forward is not None:
+            forward.Clear()
+        self.forward = forward
+        return forward
+
+    def side_effect(
+        self, service_name: str, command_name: str, payload, synchronous: bool = False
+    ):
+        """Invoke the given command of another service as a side effect of this one.
+        The payload may be a message, a lazy payload received by the handler, or a
+        serialized payload: an Any or a (type URL, bytes) pair."""
+        effect = self.new_side_effect()
+        effect.service_name = service_name
+        effect.command_name = command_name
+        effect.synchronous = synchronous
+        pack_into(effect.payload, payload)
+        if self.trace_context:
+            effect.metadata.entries.extend(self.trace_context)
+
+    def new_side_effect(self) -> SideEffect:
+        """A side effect added to those of the command, for it to be set in place."""
+        effects = self._effects
+        if effects is None:
+            effects = self._effects = []
+        if effects.__class__ is list:
+            effect = SideEffect()
+            effects.append(effect)
+            return effect
+        return effects.add()
 
+    def write_client_action(self, result, allow_reply) -> bool:
+        """Write the failure, the reply of the given result or the forward into
+        reply_to, and drop the side effects of a failed command. False when there
+        is neither and allow_reply is set. The result may be serialized already, as
+        an Any or a (type URL, bytes or memoryview) pair, which is replied as is."""
+        if self.reply_to is None:
+            self.reply_to = ClientAction()
+        reply_to = self.reply_to
+        if self._errors:
+            failure = reply_to.failure
+            failure.command_id = self.command_id
+            failure.description = str(self._errors)
+            if self._effects:
+                del self._effects[:]
+            return True
         elif result:
-            if self.forward:
+            if self.forward is not None:
                 raise Exception(
                     "Both a reply was returned, and a forward message was sent, "
                     "choose one or the other."
                 )
-            else:
-                reply = Reply()
-                reply.payload.Pack(result)
-                client_action.reply.CopyFrom(reply)
-        elif self.forward:
-            client_action.forward.CopyFrom(self.forward)
+            pack_into(reply_to.reply.payload, result)
+            return True
+        elif self.forward is not None:
+            # A forward assigned by the handler rather than set in place.
+            if self.forward is not reply_to.forward:
+                reply_to.forward.CopyFrom(self.forward)
+                self.forward = reply_to.forward
+            return True
         elif allow_reply:
-            return None
+            return False
         else:
             raise Exception("No reply or forward returned by command handler!")
-        return client_action
+
+    def create_client_action(self, result, allow_reply) -> Optional[ClientAction]:
+        client_action = ClientAction()
+        if self.write_client_action(result, allow_reply):
+            client_action.CopyFrom(self.reply_to)
+            return client_action
+        return None
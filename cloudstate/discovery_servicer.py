@@ -4,13 +4,13 @@ Licensed under the Apache License, Version 2.0.
 """
 
 import platform
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from logging import getLogger
-from pprint import pprint
-from typing import List
+from typing import Iterable, List, Optional, Tuple
 
+import grpc
+from google.protobuf.descriptor import FileDescriptor
 from google.protobuf.descriptor_pb2 import FileDescriptorProto, FileDescriptorSet
-from google.protobuf.descriptor_pool import Default
 from google.protobuf.empty_pb2 import Empty
 
 from cloudstate import entity_pb2
@@ -25,61 +25,67 @@ logger = getLogger()
 class CloudStateEntityDiscoveryServicer(EntityDiscoveryServicer):
     event_sourced_entities: List[EventSourcedEntity]
     action_protocol_entities: List[Action]
+    _spec: Optional[entity_pb2.EntitySpec] = field(default=None, init=False)
+    _serialized_spec: bytes = field(default=b"", init=False)
+    _spec_entities: Optional[Tuple] = field(default=None, init=False)
 
     def discover(self, request, context):
-        logger.info("discovering.")
-        pprint(request)
-        descriptor_set = FileDescriptorSet()
-        for entity in self.event_sourced_entities + self.action_protocol_entities:
-            logger.info(f"entity: {entity.name()}")
-            for descriptor in entity.file_descriptors:
-                logger.info(f"discovering {descriptor.name}")
-                logger.info(f"SD: {entity.service_descriptor.full_name}")
-                from_string = FileDescriptorProto.FromString(descriptor.serialized_pb)
-                descriptor_set.file.append(from_string)
-
-        descriptor_set.file.append(
-            FileDescriptorProto.FromString(
-                Default().FindFileByName("google/protobuf/empty.proto").serialized_pb
-            )
-        )
-        descriptor_set.file.append(
-            FileDescriptorProto.FromString(
-                Default().FindFileByName("cloudstate/entity_key.proto").serialized_pb
-            )
-        )
-        descriptor_set.file.append(
-            FileDescriptorProto.FromString(
-                Default().FindFileByName("cloudstate/eventing.proto").serialized_pb
-            )
-        )
-        descriptor_set.file.append(
-            FileDescriptorProto.FromString(
-                Default()
-                .FindFileByName("google/protobuf/descriptor.proto")
-                .serialized_pb
-            )
-        )
-        descriptor_set.file.append(
-            FileDescriptorProto.FromString(
-                Default().FindFileByName("google/api/annotations.proto").serialized_pb
-            )
-        )
-        descriptor_set.file.append(
-            FileDescriptorProto.FromString(
-                Default().FindFileByName("google/api/http.proto").serialized_pb
-            )
+        self.log_discovery(request)
+        return self.entity_spec()
+
+    def discover_serialized(self, request, context) -> bytes:
+        """Discover, replying with the spec serialized once, for the server to send
+        as it is."""
+        self.log_discovery(request)
+        return self.serialized_entity_spec()
+
+    def log_discovery(self, request):
+        logger.info(
+            f"discovering by {request.proxy_name} {request.proxy_version}, protocol "
+            f"{request.protocol_major_version}.{request.protocol_minor_version}."
         )
-        descriptor_set.file.append(
-            FileDescriptorProto.FromString(
-                Default().FindFileByName("google/api/httpbody.proto").serialized_pb
-            )
+
+    def entity_spec(self) -> entity_pb2.EntitySpec:
+        """The spec of the registered entities, built on first use and served
+        again as it is, unless the entities changed since."""
+        self.cache_entity_spec()
+        return self._spec
+
+    def serialized_entity_spec(self) -> bytes:
+        self.cache_entity_spec()
+        return self._serialized_spec
+
+    def cache_entity_spec(self):
+        # The entities the spec was built for, themselves rather than their count,
+        # as they could be replaced in the lists.
+        entities = (
+            *self.event_sourced_entities,
+            None,
+            *self.action_protocol_entities,
         )
-        descriptor_set.file.append(
-            FileDescriptorProto.FromString(
-                Default().FindFileByName("google/protobuf/any.proto").serialized_pb
+        cached = self._spec_entities
+        if (
+            cached is None
+            or len(cached) != len(entities)
+            or any(old is not new for old, new in zip(cached, entities))
+        ):
+            spec = self.build_entity_spec()
+            self._spec, self._serialized_spec = spec, spec.SerializeToString()
+            self._spec_entities = entities
+
+    def build_entity_spec(self) -> entity_pb2.EntitySpec:
+        entities = self.event_sourced_entities + self.action_protocol_entities
+        files = []
+        for entity in entities:
+            logger.info(f"entity: {entity.name()}")
+            files.append(entity.service_descriptor.file)
+            files.extend(entity.file_descriptors)
+        descriptor_set = FileDescriptorSet()
+        for descriptor in descriptor_closure(files):
+            logger.debug(f"discovering {descriptor.name}")
+            descriptor_set.file.append(
+                FileDescriptorProto.FromString(descriptor.serialized_pb)
             )
-        )
         spec = entity_pb2.EntitySpec(
             service_info=entity_pb2.ServiceInfo(
                 service_name="",
@@ -100,8 +106,7 @@ class CloudStateEntityDiscoveryServicer(EntityDiscoveryServicer):
                     service_name=entity.service_descriptor.full_name,
                     persistence_id=entity.persistence_id,
                 )
-                for entity in self.event_sourced_entities
-                + self.action_protocol_entities
+                for entity in entities
             ],
             proto=descriptor_set.SerializeToString(),
         )
@@ -109,5 +114,48 @@ class CloudStateEntityDiscoveryServicer(EntityDiscoveryServicer):
 
     def reportError(self, request, context):
         logger.error(f"Report error: {request}")
-        pprint(request)
         return Empty()
+
+
+def add_entity_discovery_to_server(servicer, server):
+    """Add the discovery servicer to the server, like
+    add_EntityDiscoveryServicer_to_server, but replying with the spec it serialized
+    once rather than serializing it again for every discovery."""
+    handlers = {
+        "discover": grpc.unary_unary_rpc_method_handler(
+            servicer.discover_serialized,
+            request_deserializer=entity_pb2.ProxyInfo.FromString,
+        ),
+        "reportError": grpc.unary_unary_rpc_method_handler(
+            servicer.reportError,
+            request_deserializer=entity_pb2.UserFunctionError.FromString,
+            response_serializer=Empty.SerializeToString,
+        ),
+    }
+    server.add_generic_rpc_handlers(
+        (grpc.method_handlers_generic_handler("cloudstate.EntityDiscovery", handlers),)
+    )
+
+
+def descriptor_closure(files: Iterable[FileDescriptor]) -> List[FileDescriptor]:
+    """The given files and all the files they import, transitively, each once and
+    after the files it imports."""
+    ordered: List[FileDescriptor] = []
+    seen = set()
+    for file in files:
+        if file.name in seen:
+            continue
+        seen.add(file.name)
+        # Iterative depth first walk, a file is added once its imports are.
+        stack = [(file, iter(file.dependencies))]
+        while stack:
+            current, dependencies = stack[-1]
+            for dependency in dependencies:
+                if dependency.name not in seen:
+                    seen.add(dependency.name)
+                    stack.append((dependency, iter(dependency.dependencies)))
+                    break
+            else:
+                stack.pop()
+                ordered.append(current)
+    return ordered
@@ -0,0 +1,162 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import logging
+import os
+import struct
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from cloudstate.event_sourced_pb2 import EventSourcedEvent, EventSourcedSnapshot
+
+EVENT = 1
+SNAPSHOT = 2
+
+# kind, key length, body length
+HEADER = struct.Struct(">BII")
+
+
+@dataclass
+class JournalEntry:
+    """The events of an entity, and its latest snapshot. Events are persisted with
+    contiguous sequence numbers from 1, so the event of sequence n is at n - 1."""
+
+    events: List[EventSourcedEvent] = field(default_factory=list)
+    snapshot: Optional[EventSourcedSnapshot] = None
+
+    def sequence(self) -> int:
+        return len(self.events)
+
+
+class InMemoryJournal:
+    """Events and snapshots of the event sourced entities, kept for as long as the
+    emulator runs."""
+
+    def __init__(self):
+        self.entries: Dict[Tuple[str, str], JournalEntry] = {}
+        self.lock = threading.Lock()
+
+    def load(
+        self, persistence_id: str, entity_id: str
+    ) -> Tuple[Optional[EventSourcedSnapshot], List[EventSourcedEvent]]:
+        """The latest snapshot of the entity, and the events persisted after it."""
+        with self.lock:
+            entry = self.entries.get((persistence_id, entity_id))
+            if entry is None:
+                return None, []
+            snapshot = entry.snapshot
+            start = snapshot.snapshot_sequence if snapshot is not None else 0
+            return snapshot, entry.events[start:]
+
+    def persist(
+        self,
+        persistence_id: str,
+        entity_id: str,
+        events: List[EventSourcedEvent],
+        snapshot: Optional[EventSourcedSnapshot] = None,
+    ):
+        with self.lock:
+            self._append((persistence_id, entity_id), events, snapshot)
+
+    def _append(
+        self,
+        key: Tuple[str, str],
+        events: List[EventSourcedEvent],
+        snapshot: Optional[EventSourcedSnapshot],
+    ):
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = JournalEntry()
+        for event in events:
+            if event.sequence != entry.sequence() + 1:
+                raise Exception(
+                    "Event {} of {} does not follow sequence {}".format(
+                        event.sequence, key, entry.sequence()
+                    )
+                )
+            entry.events.append(event)
+        if snapshot is not None:
+            entry.snapshot = snapshot
+
+    def sequence(self, persistence_id: str, entity_id: str) -> int:
+        with self.lock:
+            entry = self.entries.get((persistence_id, entity_id))
+            return entry.sequence() if entry is not None else 0
+
+    def close(self):
+        pass
+
+
+class FileJournal(InMemoryJournal):
+    """An in memory journal which also appends what it persists to a file, read
+    back when the journal is opened, so that entities survive a restart of the
+    emulator. A record which was only partly written is dropped."""
+
+    def __init__(self, path: str, sync: bool = False):
+        super().__init__()
+        self.path = path
+        self.sync = sync
+        end = self._read()
+        self.file = open(path, "ab")
+        if self.file.tell() != end:
+            logging.warning(f"Truncating incomplete journal record in {path}")
+            self.file.truncate(end)
+            self.file.seek(end)
+
+    def _read(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            kind, key_length, body_length = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            end = start + key_length + body_length
+            if end > len(data):
+                break
+            persistence_id, entity_id = (
+                data[start : start + key_length].decode("utf-8").split("\0", 1)
+            )
+            body = data[start + key_length : end]
+            if kind == EVENT:
+                events, snapshot = [EventSourcedEvent.FromString(body)], None
+            elif kind == SNAPSHOT:
+                events, snapshot = [], EventSourcedSnapshot.FromString(body)
+            else:
+                raise Exception(
+                    "Unknown record kind {} in {} at {}".format(kind, self.path, offset)
+                )
+            self._append((persistence_id, entity_id), events, snapshot)
+            offset = end
+        return offset
+
+    def persist(
+        self,
+        persistence_id: str,
+        entity_id: str,
+        events: List[EventSourcedEvent],
+        snapshot: Optional[EventSourcedSnapshot] = None,
+    ):
+        key = (persistence_id + "\0" + entity_id).encode("utf-8")
+        records = [_record(EVENT, key, event) for event in events]
+        if snapshot is not None:
+            records.append(_record(SNAPSHOT, key, snapshot))
+        with self.lock:
+            self._append((persistence_id, entity_id), events, snapshot)
+            self.file.write(b"".join(records))
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def _record(kind: int, key: bytes, message) -> bytes:
+    body = message.SerializeToString()
+    return HEADER.pack(kind, len(key), len(body)) + key + body
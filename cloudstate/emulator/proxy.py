@@ -0,0 +1,603 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+
+A stand-in for the Cloudstate proxy, to test and benchmark a user function without
+one. It discovers the entities of the user function, serves their gRPC services
+to clients, and routes the calls into the EventSourced and ActionProtocol streams
+of the user function, persisting events and snapshots to a journal which is
+replayed when an entity is activated again:
+
+    python -m cloudstate.test.tck_services server shoppingcart ActionDemo
+    python -m cloudstate.emulator --user-function localhost:8080 --port 9000
+"""
+
+import argparse
+import logging
+import queue
+import threading
+import time
+from concurrent import futures
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import grpc
+from google.protobuf import descriptor_pool, message_factory
+from google.protobuf.any_pb2 import Any
+from google.protobuf.descriptor_pb2 import FileDescriptorProto, FileDescriptorSet
+
+from cloudstate import entity_key_pb2
+from cloudstate.action_pb2 import _ACTIONPROTOCOL, ActionCommand
+from cloudstate.action_pb2_grpc import ActionProtocolStub
+from cloudstate.emulator.journal import FileJournal, InMemoryJournal
+from cloudstate.entity_pb2 import Command, EntitySpec, ProxyInfo
+from cloudstate.entity_pb2_grpc import EntityDiscoveryStub
+from cloudstate.event_sourced_pb2 import (
+    _EVENTSOURCED,
+    EventSourcedEvent,
+    EventSourcedInit,
+    EventSourcedReply,
+    EventSourcedSnapshot,
+    EventSourcedStreamIn,
+    EventSourcedStreamOut,
+)
+from cloudstate.event_sourced_pb2_grpc import EventSourcedStub
+
+TYPE_URL_PREFIX = "type.googleapis.com/"
+ENTITY_KEY_SEPARATOR = ":"
+
+_CLOSE = object()
+
+
+@dataclass
+class Method:
+    service_name: str
+    name: str
+    input_type: str
+    client_streaming: bool
+    server_streaming: bool
+    input_class: Optional[type] = None
+    key_fields: List[str] = field(default_factory=list)
+
+    @property
+    def type_url(self) -> str:
+        return TYPE_URL_PREFIX + self.input_type
+
+    def entity_id(self, payload: bytes) -> str:
+        if not self.key_fields:
+            raise Exception(
+                "{} of {} has no entity key field".format(self.input_type, self.name)
+            )
+        message = self.input_class.FromString(payload)
+        return ENTITY_KEY_SEPARATOR.join(
+            str(getattr(message, key_field)) for key_field in self.key_fields
+        )
+
+
+@dataclass
+class Service:
+    name: str
+    entity_type: str
+    persistence_id: str
+    methods: Dict[str, Method] = field(default_factory=dict)
+
+    @property
+    def event_sourced(self) -> bool:
+        return self.entity_type == _EVENTSOURCED.full_name
+
+
+class Activation:
+    """An event sourced entity, active in the user function over an
+    EventSourced.handle stream, which handles one command at a time."""
+
+    def __init__(
+        self,
+        stub: EventSourcedStub,
+        service: Service,
+        entity_id: str,
+        snapshot: Optional[EventSourcedSnapshot],
+        events: List[EventSourcedEvent],
+    ):
+        self.service = service
+        self.entity_id = entity_id
+        self.lock = threading.Lock()
+        self.closed = False
+        self.command_id = 0
+        self.last_used = time.monotonic()
+        if events:
+            self.sequence = events[-1].sequence
+        elif snapshot is not None:
+            self.sequence = snapshot.snapshot_sequence
+        else:
+            self.sequence = 0
+        init = EventSourcedInit(service_name=service.name, entity_id=entity_id)
+        if snapshot is not None:
+            init.snapshot.CopyFrom(snapshot)
+        self.requests: queue.Queue = queue.Queue()
+        self.requests.put(EventSourcedStreamIn(init=init))
+        for event in events:
+            self.requests.put(EventSourcedStreamIn(event=event))
+        self.responses = stub.handle(iter(self.requests.get, _CLOSE))
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return self.service.name, self.entity_id
+
+    def call(self, command: Command) -> EventSourcedStreamOut:
+        self.requests.put(EventSourcedStreamIn(command=command))
+        return next(self.responses)
+
+    def close(self):
+        self.closed = True
+        self.requests.put(_CLOSE)
+        self.responses.cancel()
+
+
+def build_pool(descriptor_set: FileDescriptorSet) -> descriptor_pool.DescriptorPool:
+    """A descriptor pool of the discovered files, added after their dependencies.
+    Dependencies which were not discovered are taken from the default pool."""
+    pool = descriptor_pool.DescriptorPool()
+    files = {}
+    for file in descriptor_set.file:
+        files.setdefault(file.name, file)
+    added = set()
+
+    def add(name: str):
+        if name in added:
+            return
+        added.add(name)
+        file = files.get(name)
+        if file is None:
+            try:
+                serialized = (
+                    descriptor_pool.Default().FindFileByName(name).serialized_pb
+                )
+            except KeyError:
+                raise Exception("Discovered descriptors depend on unknown " + name)
+            file = FileDescriptorProto.FromString(serialized)
+        for dependency in file.dependency:
+            add(dependency)
+        pool.Add(file)
+
+    for name in files:
+        add(name)
+    return pool
+
+
+def message_class(pool: descriptor_pool.DescriptorPool, full_name: str) -> type:
+    descriptor = pool.FindMessageTypeByName(full_name)
+    if hasattr(message_factory, "GetMessageClass"):
+        return message_factory.GetMessageClass(descriptor)
+    return message_factory.MessageFactory(pool).GetPrototype(descriptor)
+
+
+def entity_keys(descriptor_set: FileDescriptorSet) -> Dict[str, List[str]]:
+    """The entity key fields of every discovered message, by full name."""
+    keys = {}
+
+    def collect(prefix: str, messages):
+        for message in messages:
+            full_name = prefix + message.name
+            keys[full_name] = [
+                message_field.name
+                for message_field in message.field
+                if message_field.options.Extensions[entity_key_pb2.entity_key]
+            ]
+            collect(full_name + ".", message.nested_type)
+
+    for file in descriptor_set.file:
+        collect(file.package + "." if file.package else "", file.message_type)
+    return keys
+
+
+def services(spec: EntitySpec) -> Dict[str, Service]:
+    descriptor_set = FileDescriptorSet.FromString(spec.proto)
+    pool = build_pool(descriptor_set)
+    keys = entity_keys(descriptor_set)
+    service_protos = {}
+    for file in descriptor_set.file:
+        for service_proto in file.service:
+            prefix = file.package + "." if file.package else ""
+            service_protos[prefix + service_proto.name] = service_proto
+    discovered = {}
+    for entity in spec.entities:
+        if entity.service_name not in service_protos:
+            raise Exception("No descriptor discovered for " + entity.service_name)
+        service = Service(
+            entity.service_name, entity.entity_type, entity.persistence_id
+        )
+        for method_proto in service_protos[entity.service_name].method:
+            method = Method(
+                service.name,
+                method_proto.name,
+                method_proto.input_type.lstrip("."),
+                method_proto.client_streaming,
+                method_proto.server_streaming,
+            )
+            if service.event_sourced:
+                method.input_class = message_class(pool, method.input_type)
+                method.key_fields = keys.get(method.input_type, [])
+            service.methods[method.name] = method
+        discovered[service.name] = service
+    return discovered
+
+
+def _abort(context, ex: Exception):
+    if isinstance(ex, grpc.RpcError) and isinstance(ex, grpc.Call):
+        context.abort(ex.code(), ex.details())
+    context.abort(grpc.StatusCode.UNKNOWN, str(ex))
+
+
+class ProxyEmulator:
+    """Serves the services of a user function on a local port, in place of the
+    proxy. Event sourced entities are passivated once idle for the passivation
+    timeout, and replayed from the journal on their next command."""
+
+    def __init__(
+        self,
+        user_function: str,
+        journal: Optional[InMemoryJournal] = None,
+        passivation_timeout: float = 30.0,
+        host: str = "localhost",
+        port: int = 9000,
+        max_workers: int = 16,
+        connect_timeout: float = 10.0,
+    ):
+        self.user_function = user_function
+        self.journal = journal if journal is not None else InMemoryJournal()
+        self.passivation_timeout = passivation_timeout
+        self.host = host
+        self.port = port
+        self.max_workers = max_workers
+        self.connect_timeout = connect_timeout
+        self.channel: grpc.Channel = None
+        self.services: Dict[str, Service] = {}
+        self.activations: Dict[Tuple[str, str], Activation] = {}
+        self.lock = threading.Lock()
+        self.server: grpc.Server = None
+        self.stopped = threading.Event()
+        self.activated = 0
+        self.replayed_events = 0
+        self.passivations = 0
+        self.commands = 0
+
+    def discover(self) -> EntitySpec:
+        grpc.channel_ready_future(self.channel).result(timeout=self.connect_timeout)
+        return EntityDiscoveryStub(self.channel).discover(
+            ProxyInfo(
+                protocol_major_version=0,
+                protocol_minor_version=1,
+                proxy_name="cloudstate-emulator",
+                proxy_version="0",
+                supported_entity_types=[
+                    _EVENTSOURCED.full_name,
+                    _ACTIONPROTOCOL.full_name,
+                ],
+            )
+        )
+
+    def start(self) -> "ProxyEmulator":
+        self.channel = grpc.insecure_channel(self.user_function)
+        self.event_sourced = EventSourcedStub(self.channel)
+        self.actions = ActionProtocolStub(self.channel)
+        self.services = services(self.discover())
+        self.server = grpc.server(futures.ThreadPoolExecutor(self.max_workers))
+        self.server.add_generic_rpc_handlers(
+            [
+                grpc.method_handlers_generic_handler(
+                    service.name,
+                    {
+                        method.name: self.method_handler(service, method)
+                        for method in service.methods.values()
+                    },
+                )
+                for service in self.services.values()
+            ]
+        )
+        self.port = self.server.add_insecure_port(f"{self.host}:{self.port}")
+        self.server.start()
+        if self.passivation_timeout > 0:
+            threading.Thread(
+                target=self.run_passivation, name="passivation", daemon=True
+            ).start()
+        logging.info(
+            f"Emulating the proxy of {self.user_function} on {self.host}:{self.port}"
+        )
+        return self
+
+    def stop(self, grace: Optional[float] = None):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.stop(grace).wait()
+        for activation in list(self.activations.values()):
+            self.deactivate(activation)
+        if self.channel is not None:
+            self.channel.close()
+        self.journal.close()
+
+    def wait_for_termination(self):
+        self.server.wait_for_termination()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": len(self.activations),
+            "activated": self.activated,
+            "replayed_events": self.replayed_events,
+            "passivations": self.passivations,
+            "commands": self.commands,
+        }
+
+    def method_handler(self, service: Service, method: Method):
+        if service.event_sourced:
+            if method.client_streaming or method.server_streaming:
+                # Streamed commands of event sourced entities are not emulated, the
+                # missing handler has gRPC answer UNIMPLEMENTED.
+                return None
+            return grpc.unary_unary_rpc_method_handler(
+                lambda request, context: self.handle_unary(method, request, context)
+            )
+        if method.client_streaming and method.server_streaming:
+            return grpc.stream_stream_rpc_method_handler(
+                lambda requests, context: self.handle_streamed(
+                    method, requests, context
+                )
+            )
+        if method.client_streaming:
+            return grpc.stream_unary_rpc_method_handler(
+                lambda requests, context: self.handle_streamed_in(
+                    method, requests, context
+                )
+            )
+        if method.server_streaming:
+            return grpc.unary_stream_rpc_method_handler(
+                lambda request, context: self.handle_streamed_out(
+                    method, request, context
+                )
+            )
+        return grpc.unary_unary_rpc_method_handler(
+            lambda request, context: self.handle_unary(method, request, context)
+        )
+
+    def handle_unary(self, method: Method, request: bytes, context) -> bytes:
+        try:
+            payload = self.invoke(
+                method.service_name,
+                method.name,
+                Any(type_url=method.type_url, value=request),
+            )
+        except Exception as ex:
+            _abort(context, ex)
+        return payload.value if payload is not None else b""
+
+    def handle_streamed_out(self, method: Method, request: bytes, context):
+        command = ActionCommand(
+            service_name=method.service_name,
+            name=method.name,
+            payload=Any(type_url=method.type_url, value=request),
+        )
+        try:
+            yield from self.replies(self.actions.handleStreamedOut(command))
+        except Exception as ex:
+            _abort(context, ex)
+
+    def handle_streamed_in(self, method: Method, requests: Iterator[bytes], context):
+        try:
+            response = self.actions.handleStreamedIn(
+                self.action_commands(method, requests)
+            )
+            payload = self.resolve(response, response.side_effects)
+        except Exception as ex:
+            _abort(context, ex)
+        return payload.value if payload is not None else b""
+
+    def handle_streamed(self, method: Method, requests: Iterator[bytes], context):
+        try:
+            yield from self.replies(
+                self.actions.handleStreamed(self.action_commands(method, requests))
+            )
+        except Exception as ex:
+            _abort(context, ex)
+
+    def action_commands(self, method: Method, requests: Iterator[bytes]):
+        # The first command of a stream names the command, the others carry the
+        # payloads.
+        yield ActionCommand(service_name=method.service_name, name=method.name)
+        for request in requests:
+            yield ActionCommand(payload=Any(type_url=method.type_url, value=request))
+
+    def replies(self, responses) -> Iterator[bytes]:
+        for response in responses:
+            payload = self.resolve(response, response.side_effects)
+            if payload is not None:
+                yield payload.value
+
+    def invoke(
+        self, service_name: str, command_name: str, payload: Any
+    ) -> Optional[Any]:
+        """Invoke a unary command, on behalf of a client or of a forward or side
+        effect of another command, and resolve it to its reply."""
+        service = self.services.get(service_name)
+        if service is None or command_name not in service.methods:
+            raise Exception(f"Unknown command {service_name}/{command_name}")
+        method = service.methods[command_name]
+        if method.client_streaming or method.server_streaming:
+            raise Exception(f"Cannot invoke streamed {service_name}/{command_name}")
+        self.commands += 1
+        if service.event_sourced:
+            reply = self.handle_command(service, method, payload)
+            return self.resolve(reply.client_action, reply.side_effects)
+        response = self.actions.handleUnary(
+            ActionCommand(service_name=service_name, name=command_name, payload=payload)
+        )
+        return self.resolve(response, response.side_effects)
+
+    def resolve(self, action, side_effects) -> Optional[Any]:
+        """The reply payload of a client action or an action response, after
+        performing the side effects and following its forward."""
+        for effect in side_effects:
+            try:
+                self.invoke(effect.service_name, effect.command_name, effect.payload)
+            except Exception:
+                logging.exception(
+                    f"Side effect {effect.service_name}/{effect.command_name} failed"
+                )
+        if action.HasField("failure"):
+            raise Exception(action.failure.description)
+        if action.HasField("forward"):
+            forward = action.forward
+            return self.invoke(
+                forward.service_name, forward.command_name, forward.payload
+            )
+        if action.HasField("reply"):
+            return action.reply.payload
+        return None
+
+    def handle_command(
+        self, service: Service, method: Method, payload: Any
+    ) -> EventSourcedReply:
+        entity_id = method.entity_id(payload.value)
+        while True:
+            activation = self.activate(service, entity_id)
+            with activation.lock:
+                if activation.closed:
+                    continue
+                activation.command_id += 1
+                try:
+                    output = activation.call(
+                        Command(
+                            entity_id=entity_id,
+                            id=activation.command_id,
+                            name=method.name,
+                            payload=payload,
+                        )
+                    )
+                except Exception:
+                    self.deactivate(activation)
+                    raise
+                if output.HasField("failure"):
+                    # The user function fails the entity when it cannot carry on.
+                    self.deactivate(activation)
+                    raise Exception(output.failure.description)
+                reply = output.reply
+                self.persist(activation, reply)
+                activation.last_used = time.monotonic()
+            return reply
+
+    def persist(self, activation: Activation, reply: EventSourcedReply):
+        if not reply.events and not reply.HasField("snapshot"):
+            return
+        sequence = activation.sequence
+        events = [
+            EventSourcedEvent(sequence=sequence + number, payload=event)
+            for number, event in enumerate(reply.events, 1)
+        ]
+        activation.sequence = sequence + len(events)
+        snapshot = None
+        if reply.HasField("snapshot"):
+            snapshot = EventSourcedSnapshot(
+                snapshot_sequence=activation.sequence, snapshot=reply.snapshot
+            )
+        self.journal.persist(
+            activation.service.persistence_id, activation.entity_id, events, snapshot
+        )
+
+    def activate(self, service: Service, entity_id: str) -> Activation:
+        key = (service.name, entity_id)
+        with self.lock:
+            activation = self.activations.get(key)
+            if activation is None:
+                snapshot, events = self.journal.load(service.persistence_id, entity_id)
+                activation = Activation(
+                    self.event_sourced, service, entity_id, snapshot, events
+                )
+                self.activations[key] = activation
+                self.activated += 1
+                self.replayed_events += len(events)
+            return activation
+
+    def deactivate(self, activation: Activation):
+        with self.lock:
+            if self.activations.get(activation.key) is activation:
+                del self.activations[activation.key]
+        activation.close()
+
+    def passivate(self, service_name: str, entity_id: str) -> bool:
+        """Passivate an entity now, once it is done with its current command."""
+        activation = self.activations.get((service_name, entity_id))
+        if activation is None:
+            return False
+        with activation.lock:
+            if activation.closed:
+                return False
+            self.deactivate(activation)
+            self.passivations += 1
+        return True
+
+    def passivate_idle(self, timeout: float):
+        """Passivate the entities idle for at least the timeout, and not busy."""
+        now = time.monotonic()
+        for activation in list(self.activations.values()):
+            if now - activation.last_used < timeout:
+                continue
+            if not activation.lock.acquire(blocking=False):
+                continue
+            try:
+                if not activation.closed and now - activation.last_used >= timeout:
+                    self.deactivate(activation)
+                    self.passivations += 1
+            finally:
+                activation.lock.release()
+
+    def run_passivation(self):
+        interval = max(self.passivation_timeout / 2, 0.01)
+        while not self.stopped.wait(interval):
+            self.passivate_idle(self.passivation_timeout)
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m cloudstate.emulator",
+        description="Serve the entities of a user function in place of the proxy.",
+    )
+    parser.add_argument("--user-function", default="localhost:8080")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument(
+        "--journal", help="append events and snapshots to this file, for restarts"
+    )
+    parser.add_argument(
+        "--sync", action="store_true", help="sync the journal file on every write"
+    )
+    parser.add_argument(
+        "--passivation",
+        type=float,
+        default=30.0,
+        help="seconds before passivating an idle entity, 0 never does",
+    )
+    parser.add_argument("--workers", type=int, default=16)
+    options = parser.parse_args(args)
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    journal = (
+        FileJournal(options.journal, options.sync)
+        if options.journal
+        else InMemoryJournal()
+    )
+    emulator = ProxyEmulator(
+        options.user_function,
+        journal,
+        passivation_timeout=options.passivation,
+        host=options.host,
+        port=options.port,
+        max_workers=options.workers,
+    ).start()
+    try:
+        emulator.wait_for_termination()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+        logging.info(f"Emulator stats: {emulator.stats()}")
+    return 0
@@ -3,44 +3,92 @@ Copyright 2020 Lightbend Inc.
 Licensed under the Apache License, Version 2.0.
 """
 
-from dataclasses import dataclass, field
-from typing import Any, List
+from typing import Any, Callable, List, Optional, Sequence
 
-from cloudstate.contexts import ClientActionContext
-from cloudstate.entity_pb2 import Forward, SideEffect
+from cloudstate.contexts import ClientActionContext, Context
+from cloudstate.utils.payload_utils import TypeRegistry, is_serialized
 
 
-@dataclass
 class EventSourcedCommandContext(ClientActionContext):
     """An event sourced command context.
     Command Handler Methods may take this is a parameter. It allows emitting
     new events in response to a command, along with forwarding the result to other
     entities, and performing side effects on other entities"""
 
-    command_name: str
-    command_id: int
-    entity_id: str
-    sequence: int
-    events: List[Any] = field(default_factory=list)
-    errors: List[str] = field(default_factory=list)
-    effects: List[SideEffect] = field(default_factory=list)
-    forward: Forward = None
+    __slots__ = (
+        "command_name",
+        "entity_id",
+        "sequence",
+        "_events",
+        "resolve_event_handler",
+        "type_registry",
+    )
+
+    def __init__(
+        self,
+        command_name: str,
+        command_id: int,
+        entity_id: str,
+        sequence: int,
+        resolve_event_handler: Optional[Callable[[type], Any]] = None,
+        reply_to=None,
+        effects: Sequence = None,
+        type_registry: Optional[TypeRegistry] = None,
+    ):
+        super().__init__(command_id, reply_to, effects)
+        self.command_name = command_name
+        self.entity_id = entity_id
+        self.sequence = sequence
+        self._events: Optional[List[Any]] = None
+        # Resolves the handler of an event type, for events with none to be refused
+        # when they are emitted rather than once the command returned.
+        self.resolve_event_handler = resolve_event_handler
+        self.type_registry = type_registry
+
+    @property
+    def events(self) -> List[Any]:
+        if self._events is None:
+            self._events = []
+        return self._events
+
+    @events.setter
+    def events(self, events: List[Any]):
+        self._events = events
 
     def emit(self, event):
         """
         Emit the given event. The event will be persisted, and the handler of the
         event defined in the current behavior will immediately be executed to pick it up
+        The event may be serialized already, as an Any or a (type URL, bytes) pair:
+        it is persisted as it is, and only parsed if its handler reads it.
         """
-        self.events.append(event)
+        if self.type_registry is not None and is_serialized(event):
+            event = self.type_registry.wrap_serialized(event)
+        if (
+            self.resolve_event_handler is not None
+            and self.resolve_event_handler(event.__class__) is None
+        ):
+            raise Exception(
+                f"Cannot emit {event.__class__} from command {self.command_name}: no "
+                "event handler function handles it"
+            )
+        if self._events is None:
+            self._events = [event]
+        else:
+            self._events.append(event)
+
+
+class SnapshotContext(Context):
+    __slots__ = ("entity_id", "sequence_number")
 
+    def __init__(self, entity_id: str, sequence_number: int):
+        self.entity_id = entity_id
+        self.sequence_number = sequence_number
 
-@dataclass
-class SnapshotContext:
-    entity_id: str
-    sequence_number: int
 
+class EventContext(Context):
+    __slots__ = ("entity_id", "sequence_number")
 
-@dataclass
-class EventContext:
-    entity_id: str
-    sequence_number: int
+    def __init__(self, entity_id: str, sequence_number: int):
+        self.entity_id = entity_id
+        self.sequence_number = sequence_number
@@ -3,18 +3,23 @@ Copyright 2020 Lightbend Inc.
 Licensed under the Apache License, Version 2.0.
 """
 
-import inspect
+import typing
 from dataclasses import dataclass, field
-from typing import Any, Callable, List, MutableMapping
+from typing import Any, Callable, List, MutableMapping, Optional
 
 from google.protobuf import descriptor as _descriptor
+from google.protobuf.message import Message
 
+from cloudstate.contexts import Context
 from cloudstate.event_sourced_context import (
     EventContext,
     EventSourcedCommandContext,
     SnapshotContext,
 )
 from cloudstate.event_sourced_pb2 import _EVENTSOURCED
+from cloudstate.snapshot_policy import EveryEvents, SnapshotPolicy
+from cloudstate.utils.handler_utils import HandlerPlan, Slot, compile_handler
+from cloudstate.utils.payload_utils import TypeRegistry
 
 
 @dataclass
@@ -28,10 +33,31 @@ class EventSourcedEntity:
     snapshot_handler_function: Callable[[Any, Any], Any] = None
     command_handlers: MutableMapping[str, Callable] = field(default_factory=dict)
     event_handlers: MutableMapping[type, Callable] = field(default_factory=dict)
+    snapshot_plan: HandlerPlan = None
+    snapshot_handler_plan: HandlerPlan = None
+    command_handler_plans: MutableMapping[str, HandlerPlan] = field(
+        default_factory=dict
+    )
+    event_handler_plans: MutableMapping[type, HandlerPlan] = field(default_factory=dict)
+    # The plans resolved for the concrete event types seen, None for those with no
+    # handler, cleared when an event handler is registered.
+    resolved_event_handler_plans: MutableMapping[type, Optional[HandlerPlan]] = field(
+        default_factory=dict
+    )
+    bulk_event_handler_function: Callable[[Any, List[Any]], Any] = None
+    bulk_event_handler_plan: HandlerPlan = None
+    bulk_event_batch_size: int = 1000
+    snapshot_policy: SnapshotPolicy = None
+    type_registry: TypeRegistry = field(init=False, default=None)
 
     def __post_init__(self):
         if not self.persistence_id:
             self.persistence_id = self.service_descriptor.full_name
+        if self.snapshot_policy is None and self.snapshot_every > 0:
+            self.snapshot_policy = EveryEvents(self.snapshot_every)
+        self.type_registry = TypeRegistry.for_service(
+            self.service_descriptor, self.file_descriptors
+        )
 
     def entity_type(self):
         return _EVENTSOURCED.full_name
@@ -52,6 +78,11 @@ class EventSourcedEntity:
                     "At most 2 parameters, the current state and the snapshot context, "
                     "should be accepted by the snapshot function"
                 )
+            self.snapshot_plan = compile_handler(
+                function,
+                [self._state_slot(), Slot("context", SnapshotContext, Context)],
+                allow_async=False,
+            )
             self.snapshot_function = function
             return function
 
@@ -72,15 +103,25 @@ class EventSourcedEntity:
                     "At most two parameters, the current state and the snapshot, "
                     "should be accepted by the snapshot_handler function"
                 )
+            self.snapshot_handler_plan = compile_handler(
+                function,
+                [
+                    self._state_slot(),
+                    Slot("snapshot", Message, Message),
+                    Slot("context", SnapshotContext, Context),
+                ],
+                allow_async=False,
+            )
             self.snapshot_handler_function = function
             return function
 
         return register_snapshot_handler
 
-    def command_handler(self, name: str):
+    def command_handler(self, name: str, lazy: bool = False):
         def register_command_handler(function):
             """
             Register the function to handle commands
+            With lazy, the command is passed as a LazyMessage, parsed on first access
             """
             if name in self.command_handlers:
                 raise Exception(
@@ -93,6 +134,23 @@ class EventSourcedEntity:
                     "At most three parameters, the current state, the command and the "
                     "context, should be accepted by the command_handler function"
                 )
+            if name not in self.service_descriptor.methods_by_name:
+                raise Exception(
+                    f"Command handler function {function} registered for unknown "
+                    f"command {name} of service {self.name()}"
+                )
+            self.command_handler_plans[name] = compile_handler(
+                function,
+                [
+                    self._state_slot(),
+                    Slot("command", self.type_registry.input_types.get(name), Message),
+                    Slot("context", EventSourcedCommandContext, Context),
+                ],
+            )
+            self.command_handler_plans[name].lazy = lazy
+            self.command_handler_plans[name].decode = self.type_registry.method_decoder(
+                name, lazy
+            )
             self.command_handlers[name] = function
             return function
 
@@ -101,8 +159,14 @@ class EventSourcedEntity:
     def event_handler(self, event_type: type):
         def register_event_handler(function):
             """
-            Register the function to handle events
+            Register the function to handle events of the given type, and of its
+            subclasses which have no handler of their own
             """
+            if not isinstance(event_type, type):
+                raise Exception(
+                    f"Event handler function {function} must be registered for an "
+                    f"event class, not {event_type!r}"
+                )
             if event_type in self.event_handlers:
                 raise Exception(
                     "Event handler function {} already defined for type {}".format(
@@ -114,36 +178,104 @@ class EventSourcedEntity:
                     "At most two parameters, the current state and the event, should "
                     "be accepted by the command_handler function"
                 )
+            self.event_handler_plans[event_type] = compile_handler(
+                function,
+                [
+                    self._state_slot(),
+                    Slot("event", event_type, Message),
+                    Slot("context", EventContext, Context),
+                ],
+                allow_async=False,
+            )
+            if getattr(event_type, "DESCRIPTOR", None) is not None:
+                self.type_registry.register(event_type)
             self.event_handlers[event_type] = function
+            self.resolved_event_handler_plans.clear()
             return function
 
         return register_event_handler
 
+    def bulk_event_handler(self, max_batch: int = 1000):
+        def register_bulk_event_handler(function):
+            """
+            Register the function to handle the events replayed while recovering the
+            entity. It receives runs of up to max_batch consecutive events as a list,
+            along with the context of the last one, and returns the new state.
+            Events emitted by commands are still handled by the event handlers
+            """
+            if self.bulk_event_handler_function:
+                raise Exception(
+                    f"Bulk event handler function {self.bulk_event_handler_function} "
+                    "already defined for this entity"
+                )
+            if function.__code__.co_argcount > 3:
+                raise Exception(
+                    "At most three parameters, the current state, the events and the "
+                    "context, should be accepted by the bulk_event_handler function"
+                )
+            if max_batch < 1:
+                raise Exception(
+                    f"The batches of bulk event handler function {function} must hold "
+                    "at least one event"
+                )
+            self.bulk_event_handler_plan = compile_handler(
+                function,
+                [
+                    self._state_slot(),
+                    Slot("events", list),
+                    Slot("context", EventContext, Context),
+                ],
+                allow_async=False,
+            )
+            self.bulk_event_batch_size = max_batch
+            self.bulk_event_handler_function = function
+            return function
+
+        return register_bulk_event_handler
+
     def name(self):
         return self.service_descriptor.full_name
 
+    def event_handler_plan(self, event_type: type) -> Optional[HandlerPlan]:
+        """The plan of the handler of the given event type, the one registered for
+        the nearest class in its method resolution order."""
+        try:
+            return self.resolved_event_handler_plans[event_type]
+        except KeyError:
+            pass
+        plans = self.event_handler_plans
+        plan = next(
+            (plans[cls] for cls in event_type.__mro__ if cls in plans),
+            None,
+        )
+        self.resolved_event_handler_plans[event_type] = plan
+        return plan
 
-def invoke(function, parameters):
-    ordered_parameters = []
-    for parameter_definition in inspect.signature(function).parameters.values():
-        annotation = parameter_definition.annotation
-        if annotation == inspect._empty:
-            raise Exception(
-                f"Cannot inject parameter {parameter_definition.name} of function "
-                f"{function}: Missing type annotation"
-            )
-        match_found = False
-        for param in parameters:
-            if isinstance(param, annotation):
-                match_found = True
-                ordered_parameters.append(param)
-        if not match_found:
-            raise Exception(
-                "Cannot inject parameter {} of function {}: No matching value".format(
-                    parameter_definition.name, function
-                )
-            )
-    return function(*ordered_parameters)
+    def command_decoder(self, name: str):
+        """The decoder of the payloads of the given command."""
+        plan = self.command_handler_plans.get(name)
+        return plan.decode if plan else self.type_registry.decode
+
+    def handler_plans(self) -> List[HandlerPlan]:
+        """The plans of all the handlers registered for this entity."""
+        return [
+            plan
+            for plan in [self.snapshot_plan, self.snapshot_handler_plan]
+            + list(self.command_handler_plans.values())
+            + list(self.event_handler_plans.values())
+            + [self.bulk_event_handler_plan]
+            if plan
+        ]
+
+    def _state_slot(self) -> Slot:
+        return Slot("state", self._state_type())
+
+    def _state_type(self) -> Optional[type]:
+        try:
+            state_type = typing.get_type_hints(self.init_state).get("return")
+        except Exception:
+            return None
+        return state_type if isinstance(state_type, type) else None
 
 
 @dataclass
@@ -158,7 +290,7 @@ class EventSourcedHandler:
             raise Exception(
                 "Missing snapshot function for entity {}".format(self.entity.name())
             )
-        return invoke(self.entity.snapshot_function, [current_state, snapshot_context])
+        return self.entity.snapshot_plan.invoke(current_state, snapshot_context)
 
     def handle_snapshot(
         self, current_state, snapshot, snapshot_context: SnapshotContext
@@ -169,26 +301,37 @@ class EventSourcedHandler:
                     self.entity.name()
                 )
             )
-        return invoke(
-            self.entity.snapshot_handler_function,
-            [current_state, snapshot, snapshot_context],
+        return self.entity.snapshot_handler_plan.invoke(
+            current_state, snapshot, snapshot_context
         )
 
-    def handle_event(self, current_state, event, event_context: EventContext):
-        event_type = type(event)
-        handler_function = None
-        if event_type in self.entity.event_handlers:
-            handler_function = self.entity.event_handlers[event_type]
-        else:
-            for event_type, function in self.entity.event_handlers:
-                if isinstance(event, event_type):
-                    handler_function = function
-        if not handler_function:
+    def event_plan(self, event) -> HandlerPlan:
+        # The class of lazy messages is the one of the message they stand in for.
+        plan = self.entity.event_handler_plan(event.__class__)
+        if plan is None:
             raise Exception(
                 f"Missing event handler function for entity {self.entity.name()} and "
-                f"event type {event_type}"
+                f"event type {event.__class__}"
+            )
+        return plan
+
+    def handle_event(self, current_state, event, event_context: EventContext):
+        return self.event_plan(event).invoke(current_state, event, event_context)
+
+    def replay_event(self, current_state, event, entity_id: str, sequence_number: int):
+        """Handle a replayed event, only creating its context for the handlers that
+        accept one."""
+        plan = self.event_plan(event)
+        if 2 in plan.indices:
+            return plan.invoke(
+                current_state, event, EventContext(entity_id, sequence_number)
             )
-        return invoke(handler_function, [current_state, event, event_context])
+        return plan.invoke(current_state, event, None)
+
+    def handle_events(self, current_state, events: List, event_context: EventContext):
+        return self.entity.bulk_event_handler_plan.invoke(
+            current_state, events, event_context
+        )
 
     def handle_command(self, current_state, command, ctx: EventSourcedCommandContext):
         if ctx.command_name not in self.entity.command_handlers:
@@ -196,7 +339,6 @@ class EventSourcedHandler:
                 f"Missing command handler function for entity {self.entity.name()} and "
                 f"command {ctx.command_name}"
             )
-        return invoke(
-            self.entity.command_handlers[ctx.command_name],
-            [current_state, command, ctx],
+        return self.entity.command_handler_plans[ctx.command_name].invoke(
+            current_state, command, ctx
         )
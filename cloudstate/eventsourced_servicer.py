@@ -4,11 +4,12 @@ Licensed under the Apache License, Version 2.0.
 """
 
 import logging
-from pprint import pprint
-from typing import List
+from time import perf_counter
+from typing import Any, List, Mapping, Optional, Tuple
 
 from google.protobuf import symbol_database as _symbol_database
 
+from cloudstate import tracing
 from cloudstate.entity_pb2 import Command
 from cloudstate.event_sourced_context import (
     EventContext,
@@ -19,125 +20,386 @@ from cloudstate.event_sourced_entity import EventSourcedEntity, EventSourcedHand
 from cloudstate.event_sourced_pb2 import (
     EventSourcedEvent,
     EventSourcedInit,
-    EventSourcedReply,
     EventSourcedSnapshot,
     EventSourcedStreamOut,
 )
 from cloudstate.event_sourced_pb2_grpc import EventSourcedServicer
-from cloudstate.utils.payload_utils import get_payload, pack
+from cloudstate.metrics import METRICS, CommandMetrics, EntityMetrics
+from cloudstate.snapshot_policy import SnapshotStats
+from cloudstate.state_cache import CachedState, StateCache
+from cloudstate.utils.payload_utils import pack_into
 
 _sym_db = _symbol_database.Default()
 
 TYPE_URL_PREFIX = "type.googleapis.com/"
 
 
+class EventSourcedStream:
+    """The state of a single entity over the lifetime of one EventSourced.handle
+    stream. Shared by the threaded and the asyncio servicers, which only differ in
+    how they read the stream and invoke the command handler."""
+
+    def __init__(
+        self,
+        event_sourced_entities: Mapping[str, EventSourcedEntity],
+        state_cache: Optional[StateCache] = None,
+    ):
+        self.event_sourced_entities = event_sourced_entities
+        self.state_cache = state_cache
+        self.cached: Optional[CachedState] = None
+        self.pending_snapshot: Optional[EventSourcedSnapshot] = None
+        self.pending_events: List[EventSourcedEvent] = []
+        self.handler: EventSourcedHandler = None
+        self.entity_id: str = None
+        self.current_state = None
+        self.start_sequence_number: int = 0
+        self.replayed_events: List[Any] = []
+        self.metrics: EntityMetrics = None
+        self.command_metrics: CommandMetrics = None
+        self.span: tracing.Span = None
+        # The message sent to the proxy for the command being handled, which its
+        # context writes the reply and side effects into.
+        self.output: Optional[EventSourcedStreamOut] = None
+        self.recovering = False
+        self.recovery_started = 0.0
+        self.events_replayed = 0
+        self.snapshot_stats = SnapshotStats()
+        # Whether the state is not in the middle of being changed, for it to be
+        # cached when the stream ends.
+        self.settled = True
+
+    @property
+    def initiated(self) -> bool:
+        return self.handler is not None
+
+    def init(self, init: EventSourcedInit):
+        self.settled = False
+        service_name = init.service_name
+        self.entity_id = init.entity_id
+        if service_name not in self.event_sourced_entities:
+            raise Exception(
+                "No event sourced entity registered for service {}".format(service_name)
+            )
+        entity = self.event_sourced_entities[service_name]
+        self.metrics = METRICS.entity(service_name)
+        self.metrics.active_streams.inc()
+        self.recovering = True
+        self.recovery_started = perf_counter()
+        self.handler = EventSourcedHandler(entity)
+        self.decode = entity.type_registry.decode
+        snapshot = init.snapshot if init.HasField("snapshot") else None
+        if self.state_cache is not None:
+            cached = self.state_cache.take(entity.persistence_id, self.entity_id)
+            if cached is None:
+                self.metrics.state_cache_misses.inc()
+            elif snapshot is None or (
+                cached.sequence_number >= snapshot.snapshot_sequence
+            ):
+                # The cached state is only reused once the journal is known to
+                # reach its sequence number, until then the snapshot and events
+                # are kept to recover the entity without it.
+                self.cached = cached
+                self.pending_snapshot = snapshot
+                if snapshot is not None:
+                    self.reuse_cached(snapshot.snapshot_sequence)
+                self.settled = True
+                return
+            else:
+                self.metrics.state_cache_stale.inc()
+        self.current_state = self.handler.init_state(self.entity_id)
+        if snapshot is not None:
+            self.apply_snapshot(snapshot)
+        self.settled = True
+
+    def apply_snapshot(self, event_sourced_snapshot: EventSourcedSnapshot):
+        self.start_sequence_number = event_sourced_snapshot.snapshot_sequence
+        self.snapshot_stats.sequence_number = self.start_sequence_number
+        snapshot = self.decode(event_sourced_snapshot.snapshot)
+        snapshot_context = SnapshotContext(self.entity_id, self.start_sequence_number)
+        snapshot_result = self.handler.handle_snapshot(
+            self.current_state, snapshot, snapshot_context
+        )
+        if snapshot_result:
+            self.current_state = snapshot_result
+
+    def reuse_cached(self, sequence_number: int):
+        """Reuse the cached state if the journal reached its sequence number,
+        skipping the events it already applied."""
+        cached = self.cached
+        if sequence_number != cached.sequence_number:
+            return
+        self.cached = None
+        self.pending_snapshot = None
+        self.pending_events = []
+        self.current_state = cached.state
+        self.start_sequence_number = cached.sequence_number
+        self.snapshot_stats = cached.snapshot_stats
+        self.snapshot_stats.snapshots = 0
+        self.metrics.state_cache_hits.inc()
+
+    def recover_without_cache(self):
+        """Recover from the snapshot and events, the cached state being ahead of
+        the journal."""
+        self.cached = None
+        self.metrics.state_cache_stale.inc()
+        self.current_state = self.handler.init_state(self.entity_id)
+        if self.pending_snapshot is not None:
+            self.apply_snapshot(self.pending_snapshot)
+        events, self.pending_events = self.pending_events, []
+        self.pending_snapshot = None
+        for event in events:
+            self.apply_event(event)
+
+    def apply_event(self, event: EventSourcedEvent):
+        self.settled = False
+        if self.cached is not None:
+            if event.sequence < self.cached.sequence_number:
+                self.pending_events.append(event)
+                self.events_replayed += 1
+                self.settled = True
+                return
+            if event.sequence == self.cached.sequence_number:
+                self.events_replayed += 1
+                self.reuse_cached(event.sequence)
+                self.settled = True
+                return
+            self.recover_without_cache()
+        start = perf_counter()
+        evt = self.decode(event.payload)
+        self.start_sequence_number = event.sequence
+        self.events_replayed += 1
+        entity = self.handler.entity
+        if entity.bulk_event_handler_plan:
+            replayed_events = self.replayed_events
+            replayed_events.append(evt)
+            if len(replayed_events) >= entity.bulk_event_batch_size:
+                self.flush_events()
+        else:
+            event_result = self.handler.replay_event(
+                self.current_state, evt, self.entity_id, event.sequence
+            )
+            if event_result:
+                self.current_state = event_result
+        snapshot_stats = self.snapshot_stats
+        snapshot_stats.sequence_number = event.sequence
+        snapshot_stats.events += 1
+        snapshot_stats.event_bytes += len(event.payload.value)
+        snapshot_stats.replay_seconds += perf_counter() - start
+        self.settled = True
+
+    def flush_events(self):
+        """Hand the events replayed since the last flush to the bulk event handler.
+        Done before the next command, or once a batch is full."""
+        if not self.replayed_events:
+            return
+        events, self.replayed_events = self.replayed_events, []
+        event_result = self.handler.handle_events(
+            self.current_state,
+            events,
+            EventContext(self.entity_id, self.start_sequence_number),
+        )
+        if event_result:
+            self.current_state = event_result
+
+    def recovered(self):
+        """Record the recovery of the entity, once its events have been replayed."""
+        if self.recovering:
+            self.recovering = False
+            if self.cached is not None:
+                self.recover_without_cache()
+            flushing = perf_counter()
+            self.flush_events()
+            self.snapshot_stats.replay_seconds += perf_counter() - flushing
+            recovery_seconds = perf_counter() - self.recovery_started
+            self.snapshot_stats.recovery_seconds = recovery_seconds
+            self.metrics.recovery_events.observe(self.events_replayed)
+            self.metrics.recovery_seconds.observe(recovery_seconds)
+
+    def close(self):
+        if self.initiated:
+            # A cached state which was not reused yet stays cached as it is.
+            cached, self.cached = self.cached, None
+            self.recovered()
+            self.metrics.active_streams.dec()
+            if self.state_cache is not None and self.settled:
+                persistence_id = self.handler.entity.persistence_id
+                if cached is not None:
+                    self.state_cache.put(persistence_id, self.entity_id, cached)
+                elif self.start_sequence_number > 0:
+                    self.state_cache.store(
+                        persistence_id,
+                        self.entity_id,
+                        self.current_state,
+                        self.start_sequence_number,
+                        self.snapshot_stats,
+                    )
+        if self.span is not None:
+            self.span.end()
+
+    def begin_command(self, command: Command) -> Tuple[Any, EventSourcedCommandContext]:
+        self.recovered()
+        self.settled = False
+        entity = self.handler.entity
+        self.command_metrics = METRICS.command(entity.name(), command.name)
+        output = self.output = EventSourcedStreamOut()
+        reply = output.reply
+        reply.command_id = command.id
+        ctx = EventSourcedCommandContext(
+            command.name,
+            command.id,
+            self.entity_id,
+            self.start_sequence_number,
+            entity.event_handler_plan,
+            reply.client_action,
+            reply.side_effects,
+            entity.type_registry,
+        )
+        tracer = tracing.TRACER
+        if tracer.enabled:
+            self.span = tracing.start_span(
+                tracer,
+                ctx,
+                f"{entity.name()}/{command.name}",
+                command.metadata,
+                {
+                    "cloudstate.entity_id": self.entity_id,
+                    "cloudstate.command_id": command.id,
+                    "cloudstate.sequence": self.start_sequence_number,
+                },
+            )
+        start = perf_counter()
+        cmd = entity.command_decoder(command.name)(command.payload)
+        self.command_metrics.decode.observe(perf_counter() - start)
+        return cmd, ctx
+
+    def invoke_command(self, cmd, ctx: EventSourcedCommandContext):
+        return self.handler.handle_command(self.current_state, cmd, ctx)
+
+    def command_failed(self, ctx: EventSourcedCommandContext, ex: Exception):
+        ctx.fail(str(ex))
+        if self.span is not None:
+            self.span.record_exception(ex)
+        logging.exception("Failed to execute command:" + str(ex))
+
+    def complete_command(
+        self, command: Command, ctx: EventSourcedCommandContext, result
+    ) -> EventSourcedStreamOut:
+        handler = self.handler
+        command_metrics = self.command_metrics
+        if ctx.has_errors():
+            command_metrics.failures.inc()
+        start = perf_counter()
+        output, self.output = self.output, None
+        event_sourced_reply = output.reply
+        ctx.write_client_action(result, False)
+        snapshot = None
+        applied = snapshotted = 0.0
+        if not ctx.has_errors():
+            start_sequence_number = self.start_sequence_number
+            snapshot_stats = self.snapshot_stats
+            if ctx.events:
+                applying = perf_counter()
+                sequence_number = start_sequence_number
+                for event in ctx.events:
+                    sequence_number += 1
+                    # Handlers may keep their context, so each event has its own.
+                    event_result = handler.handle_event(
+                        self.current_state,
+                        event,
+                        EventContext(self.entity_id, sequence_number),
+                    )
+                    if event_result:
+                        self.current_state = event_result
+                applied = perf_counter() - applying
+                command_metrics.event_apply.observe(applied)
+            end_sequence_number = start_sequence_number + len(ctx.events)
+            self.start_sequence_number = end_sequence_number
+
+            events = event_sourced_reply.events
+            for event in ctx.events:
+                pack_into(events.add(), event)
+            snapshot_stats.sequence_number = end_sequence_number
+            snapshot_stats.emitted = len(ctx.events)
+            if ctx.events:
+                snapshot_stats.events += len(ctx.events)
+                snapshot_stats.event_bytes += sum(
+                    len(event.value) for event in event_sourced_reply.events
+                )
+                snapshot_stats.replay_seconds += applied
+            snapshot_policy = handler.entity.snapshot_policy
+            if (
+                snapshot_policy is not None
+                and snapshot_stats.dirty
+                and snapshot_policy.should_snapshot(snapshot_stats)
+            ):
+                snapshotting = perf_counter()
+                snapshot = handler.snapshot(
+                    self.current_state,
+                    SnapshotContext(self.entity_id, end_sequence_number),
+                )
+                snapshot_stats.snapshotted()
+                snapshotted = perf_counter() - snapshotting
+                command_metrics.snapshot.observe(snapshotted)
+
+            if snapshot:
+                pack_into(event_sourced_reply.snapshot, snapshot)
+                self.metrics.snapshot_bytes.observe(
+                    len(event_sourced_reply.snapshot.value)
+                )
+
+        # Encoding covers building the reply, less applying the events and taking
+        # the snapshot, which are observed separately.
+        command_metrics.encode.observe(perf_counter() - start - applied - snapshotted)
+        if self.span is not None:
+            self.span.set_attribute("cloudstate.events_emitted", len(ctx.events))
+            self.span.set_attribute("cloudstate.snapshot", snapshot is not None)
+            tracing.end_span(self.span, ctx)
+            self.span = None
+        self.settled = True
+        return output
+
+    def handle_command(self, command: Command) -> EventSourcedStreamOut:
+        cmd, ctx = self.begin_command(command)
+        result = None
+        start = perf_counter()
+        try:
+            result = self.invoke_command(cmd, ctx)
+        except Exception as ex:
+            self.command_failed(ctx, ex)
+        self.command_metrics.handler.observe(perf_counter() - start)
+        return self.complete_command(command, ctx, result)
+
+
 class CloudStateEventSourcedServicer(EventSourcedServicer):
-    def __init__(self, event_sourced_entities: List[EventSourcedEntity]):
+    def __init__(
+        self,
+        event_sourced_entities: List[EventSourcedEntity],
+        state_cache: Optional[StateCache] = None,
+    ):
         self.event_sourced_entities = {
             entity.name(): entity for entity in event_sourced_entities
         }
+        self.state_cache = state_cache
 
     def handle(self, request_iterator, context):
-        initiated = False
-        current_state = None
-        handler: EventSourcedHandler = None
-        entity_id: str = None
-        start_sequence_number: int = 0
-        for request in request_iterator:
-            if not initiated:
-                if request.HasField("init"):
-                    init: EventSourcedInit = request.init
-                    service_name = init.service_name
-                    entity_id = init.entity_id
-                    if service_name not in self.event_sourced_entities:
-                        raise Exception(
-                            "No event sourced entity registered for service {}".format(
-                                service_name
-                            )
-                        )
-                    entity = self.event_sourced_entities[service_name]
-                    handler = EventSourcedHandler(entity)
-                    current_state = handler.init_state(entity_id)
-                    initiated = True
-                    if init.HasField("snapshot"):
-                        event_sourced_snapshot: EventSourcedSnapshot = init.snapshot
-                        start_sequence_number = event_sourced_snapshot.snapshot_sequence
-                        snapshot = get_payload(event_sourced_snapshot.snapshot)
-                        snapshot_context = SnapshotContext(
-                            entity_id, start_sequence_number
-                        )
-                        snapshot_result = handler.handle_snapshot(
-                            current_state, snapshot, snapshot_context
-                        )
-                        if snapshot_result:
-                            current_state = snapshot_result
+        stream = EventSourcedStream(self.event_sourced_entities, self.state_cache)
+        try:
+            for request in request_iterator:
+                # Dispatch on the field set, commands and events first.
+                message = request.WhichOneof("message")
+                if message == "command" and stream.initiated:
+                    yield stream.handle_command(request.command)
+                elif message == "event" and stream.initiated:
+                    stream.apply_event(request.event)
+                elif message == "init" and not stream.initiated:
+                    stream.init(request.init)
+                elif stream.initiated:
+                    raise Exception(
+                        "Cannot handle {} after initialization".format(type(request))
+                    )
                 else:
                     raise Exception(
                         "Cannot handle {} before initialization".format(request)
                     )
-
-            elif request.HasField("event"):
-                event: EventSourcedEvent = request.event
-                evt = get_payload(event)
-                event_result = handler.handle_event(
-                    current_state, evt, EventContext(entity_id, event.sequence)
-                )
-                start_sequence_number = event.sequence
-                if event_result:
-                    current_state = event_result
-                pprint("Handling event {}".format(event))
-            elif request.HasField("command"):
-                command: Command = request.command
-                cmd = get_payload(command)
-                ctx = EventSourcedCommandContext(
-                    command.name, command.id, entity_id, start_sequence_number
-                )
-                result = None
-                try:
-                    result = handler.handle_command(current_state, cmd, ctx)
-                except Exception as ex:
-                    ctx.fail(str(ex))
-                    logging.exception("Failed to execute command:" + str(ex))
-
-                client_action = ctx.create_client_action(result, False)
-                event_sourced_reply = EventSourcedReply()
-                event_sourced_reply.command_id = command.id
-                event_sourced_reply.client_action.CopyFrom(client_action)
-                snapshot = None
-                perform_snapshot = False
-                if not ctx.has_errors():
-                    for number, event in enumerate(ctx.events):
-                        sequence_number = start_sequence_number + number + 1
-                        event_result = handler.handle_event(
-                            current_state,
-                            event,
-                            EventContext(entity_id, start_sequence_number + number),
-                        )
-                        if event_result:
-                            current_state = event_result
-                        snapshot_every = handler.entity.snapshot_every
-                        perform_snapshot = (snapshot_every > 0) and (
-                            perform_snapshot or (sequence_number % snapshot_every == 0)
-                        )
-                    end_sequence_number = start_sequence_number + len(ctx.events)
-                    if perform_snapshot:
-                        snapshot = handler.snapshot(
-                            current_state,
-                            SnapshotContext(entity_id, end_sequence_number),
-                        )
-
-                    event_sourced_reply.side_effects.extend(ctx.effects)
-                    event_sourced_reply.events.extend(
-                        [pack(event) for event in ctx.events]
-                    )
-                    if snapshot:
-                        event_sourced_reply.snapshot.Pack(snapshot)
-
-                output = EventSourcedStreamOut()
-                output.reply.CopyFrom(event_sourced_reply)
-                yield output
-
-            else:
-                raise Exception(
-                    "Cannot handle {} after initialization".format(type(request))
-                )
+        finally:
+            stream.close()
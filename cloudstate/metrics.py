@@ -0,0 +1,443 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import logging
+import math
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Latencies, in seconds.
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+# Sizes, in bytes.
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+# Numbers of items, such as the events replayed by a recovery.
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+# Commands handled by a call of a batch handler.
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Value:
+    """A counter or gauge value for one set of label values. A gauge may instead
+    be computed by a function whenever it is collected."""
+
+    __slots__ = ("_lock", "_value", "function")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value: float):
+        self._value = value
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is not None:
+            return self.function()
+        return self._value
+
+
+class HistogramValue:
+    """A histogram for one set of label values."""
+
+    __slots__ = ("_lock", "buckets", "counts", "sum")
+
+    def __init__(self, buckets: Sequence[float]):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        # The last count is that of the +Inf bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def count(self) -> int:
+        return sum(self.counts)
+
+
+class Metric:
+    """A metric family, with one value per combination of label values."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *labelvalues: str):
+        """The value of the given label values, which callers on hot paths should
+        keep rather than look up every time."""
+        value = self._values.get(labelvalues)
+        if value is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise Exception(
+                    f"Metric {self.name} expects the labels {self.labelnames}, got "
+                    f"{labelvalues}"
+                )
+            with self._lock:
+                value = self._values.setdefault(labelvalues, self._new_value())
+        return value
+
+    def _new_value(self):
+        return Value()
+
+    def collect(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        """The samples of the metric, as name, labels and value."""
+        for labelvalues, value in list(self._values.items()):
+            yield self.name, dict(zip(self.labelnames, labelvalues)), value.get()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_value(self):
+        return HistogramValue(self.buckets)
+
+    def collect(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        for labelvalues, value in list(self._values.items()):
+            labels = dict(zip(self.labelnames, labelvalues))
+            with value._lock:
+                counts = list(value.counts)
+                total = value.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield self.name + "_bucket", dict(labels, le=_number(bound)), cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+
+class Registry:
+    """The metrics exposed together, in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        if any(existing.name == metric.name for existing in self.metrics):
+            raise Exception(f"Metric {metric.name} is already registered")
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def exposition(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {_escape_help(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                for name, labels, value in metric.collect():
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+            except Exception:
+                logging.exception("Failed to collect metric %s", metric.name)
+        return "\n".join(lines) + "\n"
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", r"\\").replace("\n", r"\n")
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", r"\\")
+                .replace('"', r"\"")
+                .replace("\n", r"\n"),
+            )
+            for name, value in labels.items()
+        )
+        + "}"
+    )
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class CommandMetrics:
+    """The metrics of one command of one entity, looked up once per command."""
+
+    __slots__ = ("decode", "handler", "event_apply", "snapshot", "encode", "failures")
+
+    def __init__(self, metrics: "Metrics", entity: str, command: str):
+        stage_seconds = metrics.stage_seconds
+        self.decode = stage_seconds.labels(entity, command, "decode")
+        self.handler = stage_seconds.labels(entity, command, "handler")
+        self.event_apply = stage_seconds.labels(entity, command, "event_apply")
+        self.snapshot = stage_seconds.labels(entity, command, "snapshot")
+        self.encode = stage_seconds.labels(entity, command, "encode")
+        self.failures = metrics.failures.labels(entity, command)
+
+
+class EntityMetrics:
+    """The metrics of the streams of one entity."""
+
+    __slots__ = (
+        "recovery_events",
+        "recovery_seconds",
+        "snapshot_bytes",
+        "active_streams",
+        "state_cache_hits",
+        "state_cache_misses",
+        "state_cache_stale",
+    )
+
+    def __init__(self, metrics: "Metrics", entity: str):
+        self.recovery_events = metrics.recovery_events.labels(entity)
+        self.recovery_seconds = metrics.recovery_seconds.labels(entity)
+        self.snapshot_bytes = metrics.snapshot_bytes.labels(entity)
+        self.active_streams = metrics.active_streams.labels(entity)
+        self.state_cache_hits = metrics.state_cache.labels(entity, "hit")
+        self.state_cache_misses = metrics.state_cache.labels(entity, "miss")
+        self.state_cache_stale = metrics.state_cache.labels(entity, "stale")
+
+
+class Metrics:
+    """The metrics recorded by the servicers. Recording one costs a lock and a few
+    additions, and the values of every entity and command are created once, so
+    they can stay enabled in production."""
+
+    def __init__(self, registry: Optional[Registry] = None):
+        self.registry = registry or Registry()
+        self.stage_seconds = self.registry.histogram(
+            "cloudstate_command_stage_seconds",
+            "Time spent handling commands, by entity, command and stage.",
+            ("entity", "command", "stage"),
+        )
+        self.failures = self.registry.counter(
+            "cloudstate_command_failures_total",
+            "Commands that failed, by entity and command.",
+            ("entity", "command"),
+        )
+        self.recovery_events = self.registry.histogram(
+            "cloudstate_recovery_events",
+            "Events replayed to recover an entity.",
+            ("entity",),
+            COUNT_BUCKETS,
+        )
+        self.recovery_seconds = self.registry.histogram(
+            "cloudstate_recovery_seconds",
+            "Time from the initialization of an entity to its first command.",
+            ("entity",),
+        )
+        self.snapshot_bytes = self.registry.histogram(
+            "cloudstate_snapshot_bytes",
+            "Serialized size of the snapshots taken.",
+            ("entity",),
+            SIZE_BUCKETS,
+        )
+        self.active_streams = self.registry.gauge(
+            "cloudstate_active_streams",
+            "Entity and streamed action streams currently open.",
+            ("entity",),
+        )
+        self.state_cache = self.registry.counter(
+            "cloudstate_state_cache_total",
+            "Lookups of the state cache on initialization of an entity, by entity and "
+            "result: hit, miss, or stale when the cached state is behind the journal.",
+            ("entity", "result"),
+        )
+        self.state_cache_entries = self.registry.gauge(
+            "cloudstate_state_cache_entries", "States held by the state cache."
+        )
+        self.state_cache_bytes = self.registry.gauge(
+            "cloudstate_state_cache_bytes",
+            "Approximate size of the states held by the state cache.",
+        )
+        self.batch_size = self.registry.histogram(
+            "cloudstate_batch_size",
+            "Commands handled by each call of a batch handler, by entity and command.",
+            ("entity", "command"),
+            BATCH_BUCKETS,
+        )
+        self.batch_wait_seconds = self.registry.histogram(
+            "cloudstate_batch_wait_seconds",
+            "Time from the first command of a batch to the call of its handler.",
+            ("entity", "command"),
+        )
+        self.executor_queue_depth = self.registry.gauge(
+            "cloudstate_executor_queue_depth",
+            "Calls waiting for a thread of an executor.",
+            ("executor",),
+        )
+        self.executor_queue_seconds = self.registry.histogram(
+            "cloudstate_executor_queue_seconds",
+            "Time calls waited for a thread of an executor.",
+            ("executor",),
+        )
+        self.executor_busy_threads = self.registry.gauge(
+            "cloudstate_executor_busy_threads",
+            "Threads of an executor running a call.",
+            ("executor",),
+        )
+        self.executor_saturation = self.registry.gauge(
+            "cloudstate_executor_saturation",
+            "Share of the threads of an executor running a call, from 0 to 1.",
+            ("executor",),
+        )
+        self.executor_starved = self.registry.counter(
+            "cloudstate_executor_starved_total",
+            "Calls that waited for a thread of an executor for longer than the "
+            "starvation threshold.",
+            ("executor",),
+        )
+        self._commands: Dict[Tuple[str, str], CommandMetrics] = {}
+        self._entities: Dict[str, EntityMetrics] = {}
+
+    def command(self, entity: str, command: str) -> CommandMetrics:
+        key = (entity, command)
+        command_metrics = self._commands.get(key)
+        if command_metrics is None:
+            command_metrics = self._commands.setdefault(
+                key, CommandMetrics(self, entity, command)
+            )
+        return command_metrics
+
+    def entity(self, entity: str) -> EntityMetrics:
+        entity_metrics = self._entities.get(entity)
+        if entity_metrics is None:
+            entity_metrics = self._entities.setdefault(
+                entity, EntityMetrics(self, entity)
+            )
+        return entity_metrics
+
+    def monitor_executor(self, name: str, executor):
+        """Report the depth of the work queue of a concurrent.futures executor."""
+        work_queue = getattr(executor, "_work_queue", None)
+        if work_queue is not None:
+            self.executor_queue_depth.labels(name).set_function(work_queue.qsize)
+
+    def monitor_state_cache(self, state_cache):
+        self.state_cache_entries.labels().set_function(state_cache.__len__)
+        self.state_cache_bytes.labels().set_function(lambda: state_cache.bytes)
+
+
+METRICS = Metrics()
+
+
+def timed(function: Callable, histogram: HistogramValue) -> Callable:
+    """Wrap the given function of one argument to observe its duration."""
+
+    def timed_function(argument):
+        start = perf_counter()
+        try:
+            return function(argument)
+        finally:
+            histogram.observe(perf_counter() - start)
+
+    return timed_function
+
+
+class MetricsServer:
+    """Serves the exposition of a registry over HTTP on a background thread."""
+
+    def __init__(self, registry: Registry, host: str, port: int):
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry_.exposition().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.address = "{}:{}".format(*self.httpd.server_address[:2])
+
+    def start(self):
+        threading.Thread(
+            target=self.httpd.serve_forever, name="cloudstate-metrics", daemon=True
+        ).start()
+        logging.info("Serving Cloudstate metrics on http://%s/metrics", self.address)
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
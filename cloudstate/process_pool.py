@@ -0,0 +1,202 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Tuple
+
+from google.protobuf.any_pb2 import Any
+from google.protobuf.message import Message
+
+from cloudstate.action_context import ActionContext
+from cloudstate.contexts import Context
+from cloudstate.utils.handler_utils import HandlerPlan, Slot, compile_handler
+from cloudstate.utils.payload_utils import pack_into
+
+# What a handler run in a worker process did: the errors of its context, its reply
+# as a type URL and bytes, and its forward and side effects, serialized.
+Outcome = Tuple[List[str], Optional[Tuple[str, bytes]], Optional[bytes], List[bytes]]
+
+# The plans of the handlers run by this worker process.
+_plans: Dict[Callable, HandlerPlan] = {}
+
+
+def _warm():
+    return os.getpid()
+
+
+def run_handler(
+    function: Callable,
+    input_type: type,
+    command_name: str,
+    payload: bytes,
+    trace_context: list,
+) -> Outcome:
+    """Run a handler in a worker process, on the serialized command."""
+    plan = _plans.get(function)
+    if plan is None:
+        plan = _plans[function] = compile_handler(
+            function,
+            [
+                Slot("command", input_type, Message),
+                Slot("context", ActionContext, Context),
+            ],
+        )
+    ctx = ActionContext(command_name)
+    ctx.trace_context = trace_context
+    reply = None
+    try:
+        result = plan.invoke(input_type.FromString(payload), ctx)
+        if result is not None and not ctx.has_errors():
+            serialized = Any()
+            pack_into(serialized, result)
+            reply = (serialized.type_url, serialized.value)
+    except Exception as ex:
+        ctx.fail(str(ex))
+        logging.exception("Failed to execute command:" + str(ex))
+    return (
+        list(ctx.errors),
+        reply,
+        None if ctx.forward is None else ctx.forward.SerializeToString(),
+        [effect.SerializeToString() for effect in ctx.effects],
+    )
+
+
+def apply_outcome(ctx: ActionContext, outcome: Outcome):
+    """Carry what a handler did in a worker process over to the context of the
+    command, and return its reply, still serialized."""
+    errors, reply, forward, side_effects = outcome
+    for error in errors:
+        ctx.fail(error)
+    if forward is not None:
+        ctx.new_forward().MergeFromString(forward)
+    for side_effect in side_effects:
+        ctx.new_side_effect().MergeFromString(side_effect)
+    return reply
+
+
+class HandlerProcessPool:
+    """Worker processes running the handlers registered with executor="process",
+    out of the gRPC threads and the global interpreter lock of the user function.
+
+    Commands are shipped to the workers as bytes, along with a reference to the
+    handler, which is imported by its module. The workers are forked when the user
+    function starts, before its gRPC server. Should one die, they are started again
+    from a fork server, as forking the threads of the gRPC server is not safe: like
+    with spawn, the main module is imported again by the new workers. At most
+    max_queue commands are submitted at once, others fail right away."""
+
+    def __init__(self, workers: Optional[int] = None, max_queue: int = 0):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.configure(workers, max_queue)
+
+    def configure(self, workers: Optional[int] = None, max_queue: int = 0):
+        """Set the number of worker processes, the number of CPUs by default, and of
+        commands submitted at once, eight per worker by default."""
+        if self._executor is not None:
+            raise Exception("The handler worker processes are already started")
+        # How the worker processes are started.
+        self.context = multiprocessing.get_context("fork")
+        self.workers = workers or os.cpu_count()
+        self.max_queue = max_queue or 8 * self.workers
+        self._queue = threading.BoundedSemaphore(self.max_queue)
+
+    def divide(self, parts: int):
+        """Share the worker processes and the places of the queue between the given
+        number of processes, which each start their own pool."""
+        self.configure(max(1, self.workers // parts), max(1, self.max_queue // parts))
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        self.workers, mp_context=self.context
+                    )
+        return self._executor
+
+    def start(self):
+        """Fork the worker processes, and wait for them to be ready."""
+        executor = self.executor
+        pids = {
+            future.result()
+            for future in [executor.submit(_warm) for _ in range(self.workers)]
+        }
+        logging.info("Started %s handler worker processes", len(pids))
+
+    def submit(self, function: Callable, *args) -> Future:
+        if not self._queue.acquire(blocking=False):
+            raise Exception(
+                f"Cannot run {function}: all {self.max_queue} places of the queue of "
+                "the handler worker processes are taken"
+            )
+        try:
+            executor = self.executor
+            try:
+                future = executor.submit(function, *args)
+            except BrokenProcessPool:
+                self._restart(executor)
+                executor = self.executor
+                future = executor.submit(function, *args)
+        except BaseException:
+            self._queue.release()
+            raise
+
+        def done(future: Future):
+            self._queue.release()
+            if not future.cancelled() and isinstance(
+                future.exception(), BrokenProcessPool
+            ):
+                self._restart(executor)
+
+        future.add_done_callback(done)
+        return future
+
+    def _restart(self, broken: ProcessPoolExecutor):
+        """Replace the given executor, unless it was replaced already."""
+        with self._lock:
+            if self._executor is not broken:
+                return
+            self._executor = None
+            self.context = multiprocessing.get_context("forkserver")
+        logging.error("A handler worker process died, starting them again")
+        broken.shutdown(wait=False)
+
+    def submit_command(
+        self, function: Callable, input_type: type, ctx: ActionContext, payload: Any
+    ) -> Future:
+        """Submit the command to the handler, the outcome of which is to be applied
+        to its context."""
+        return self.submit(
+            run_handler,
+            function,
+            input_type,
+            ctx.command_name,
+            payload.value,
+            ctx.trace_context,
+        )
+
+    def run(
+        self, function: Callable, input_type: type, ctx: ActionContext, payload: Any
+    ):
+        """Run the handler in a worker process, and return its reply."""
+        return apply_outcome(
+            ctx, self.submit_command(function, input_type, ctx, payload).result()
+        )
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+PROCESS_POOL = HandlerProcessPool()
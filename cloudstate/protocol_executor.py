@@ -0,0 +1,109 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import logging
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from time import monotonic, perf_counter
+from typing import Callable, Dict, Optional
+
+from cloudstate.metrics import METRICS
+
+# Starvation is logged at most once per this many seconds for every pool.
+STARVATION_LOG_INTERVAL = 10.0
+
+
+class MonitoredPool:
+    """A thread pool recording how long calls wait for a thread, how many threads
+    are busy, and the calls which waited for longer than the starvation threshold,
+    logging a warning when they do."""
+
+    def __init__(self, name: str, workers: Optional[int], starvation: float):
+        if workers is not None and workers < 1:
+            raise Exception(f"Executor {name} needs at least one thread")
+        self.name = name
+        self.starvation = starvation
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix=name)
+        self.workers = self.executor._max_workers
+        self.queue_seconds = METRICS.executor_queue_seconds.labels(name)
+        self.busy = METRICS.executor_busy_threads.labels(name)
+        self.starved = METRICS.executor_starved.labels(name)
+        METRICS.executor_saturation.labels(name).set_function(
+            lambda: self.busy.get() / self.workers
+        )
+        METRICS.monitor_executor(name, self.executor)
+        self._logged = -STARVATION_LOG_INTERVAL
+
+    def submit(self, function: Callable, *args, **kwargs) -> Future:
+        submitted = perf_counter()
+
+        def run():
+            waited = perf_counter() - submitted
+            self.queue_seconds.observe(waited)
+            if waited > self.starvation:
+                self._starved(waited)
+            self.busy.inc()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.busy.dec()
+
+        return self.executor.submit(run)
+
+    def _starved(self, waited: float):
+        self.starved.inc()
+        now = monotonic()
+        if now - self._logged >= STARVATION_LOG_INTERVAL:
+            self._logged = now
+            logging.warning(
+                "A call waited %.3fs for one of the %s threads of executor %s, which "
+                "are all busy: give it more threads, or a dedicated executor to the "
+                "protocols holding them",
+                waited,
+                self.workers,
+                self.name,
+            )
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait)
+
+
+class ProtocolExecutor(Executor):
+    """The executor of the gRPC server, running the calls of every servicer on the
+    pool it is routed to, or on the default pool otherwise, so that long lived
+    streams of one protocol cannot take the threads of the others.
+
+    The server submits every call along with the servicer method handling it, on
+    which calls are routed."""
+
+    def __init__(self, default: MonitoredPool):
+        self.default = default
+        self.pools: Dict[str, MonitoredPool] = {default.name: default}
+        # The routes of the servicers by their id, as they need not be hashable,
+        # and the servicers, for their ids not to be reused.
+        self._routes: Dict[int, Dict[Optional[str], MonitoredPool]] = {}
+        self._servicers = []
+
+    def route(self, servicer, pool: MonitoredPool, method: Optional[str] = None):
+        """Run the calls of the given method of the servicer, or of all of its
+        methods without one, on the pool."""
+        self.pools.setdefault(pool.name, pool)
+        if id(servicer) not in self._routes:
+            self._servicers.append(servicer)
+        self._routes.setdefault(id(servicer), {})[method] = pool
+
+    def pool_of(self, args) -> MonitoredPool:
+        for arg in args:
+            routes = self._routes.get(id(getattr(arg, "__self__", None)))
+            if routes is not None:
+                pool = routes.get(arg.__name__) or routes.get(None)
+                return pool or self.default
+        return self.default
+
+    def submit(self, function: Callable, *args, **kwargs) -> Future:
+        return self.pool_of(args).submit(function, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True, **kwargs):
+        for pool in self.pools.values():
+            pool.shutdown(wait)
@@ -0,0 +1,117 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import abc
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import List
+
+
+@dataclass
+class SnapshotStats:
+    """What a stream knows of its entity since the last snapshot: the events
+    replayed or emitted since, how many bytes they take, and how long they took to
+    apply, which is what replaying them would cost on the next recovery."""
+
+    sequence_number: int = 0
+    events: int = 0
+    event_bytes: int = 0
+    replay_seconds: float = 0.0
+    emitted: int = 0
+    recovery_seconds: float = 0.0
+    last_snapshot: float = field(default_factory=monotonic)
+    snapshots: int = 0
+
+    @property
+    def dirty(self) -> bool:
+        """Whether the state may have changed since the last snapshot."""
+        return self.events > 0
+
+    def snapshotted(self):
+        self.events = 0
+        self.event_bytes = 0
+        self.replay_seconds = 0.0
+        self.last_snapshot = monotonic()
+        self.snapshots += 1
+
+
+class SnapshotPolicy(abc.ABC):
+    """Decides after a command whether to snapshot the entity. It is only asked
+    when the entity is dirty, so that an unchanged state is never snapshotted."""
+
+    @abc.abstractmethod
+    def should_snapshot(self, stats: SnapshotStats) -> bool:
+        pass
+
+    def __or__(self, other: "SnapshotPolicy") -> "SnapshotPolicy":
+        return AnyOf([self, other])
+
+
+@dataclass
+class EveryEvents(SnapshotPolicy):
+    """Snapshot when the sequence number of an emitted event is a multiple of the
+    given number of events, as snapshot_every does."""
+
+    events: int
+
+    def should_snapshot(self, stats: SnapshotStats) -> bool:
+        sequence_number = stats.sequence_number
+        return (
+            sequence_number // self.events
+            > (sequence_number - stats.emitted) // self.events
+        )
+
+
+@dataclass
+class EventBytes(SnapshotPolicy):
+    """Snapshot once the events since the last snapshot take the given bytes."""
+
+    max_bytes: int
+
+    def should_snapshot(self, stats: SnapshotStats) -> bool:
+        return stats.event_bytes >= self.max_bytes
+
+
+@dataclass
+class ReplayCost(SnapshotPolicy):
+    """Snapshot once applying the events since the last snapshot took the given
+    seconds, bounding the time to recover the entity."""
+
+    max_seconds: float
+
+    def should_snapshot(self, stats: SnapshotStats) -> bool:
+        return stats.replay_seconds >= self.max_seconds
+
+
+@dataclass
+class Interval(SnapshotPolicy):
+    """Snapshot a changed entity at most every given seconds."""
+
+    seconds: float
+
+    def should_snapshot(self, stats: SnapshotStats) -> bool:
+        return monotonic() - stats.last_snapshot >= self.seconds
+
+
+@dataclass
+class AfterSlowRecovery(SnapshotPolicy):
+    """Snapshot on the first command after a recovery which took the given seconds,
+    so that the next one does not replay the same events again."""
+
+    seconds: float
+
+    def should_snapshot(self, stats: SnapshotStats) -> bool:
+        return stats.snapshots == 0 and stats.recovery_seconds >= self.seconds
+
+
+@dataclass
+class AnyOf(SnapshotPolicy):
+    policies: List[SnapshotPolicy]
+
+    def should_snapshot(self, stats: SnapshotStats) -> bool:
+        return any(policy.should_snapshot(stats) for policy in self.policies)
+
+    def __or__(self, other: SnapshotPolicy) -> SnapshotPolicy:
+        return AnyOf(self.policies + [other])
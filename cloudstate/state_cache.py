@@ -0,0 +1,119 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import sys
+import threading
+import types
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Tuple
+
+from google.protobuf.message import Message
+
+from cloudstate.snapshot_policy import SnapshotStats
+
+
+def approximate_size(value: Any) -> int:
+    """The approximate memory taken by a value and what it references, counting
+    each object once. Protobuf messages count as their serialized size."""
+    seen = set()
+    pending = [value]
+    size = 0
+    while pending:
+        value = pending.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        if isinstance(value, Message):
+            size += sys.getsizeof(value) + value.ByteSize()
+            continue
+        size += sys.getsizeof(value)
+        if isinstance(value, (str, bytes, bytearray, int, float, type(None))):
+            continue
+        if isinstance(value, (type, types.ModuleType, types.FunctionType)):
+            continue
+        if isinstance(value, dict):
+            pending.extend(value.keys())
+            pending.extend(value.values())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            pending.extend(value)
+        if hasattr(value, "__dict__"):
+            pending.append(vars(value))
+        for slot in getattr(type(value), "__slots__", ()):
+            if hasattr(value, slot):
+                pending.append(getattr(value, slot))
+    return size
+
+
+@dataclass
+class CachedState:
+    state: Any
+    sequence_number: int
+    snapshot_stats: SnapshotStats
+    size: int
+
+
+class StateCache:
+    """The states of the entities whose streams ended, least recently used first,
+    bounded by the number of entries and by their approximate size in bytes.
+    An entry is taken out of the cache by the stream which reuses it, so a state is
+    never shared by two streams."""
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        max_bytes: Optional[int] = None,
+        size_of: Callable[[Any], int] = approximate_size,
+    ):
+        if max_entries < 1:
+            raise Exception("The state cache must hold at least one entry")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.entries: "OrderedDict[Tuple[str, str], CachedState]" = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def take(self, persistence_id: str, entity_id: str) -> Optional[CachedState]:
+        with self.lock:
+            entry = self.entries.pop((persistence_id, entity_id), None)
+            if entry is not None:
+                self.bytes -= entry.size
+            return entry
+
+    def store(
+        self,
+        persistence_id: str,
+        entity_id: str,
+        state: Any,
+        sequence_number: int,
+        snapshot_stats: SnapshotStats,
+    ):
+        self.put(
+            persistence_id,
+            entity_id,
+            CachedState(state, sequence_number, snapshot_stats, self.size_of(state)),
+        )
+
+    def put(self, persistence_id: str, entity_id: str, entry: CachedState):
+        if self.max_bytes is not None and entry.size > self.max_bytes:
+            return
+        key = (persistence_id, entity_id)
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous.size
+            self.entries[key] = entry
+            self.bytes += entry.size
+            while len(self.entries) > self.max_entries or (
+                self.max_bytes is not None and self.bytes > self.max_bytes
+            ):
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
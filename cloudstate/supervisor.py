@@ -0,0 +1,236 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import signal
+import threading
+import time
+from dataclasses import asdict, dataclass
+from multiprocessing.connection import wait
+from typing import Any, Callable, Dict, List, Optional
+
+# Workers that exit within this many seconds of starting are restarted with an
+# exponential backoff, from MIN_RESTART_DELAY up to MAX_RESTART_DELAY seconds.
+MIN_UPTIME = 5.0
+MIN_RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 30.0
+
+
+@dataclass
+class WorkerStats:
+    """What the supervisor knows about one worker process. Resource usage is
+    reported by the worker itself every stats interval."""
+
+    index: int
+    pid: int = 0
+    alive: bool = False
+    started_at: float = 0.0
+    restarts: int = 0
+    last_exit_code: Optional[int] = None
+    cpu_user_seconds: float = 0.0
+    cpu_system_seconds: float = 0.0
+    max_rss_kb: int = 0
+    reported_at: float = 0.0
+
+
+def _usage(index: int) -> Dict[str, Any]:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "index": index,
+        "cpu_user_seconds": usage.ru_utime,
+        "cpu_system_seconds": usage.ru_stime,
+        "max_rss_kb": usage.ru_maxrss,
+        "reported_at": time.time(),
+    }
+
+
+def _run_worker(
+    serve: Callable[[int], Any],
+    index: int,
+    stats_queue: multiprocessing.Queue,
+    stats_interval: float,
+    grace: float,
+):
+    # Interrupts are handled by the supervisor, which stops workers with SIGTERM.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server = serve(index)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop(grace))
+    parent = os.getppid()
+    while server.wait_for_termination(stats_interval):
+        if os.getppid() != parent:
+            logging.error("Supervisor of worker %s is gone, stopping", index)
+            server.stop(grace).wait()
+            break
+        stats_queue.put(_usage(index))
+
+
+class WorkerSupervisor:
+    """Pre-forks worker processes that each run their own gRPC server bound to the
+    same port with SO_REUSEPORT, letting the kernel balance connections between
+    them. Workers that exit while the supervisor is running are restarted.
+    serve is called in each worker with its index, and returns its started server.
+
+    Mimics the part of the grpc.Server API returned by CloudState.start()."""
+
+    def __init__(
+        self,
+        serve: Callable[[int], Any],
+        processes: int,
+        stats_interval: float = 5.0,
+        grace: float = 5.0,
+    ):
+        self.serve = serve
+        self.processes = processes
+        self.stats_interval = stats_interval
+        self.grace = grace
+        self._context = multiprocessing.get_context("fork")
+        self._stats_queue = self._context.Queue()
+        self._workers: Dict[int, multiprocessing.Process] = {}
+        self._stats = {index: WorkerStats(index) for index in range(processes)}
+        self._restart_at: Dict[int, float] = {}
+        self._restart_delay = {index: MIN_RESTART_DELAY for index in range(processes)}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._terminated = threading.Event()
+
+    def start(self):
+        for index in range(self.processes):
+            self._spawn(index)
+        threading.Thread(
+            target=self._monitor, name="cloudstate-supervisor", daemon=True
+        ).start()
+        # Workers must not outlive the supervisor.
+        atexit.register(self.stop, self.grace)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(
+                signal.SIGTERM,
+                lambda signum, frame: threading.Thread(
+                    target=self.stop, args=(self.grace,)
+                ).start(),
+            )
+        return self
+
+    def stop(self, grace: Optional[float] = None) -> threading.Event:
+        """Stop all the workers, killing those still running after the grace
+        period."""
+        if self._terminated.is_set():
+            return self._terminated
+        self._stopping.set()
+        with self._lock:
+            workers = list(self._workers.values())
+        for process in workers:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + (grace or 0)
+        for process in workers:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self._terminated.set()
+        return self._terminated
+
+    def wait_for_termination(self, timeout: Optional[float] = None) -> bool:
+        """Block until the supervisor is stopped. Returns True on timeout, like
+        grpc.Server.wait_for_termination."""
+        return not self._terminated.wait(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-worker stats, along with their aggregate over all workers."""
+        self._drain_stats()
+        with self._lock:
+            workers: List[Dict[str, Any]] = [
+                asdict(stats) for stats in self._stats.values()
+            ]
+        return {
+            "workers": workers,
+            "alive": sum(1 for worker in workers if worker["alive"]),
+            "restarts": sum(worker["restarts"] for worker in workers),
+            "cpu_user_seconds": sum(worker["cpu_user_seconds"] for worker in workers),
+            "cpu_system_seconds": sum(
+                worker["cpu_system_seconds"] for worker in workers
+            ),
+            "max_rss_kb": sum(worker["max_rss_kb"] for worker in workers),
+        }
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=_run_worker,
+            args=(
+                self.serve,
+                index,
+                self._stats_queue,
+                self.stats_interval,
+                self.grace,
+            ),
+            name=f"cloudstate-worker-{index}",
+        )
+        process.start()
+        logging.info("Started Cloudstate worker %s with pid %s", index, process.pid)
+        with self._lock:
+            self._workers[index] = process
+            stats = self._stats[index]
+            stats.pid = process.pid
+            stats.alive = True
+            stats.started_at = time.time()
+
+    def _monitor(self):
+        while not self._stopping.is_set():
+            with self._lock:
+                sentinels = {
+                    process.sentinel: index
+                    for index, process in self._workers.items()
+                    if index not in self._restart_at
+                }
+            for sentinel in wait(list(sentinels), timeout=1.0):
+                self._exited(sentinels[sentinel])
+            now = time.monotonic()
+            for index, restart_at in list(self._restart_at.items()):
+                if restart_at <= now and not self._stopping.is_set():
+                    del self._restart_at[index]
+                    self._spawn(index)
+            self._drain_stats()
+
+    def _exited(self, index: int):
+        process = self._workers[index]
+        process.join()
+        with self._lock:
+            stats = self._stats[index]
+            stats.alive = False
+            stats.last_exit_code = process.exitcode
+            uptime = time.time() - stats.started_at
+        if self._stopping.is_set():
+            return
+        if uptime < MIN_UPTIME:
+            delay = self._restart_delay[index]
+            self._restart_delay[index] = min(delay * 2, MAX_RESTART_DELAY)
+        else:
+            delay = self._restart_delay[index] = MIN_RESTART_DELAY
+        logging.error(
+            "Cloudstate worker %s (pid %s) exited with code %s, restarting in %ss",
+            index,
+            process.pid,
+            process.exitcode,
+            delay,
+        )
+        with self._lock:
+            stats.restarts += 1
+        self._restart_at[index] = time.monotonic() + delay
+
+    def _drain_stats(self):
+        while True:
+            try:
+                report = self._stats_queue.get_nowait()
+            except queue.Empty:
+                return
+            with self._lock:
+                stats = self._stats[report.pop("index")]
+                for name, value in report.items():
+                    setattr(stats, name, value)
@@ -0,0 +1,344 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import asyncio
+import socket
+from typing import AsyncIterator, Iterator
+
+import grpc
+import pytest
+from google.protobuf.any_pb2 import Any
+from google.protobuf.empty_pb2 import Empty
+
+# Discovery includes these files, which the demo protos do not import.
+import cloudstate.eventing_pb2  # noqa: F401
+import google.api.httpbody_pb2  # noqa: F401
+
+from cloudstate.action_context import ActionContext
+from cloudstate.action_pb2 import ActionCommand
+from cloudstate.action_pb2_grpc import ActionProtocolStub
+from cloudstate.action_protocol_entity import Action
+from cloudstate.cloudstate import CloudState
+from cloudstate.entity_pb2 import Command, ProxyInfo
+from cloudstate.entity_pb2_grpc import EntityDiscoveryStub
+from cloudstate.event_sourced_context import EventSourcedCommandContext
+from cloudstate.event_sourced_entity import EventSourcedEntity
+from cloudstate.event_sourced_pb2 import EventSourcedInit, EventSourcedStreamIn
+from cloudstate.event_sourced_pb2_grpc import EventSourcedStub
+from cloudstate.test.actiondemo.action_definition import definition, definition2
+from cloudstate.test.actiondemo.actiondemo2_pb2 import (
+    FunctionRequest2,
+    FunctionResponse2,
+)
+from cloudstate.test.actiondemo.actiondemo_pb2 import _ACTIONDEMO
+from cloudstate.test.actiondemo.actiondemo_pb2 import DESCRIPTOR as FILE_DESCRIPTOR
+from cloudstate.test.actiondemo.actiondemo_pb2 import (
+    AddToSum,
+    FunctionRequest,
+    FunctionResponse,
+    SumTotal,
+)
+from cloudstate.test.shoppingcart.persistence.domain_pb2 import ItemAdded
+from cloudstate.test.shoppingcart.shopping_cart_entity import entity
+from cloudstate.test.shoppingcart.shopping_cart_entity import (
+    to_domain_line_item,
+)
+from cloudstate.test.shoppingcart.shoppingcart_pb2 import _SHOPPINGCART
+from cloudstate.test.shoppingcart.shoppingcart_pb2 import (
+    DESCRIPTOR as CART_FILE_DESCRIPTOR,
+)
+from cloudstate.test.shoppingcart.shoppingcart_pb2 import (
+    AddLineItem,
+    Cart,
+    GetShoppingCart,
+)
+
+asynchronous = Action(_ACTIONDEMO, [FILE_DESCRIPTOR])
+
+
+@asynchronous.unary_handler("ReverseString")
+async def reverse_string(request: FunctionRequest, ctx: ActionContext):
+    await asyncio.sleep(0)
+    if request.foo == "boom":
+        ctx.fail("Intentionally failed.")
+    elif request.foo == "raise":
+        raise Exception("Intentionally raised.")
+    else:
+        return FunctionResponse(bar=request.foo[::-1])
+
+
+@asynchronous.stream_handler("ReverseStrings")
+async def reverse_strings(requests: AsyncIterator, ctx: ActionContext):
+    async for request in requests:
+        if request.foo == "raise":
+            raise Exception("Intentionally raised.")
+        yield FunctionResponse(bar=request.foo[::-1])
+
+
+@asynchronous.stream_in_handler("SumStream")
+async def sum_stream(additions: AsyncIterator, ctx: ActionContext):
+    total = 0
+    async for addition in additions:
+        if addition.quantity < 0:
+            raise Exception("Intentionally raised.")
+        total += addition.quantity
+    return SumTotal(total=total)
+
+
+@asynchronous.stream_out_handler("SillyLetterStream")
+async def letters(request: FunctionRequest, ctx: ActionContext):
+    for letter in request.foo:
+        if letter == "!":
+            raise Exception("Intentionally raised.")
+        yield FunctionResponse(bar=letter)
+
+
+asynchronous_cart = EventSourcedEntity(
+    _SHOPPINGCART, [CART_FILE_DESCRIPTOR], lambda entity_id: {}
+)
+
+
+@asynchronous_cart.event_handler(ItemAdded)
+def item_added(state: dict, event: ItemAdded):
+    state[event.item.productId] = event.item.quantity
+
+
+@asynchronous_cart.command_handler("AddItem")
+async def add_item(item: AddLineItem, ctx: EventSourcedCommandContext):
+    await asyncio.sleep(0)
+    if item.quantity <= 0:
+        raise Exception("Intentionally raised.")
+    ctx.emit(ItemAdded(item=to_domain_line_item(item)))
+    return Empty()
+
+
+@asynchronous_cart.command_handler("GetCart")
+async def get_cart(state: dict, request: GetShoppingCart):
+    cart = Cart()
+    for product_id, quantity in sorted(state.items()):
+        cart.items.add(product_id=product_id, quantity=quantity)
+    return cart
+
+
+def packed(message) -> Any:
+    payload = Any()
+    payload.Pack(message)
+    return payload
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def serve(actions, event_sourced_entities, scenario):
+    """Run the scenario against the user function served by start_async() on a
+    real port, with a channel to it."""
+
+    async def run():
+        port = free_port()
+        user_function = CloudState().host("127.0.0.1").port(str(port))
+        for action in actions:
+            user_function.register_action_entity(action)
+        for event_sourced_entity in event_sourced_entities:
+            user_function.register_event_sourced_entity(event_sourced_entity)
+        server = await user_function.start_async()
+        try:
+            async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+                return await scenario(channel)
+        finally:
+            await server.stop(None)
+
+    return asyncio.run(run())
+
+
+def unary(action: Action, name: str, message) -> ActionCommand:
+    return ActionCommand(service_name=action.name(), name=name, payload=packed(message))
+
+
+async def stream(action: Action, name: str, messages):
+    # The first message only names the command.
+    yield ActionCommand(service_name=action.name(), name=name)
+    for message in messages:
+        yield ActionCommand(payload=packed(message))
+
+
+def reply(response, message_type):
+    return message_type.FromString(response.reply.payload.value)
+
+
+def test_serves_sync_and_async_unary_handlers():
+    async def scenario(channel):
+        stub = ActionProtocolStub(channel)
+        replies = await asyncio.gather(
+            *[
+                stub.handleUnary(unary(asynchronous, "ReverseString", request))
+                for request in [FunctionRequest(foo=f"ab{n}") for n in range(10)]
+            ]
+        )
+        assert [reply(r, FunctionResponse).bar for r in replies] == [
+            f"{n}ba" for n in range(10)
+        ]
+        response = await stub.handleUnary(
+            unary(definition2, "ReverseString2", FunctionRequest2(foo="ab"))
+        )
+        assert reply(response, FunctionResponse2).bar == "ba!"
+        for foo in ["boom", "raise"]:
+            response = await stub.handleUnary(
+                unary(asynchronous, "ReverseString", FunctionRequest(foo=foo))
+            )
+            assert response.WhichOneof("response") == "failure"
+        response = await stub.handleUnary(
+            unary(definition2, "ReverseString2", FunctionRequest2(foo="boom"))
+        )
+        assert "Intentionally failed." in response.failure.description
+        spec = await EntityDiscoveryStub(channel).discover(ProxyInfo())
+        assert {e.service_name for e in spec.entities} == {
+            asynchronous.name(),
+            definition2.name(),
+        }
+
+    serve([asynchronous, definition2], [], scenario)
+
+
+def test_serves_async_stream_handlers():
+    async def scenario(channel):
+        stub = ActionProtocolStub(channel)
+        foos = [FunctionRequest(foo=foo) for foo in ["ab", "cd"]]
+        responses = [
+            r
+            async for r in stub.handleStreamed(
+                stream(asynchronous, "ReverseStrings", foos)
+            )
+        ]
+        assert [reply(r, FunctionResponse).bar for r in responses] == ["ba", "dc"]
+        response = await stub.handleStreamedIn(
+            stream(asynchronous, "SumStream", [AddToSum(quantity=n) for n in range(4)])
+        )
+        assert reply(response, SumTotal).total == 6
+        responses = [
+            r
+            async for r in stub.handleStreamedOut(
+                unary(asynchronous, "SillyLetterStream", FunctionRequest(foo="abc"))
+            )
+        ]
+        assert [reply(r, FunctionResponse).bar for r in responses] == list("abc")
+
+        # Handlers raising end their stream, after the replies sent before.
+        foos = [FunctionRequest(foo=foo) for foo in ["ab", "raise", "cd"]]
+        responses = [
+            r
+            async for r in stub.handleStreamed(
+                stream(asynchronous, "ReverseStrings", foos)
+            )
+        ]
+        assert [reply(r, FunctionResponse).bar for r in responses] == ["ba"]
+        response = await stub.handleStreamedIn(
+            stream(asynchronous, "SumStream", [AddToSum(quantity=-1)])
+        )
+        assert "Intentionally raised." in response.failure.description
+        responses = [
+            r
+            async for r in stub.handleStreamedOut(
+                unary(asynchronous, "SillyLetterStream", FunctionRequest(foo="a!b"))
+            )
+        ]
+        assert [reply(r, FunctionResponse).bar for r in responses] == ["a"]
+
+    serve([asynchronous], [], scenario)
+
+
+def test_serves_sync_stream_handlers():
+    async def scenario(channel):
+        stub = ActionProtocolStub(channel)
+        foos = [FunctionRequest(foo=foo) for foo in ["ab", "boom"]]
+        responses = [
+            r
+            async for r in stub.handleStreamed(
+                stream(definition, "ReverseStrings", foos)
+            )
+        ]
+        assert reply(responses[0], FunctionResponse).bar == "ba"
+        assert "Intentionally failed." in responses[1].failure.description
+        response = await stub.handleStreamedIn(
+            stream(definition, "SumStream", [AddToSum(quantity=n) for n in range(4)])
+        )
+        assert reply(response, SumTotal).total == 6
+        response = await stub.handleStreamedIn(
+            stream(definition, "SumStream", [AddToSum(quantity=-1)])
+        )
+        assert "Intentionally failed." in response.failure.description
+        responses = [
+            r
+            async for r in stub.handleStreamedOut(
+                unary(definition, "SillyLetterStream", FunctionRequest(foo="ab"))
+            )
+        ]
+        assert [reply(r, FunctionResponse).bar for r in responses] == ["a!!", "b!!"]
+
+    serve([definition], [], scenario)
+
+
+def test_refuses_streams_of_unknown_services():
+    async def scenario(channel):
+        stub = ActionProtocolStub(channel)
+        unknown = Action(_ACTIONDEMO, [FILE_DESCRIPTOR])
+        unknown.service_descriptor = definition2.service_descriptor
+        with pytest.raises(grpc.aio.AioRpcError) as error:
+            async for _ in stub.handleStreamed(stream(unknown, "ReverseStrings", [])):
+                pass
+        assert error.value.code() == grpc.StatusCode.UNIMPLEMENTED
+
+    serve([definition], [], scenario)
+
+
+def cart_stream(*commands: Iterator[Command]):
+    async def requests():
+        yield EventSourcedStreamIn(
+            init=EventSourcedInit(service_name=entity.name(), entity_id="cart")
+        )
+        for command in commands:
+            yield EventSourcedStreamIn(command=command)
+
+    return requests()
+
+
+def add(id: int, quantity: int) -> Command:
+    return Command(
+        entity_id="cart",
+        id=id,
+        name="AddItem",
+        payload=packed(AddLineItem(product_id="beer", name="Beer", quantity=quantity)),
+    )
+
+
+def get(id: int) -> Command:
+    return Command(
+        entity_id="cart", id=id, name="GetCart", payload=packed(GetShoppingCart())
+    )
+
+
+@pytest.mark.parametrize("cart_entity", [entity, asynchronous_cart])
+def test_serves_event_sourced_streams(cart_entity):
+    async def scenario(channel):
+        stub = EventSourcedStub(channel)
+        responses = [
+            r async for r in stub.handle(cart_stream(add(1, 2), add(2, 0), get(3)))
+        ]
+        first, failed, cart = [r.reply for r in responses]
+        assert len(first.events) == 1
+        assert failed.client_action.failure.command_id == 2
+        assert [item.quantity for item in reply(cart.client_action, Cart).items] == [2]
+
+        # Commands before the initialization of the stream fail it.
+        async def uninitialized():
+            yield EventSourcedStreamIn(command=get(1))
+
+        with pytest.raises(grpc.aio.AioRpcError):
+            async for _ in stub.handle(uninitialized()):
+                pass
+
+    serve([], [cart_entity], scenario)
@@ -0,0 +1,60 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+from concurrent import futures
+
+import grpc
+import pytest
+
+# Discovery includes these files, which the demo protos do not import.
+import cloudstate.eventing_pb2  # noqa: F401
+import google.api.httpbody_pb2  # noqa: F401
+
+from cloudstate.action_pb2_grpc import add_ActionProtocolServicer_to_server
+from cloudstate.action_servicer import CloudStateActionProtocolServicer
+from cloudstate.bench.load import ACTION_SERVICE, CART_SERVICE, discover
+from cloudstate.bench.load import parse_mix, run_load
+from cloudstate.discovery_servicer import CloudStateEntityDiscoveryServicer
+from cloudstate.entity_pb2_grpc import add_EntityDiscoveryServicer_to_server
+from cloudstate.event_sourced_pb2_grpc import add_EventSourcedServicer_to_server
+from cloudstate.eventsourced_servicer import CloudStateEventSourcedServicer
+from cloudstate.test.actiondemo.action_definition import definition
+from cloudstate.test.shoppingcart.shopping_cart_entity import entity
+
+
+@pytest.fixture
+def target():
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
+    add_EntityDiscoveryServicer_to_server(
+        CloudStateEntityDiscoveryServicer([entity], [definition]), server
+    )
+    add_EventSourcedServicer_to_server(CloudStateEventSourcedServicer([entity]), server)
+    add_ActionProtocolServicer_to_server(
+        CloudStateActionProtocolServicer([definition]), server
+    )
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    yield f"127.0.0.1:{port}"
+    server.stop(None)
+
+
+def test_parses_mixes():
+    assert parse_mix("cart.add=3, action.unary") == [
+        ("cart.add", 3.0),
+        ("action.unary", 1.0),
+    ]
+    with pytest.raises(ValueError):
+        parse_mix("cart.checkout=1")
+
+
+def test_drives_every_operation(target):
+    with grpc.insecure_channel(target) as channel:
+        assert {CART_SERVICE, ACTION_SERVICE} <= set(discover(channel))
+    mix = parse_mix("cart.add,cart.get,cart.remove,action.unary,action.streamed")
+    results = run_load(target, mix, concurrency=2, rate=0, duration=0.5, warmup=0.1)
+    assert results["total"]["errors"] == 0
+    for name, summary in results["operations"].items():
+        assert summary["count"] > 0, name
+        assert summary["failures"] == 0, name
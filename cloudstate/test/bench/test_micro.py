@@ -0,0 +1,42 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+from cloudstate.bench.micro import compare, run_all
+from cloudstate.bench.stats import latency_summary, percentile
+
+
+def test_percentiles_use_nearest_rank():
+    samples = list(range(1, 1001))
+    assert percentile(samples, 0.5) == 500
+    assert percentile(samples, 0.999) == 999
+    assert percentile([], 0.5) == 0.0
+    assert latency_summary([0.001, 0.002])["max_us"] == 2000
+
+
+def test_runs_every_benchmark():
+    results = run_all(size=20, repeat=1)
+    assert set(results["results"]) == {
+        "eventsourced_commands",
+        "eventsourced_replay",
+        "action_unary",
+        "action_streamed",
+        "action_streamed_in",
+    }
+    commands = results["results"]["eventsourced_commands"]
+    assert commands["operations"] == 20 and commands["steps"] == 20
+    assert commands["throughput"] > 0
+
+
+def test_flags_regressions_beyond_threshold():
+    baseline = {
+        "version": "1",
+        "results": {"bench": {"throughput": 1000.0, "p99_us": 10.0}},
+    }
+    current = {
+        "version": "2",
+        "results": {"bench": {"throughput": 850.0, "p99_us": 10.5}},
+    }
+    _, regressions = compare(baseline, current, threshold=0.1)
+    assert regressions == ["bench throughput -15.0%"]
@@ -0,0 +1,12 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+from cloudstate.bench.startup import run_startup
+
+
+def test_imports_no_protocol_before_starting():
+    results = run_startup(repeat=1)
+    assert not results["grpc_imported"]
+    assert results["import_ms"] > 0 and results["start_ms"] > 0
@@ -0,0 +1,151 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+from concurrent import futures
+
+import grpc
+import pytest
+from google.protobuf.any_pb2 import Any
+
+# Discovery includes these files, which the demo protos do not import.
+import cloudstate.eventing_pb2  # noqa: F401
+import google.api.httpbody_pb2  # noqa: F401
+
+from cloudstate.action_pb2_grpc import add_ActionProtocolServicer_to_server
+from cloudstate.action_servicer import CloudStateActionProtocolServicer
+from cloudstate.discovery_servicer import CloudStateEntityDiscoveryServicer
+from cloudstate.emulator.journal import FileJournal, InMemoryJournal
+from cloudstate.emulator.proxy import ProxyEmulator
+from cloudstate.entity_pb2_grpc import add_EntityDiscoveryServicer_to_server
+from cloudstate.event_sourced_pb2 import EventSourcedEvent, EventSourcedSnapshot
+from cloudstate.event_sourced_pb2_grpc import add_EventSourcedServicer_to_server
+from cloudstate.eventsourced_servicer import CloudStateEventSourcedServicer
+from cloudstate.test.actiondemo.action_definition import definition
+from cloudstate.test.actiondemo.actiondemo_pb2 import AddToSum, FunctionRequest
+from cloudstate.test.actiondemo.actiondemo_pb2_grpc import ActionDemoStub
+from cloudstate.test.shoppingcart.shopping_cart_entity import entity
+from cloudstate.test.shoppingcart.shoppingcart_pb2 import (
+    AddLineItem,
+    GetShoppingCart,
+)
+from cloudstate.test.shoppingcart.shoppingcart_pb2_grpc import ShoppingCartStub
+
+
+def event(sequence: int, value: bytes = b"") -> EventSourcedEvent:
+    return EventSourcedEvent(
+        sequence=sequence, payload=Any(type_url="type.googleapis.com/E", value=value)
+    )
+
+
+@pytest.fixture
+def user_function():
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
+    add_EntityDiscoveryServicer_to_server(
+        CloudStateEntityDiscoveryServicer([entity], [definition]), server
+    )
+    add_EventSourcedServicer_to_server(CloudStateEventSourcedServicer([entity]), server)
+    add_ActionProtocolServicer_to_server(
+        CloudStateActionProtocolServicer([definition]), server
+    )
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    yield f"127.0.0.1:{port}"
+    server.stop(None)
+
+
+def emulate(user_function, journal, passivation_timeout=0.0) -> ProxyEmulator:
+    return ProxyEmulator(
+        user_function,
+        journal,
+        passivation_timeout=passivation_timeout,
+        host="127.0.0.1",
+        port=0,
+    ).start()
+
+
+def test_loads_events_after_the_snapshot():
+    journal = InMemoryJournal()
+    journal.persist("p", "1", [event(1), event(2)])
+    journal.persist("p", "1", [event(3)], EventSourcedSnapshot(snapshot_sequence=3))
+    journal.persist("p", "1", [event(4)])
+    snapshot, events = journal.load("p", "1")
+    assert snapshot.snapshot_sequence == 3
+    assert [e.sequence for e in events] == [4]
+    assert journal.load("p", "2") == (None, [])
+    with pytest.raises(Exception):
+        journal.persist("p", "1", [event(6)])
+
+
+def test_file_journal_survives_a_torn_write(tmp_path):
+    path = str(tmp_path / "journal")
+    journal = FileJournal(path)
+    journal.persist("p", "1", [event(1, b"a"), event(2, b"b")])
+    journal.persist(
+        "p", "2", [event(1, b"c")], EventSourcedSnapshot(snapshot_sequence=1)
+    )
+    journal.close()
+    with open(path, "ab") as f:
+        f.write(b"\x01\x00")
+    journal = FileJournal(path)
+    assert [e.payload.value for e in journal.load("p", "1")[1]] == [b"a", b"b"]
+    assert journal.load("p", "2")[0].snapshot_sequence == 1
+    journal.persist("p", "1", [event(3, b"d")])
+    journal.close()
+    assert FileJournal(path).sequence("p", "1") == 3
+
+
+def test_replays_the_journal_on_reactivation(user_function, tmp_path):
+    path = str(tmp_path / "journal")
+    emulator = emulate(user_function, FileJournal(path))
+    try:
+        with grpc.insecure_channel(f"127.0.0.1:{emulator.port}") as channel:
+            cart = ShoppingCartStub(channel)
+            for product in ["a", "b", "a"]:
+                cart.AddItem(
+                    AddLineItem(
+                        user_id="u", product_id=product, name=product, quantity=1
+                    )
+                )
+            assert emulator.passivate(entity.name(), "u")
+            items = cart.GetCart(GetShoppingCart(user_id="u")).items
+            assert {item.product_id: item.quantity for item in items} == {
+                "a": 2,
+                "b": 1,
+            }
+            with pytest.raises(grpc.RpcError) as failure:
+                cart.AddItem(AddLineItem(user_id="u", product_id="c", quantity=-1))
+            assert "Cannot add negative quantity" in failure.value.details()
+    finally:
+        emulator.stop()
+    assert emulator.stats()["replayed_events"] == 3
+
+    emulator = emulate(user_function, FileJournal(path), passivation_timeout=0.05)
+    try:
+        with grpc.insecure_channel(f"127.0.0.1:{emulator.port}") as channel:
+            items = (
+                ShoppingCartStub(channel).GetCart(GetShoppingCart(user_id="u")).items
+            )
+            assert len(items) == 2
+    finally:
+        emulator.stop()
+    assert emulator.stats()["replayed_events"] == 3
+
+
+def test_routes_actions(user_function):
+    emulator = emulate(user_function, InMemoryJournal())
+    try:
+        with grpc.insecure_channel(f"127.0.0.1:{emulator.port}") as channel:
+            demo = ActionDemoStub(channel)
+            assert demo.ReverseString(FunctionRequest(foo="abc")).bar == "cba"
+            replies = demo.ReverseStrings(
+                iter([FunctionRequest(foo="ab"), FunctionRequest(foo="cd")])
+            )
+            assert [reply.bar for reply in replies] == ["ba", "dc"]
+            total = demo.SumStream(iter([AddToSum(quantity=1), AddToSum(quantity=2)]))
+            assert total.total == 3
+            with pytest.raises(grpc.RpcError):
+                demo.ReverseString(FunctionRequest(foo="boom"))
+    finally:
+        emulator.stop()
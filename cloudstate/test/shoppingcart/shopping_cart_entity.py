@@ -50,7 +50,7 @@ def to_domain_line_item(item):
 @entity.snapshot()
 def snapshot(state: ShoppingCartState):
     cart = DomainCart()
-    cart.items = [to_domain_line_item(item) for item in state.cart.values()]
+    cart.items.extend([to_domain_line_item(item) for item in state.cart.values()])
     return cart
 
 
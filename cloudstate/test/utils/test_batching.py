@@ -0,0 +1,97 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from google.protobuf.any_pb2 import Any
+
+from cloudstate.action_context import ActionContext
+from cloudstate.action_pb2 import ActionCommand
+from cloudstate.action_protocol_entity import Action
+from cloudstate.action_servicer import CloudStateActionProtocolServicer
+from cloudstate.aio.action_servicer import (
+    CloudStateActionProtocolServicer as AsyncActionProtocolServicer,
+)
+from cloudstate.test.actiondemo.action_definition import definition
+from cloudstate.test.actiondemo.actiondemo_pb2 import FunctionRequest, FunctionResponse
+
+action = Action(definition.service_descriptor, definition.file_descriptors)
+batches = []
+
+
+@action.batch_unary_handler("ReverseString", max_batch=4, max_wait_ms=200)
+def reverse_strings(
+    requests: List[FunctionRequest], contexts: List[ActionContext]
+) -> List[FunctionResponse]:
+    batches.append(len(requests))
+    if any(request.foo == "explode" for request in requests):
+        raise Exception("Exploded")
+    replies = []
+    for request, ctx in zip(requests, contexts):
+        if request.foo == "boom":
+            ctx.fail("Intentionally failed.")
+        replies.append(FunctionResponse(bar=request.foo[::-1]))
+    return replies
+
+
+def command(foo: str) -> ActionCommand:
+    payload = Any()
+    payload.Pack(FunctionRequest(foo=foo))
+    return ActionCommand(
+        service_name=action.name(), name="ReverseString", payload=payload
+    )
+
+
+def reply(response) -> str:
+    return FunctionResponse.FromString(response.reply.payload.value).bar
+
+
+def call_concurrently(foos: List[str]):
+    servicer = CloudStateActionProtocolServicer([action])
+    with ThreadPoolExecutor(len(foos)) as executor:
+        return list(
+            executor.map(lambda foo: servicer.handleUnary(command(foo), None), foos)
+        )
+
+
+def test_handles_concurrent_commands_in_batches():
+    batches.clear()
+    responses = call_concurrently(["a1", "b2", "c3", "d4", "e5"])
+    assert [reply(response) for response in responses] == [
+        "1a",
+        "2b",
+        "3c",
+        "4d",
+        "5e",
+    ]
+    # A full batch, and the remaining command once its wait is over.
+    assert sorted(batches) == [1, 4]
+
+
+def test_fails_commands_separately():
+    responses = call_concurrently(["ok", "boom"])
+    assert reply(responses[0]) == "ko"
+    assert "Intentionally failed." in responses[1].failure.description
+
+
+def test_fails_the_whole_batch_when_the_handler_raises():
+    responses = call_concurrently(["ok", "explode"])
+    assert all("Exploded" in response.failure.description for response in responses)
+
+
+def test_handles_batches_on_the_event_loop():
+    batches.clear()
+    servicer = AsyncActionProtocolServicer([action])
+
+    async def call_all():
+        return await asyncio.gather(
+            *[servicer.handleUnary(command(foo), None) for foo in ["ab", "cd"]]
+        )
+
+    responses = asyncio.run(call_all())
+    assert [reply(response) for response in responses] == ["ba", "dc"]
+    assert batches == [2]
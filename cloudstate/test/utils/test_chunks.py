@@ -0,0 +1,164 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import asyncio
+import time
+from typing import Iterator, List
+
+import pytest
+from google.protobuf.any_pb2 import Any
+
+from cloudstate.action_context import ActionContext
+from cloudstate.action_pb2 import ActionCommand
+from cloudstate.action_protocol_entity import Action
+from cloudstate.action_servicer import CloudStateActionProtocolServicer
+from cloudstate.aio.action_servicer import (
+    CloudStateActionProtocolServicer as AsyncActionProtocolServicer,
+)
+from cloudstate.test.actiondemo.action_definition import definition
+from cloudstate.test.actiondemo.actiondemo_pb2 import (
+    AddToSum,
+    FunctionRequest,
+    FunctionResponse,
+    SumTotal,
+)
+from cloudstate.utils.chunks import Chunks, chunked
+
+
+def test_counted_chunks():
+    assert list(chunked(range(7), Chunks(size=3))) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(chunked(range(6), Chunks(size=3, every=2))) == [
+        [0, 1, 2],
+        [2, 3, 4],
+        [3, 4, 5],
+    ]
+
+
+def test_timed_chunks():
+    def elements():
+        yield from range(3)
+        time.sleep(0.2)
+        yield from range(3, 5)
+
+    assert list(chunked(elements(), Chunks(ms=100))) == [[0, 1, 2], [3, 4]]
+    assert list(chunked(elements(), Chunks(size=2, ms=100))) == [
+        [0, 1],
+        [2],
+        [3, 4],
+    ]
+
+
+def test_sliding_timed_chunks():
+    def elements():
+        for element in range(4):
+            yield element
+            time.sleep(0.1)
+
+    chunks = list(chunked(elements(), Chunks(ms=150, every=100)))
+    # Every chunk holds the elements of the last 150ms.
+    assert all(1 <= len(chunk) <= 2 for chunk in chunks)
+    assert chunks[-1][-1] == 3
+
+
+def test_invalid_chunks():
+    with pytest.raises(Exception, match="needs a size or a time"):
+        Chunks()
+    with pytest.raises(Exception, match="either counted or timed"):
+        Chunks(size=2, ms=10, every=1)
+
+
+def test_raises_the_failures_of_the_stream():
+    def elements():
+        yield 1
+        raise Exception("Broken stream")
+
+    with pytest.raises(Exception, match="Broken stream"):
+        list(chunked(elements(), Chunks(ms=100)))
+
+
+class RequestIterator:
+    def __init__(self, requests):
+        self._requests = iter(requests)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._requests)
+
+    next = __next__
+
+
+def requests(name: str, messages) -> List[ActionCommand]:
+    commands = [ActionCommand(service_name=definition.name(), name=name)]
+    for message in messages:
+        payload = Any()
+        payload.Pack(message)
+        commands.append(ActionCommand(payload=payload))
+    return commands
+
+
+action = Action(definition.service_descriptor, definition.file_descriptors)
+
+
+@action.stream_in_handler("SumStream", chunks=Chunks(size=4))
+def sum_chunks(chunks: Iterator[List[AddToSum]], ctx: ActionContext) -> SumTotal:
+    return SumTotal(total=sum(sum(add.quantity for add in chunk) for chunk in chunks))
+
+
+@action.stream_handler("ReverseStrings", chunks=Chunks(size=2), reply_per_chunk=True)
+def join_chunk(chunk: List[FunctionRequest], ctx: ActionContext) -> FunctionResponse:
+    return FunctionResponse(bar="".join(request.foo for request in chunk)[::-1])
+
+
+def test_handles_stream_in_chunks():
+    servicer = CloudStateActionProtocolServicer([action])
+    response = servicer.handleStreamedIn(
+        RequestIterator(
+            requests("SumStream", [AddToSum(quantity=n) for n in range(10)])
+        ),
+        None,
+    )
+    assert SumTotal.FromString(response.reply.payload.value).total == 45
+
+
+def test_replies_per_chunk():
+    servicer = CloudStateActionProtocolServicer([action])
+    responses = servicer.handleStreamed(
+        RequestIterator(
+            requests("ReverseStrings", [FunctionRequest(foo=foo) for foo in "abcde"])
+        ),
+        None,
+    )
+    assert [
+        FunctionResponse.FromString(response.reply.payload.value).bar
+        for response in responses
+    ] == ["ba", "dc", "e"]
+
+
+def test_handles_chunks_on_the_event_loop():
+    servicer = AsyncActionProtocolServicer([action])
+
+    async def stream(commands):
+        for command in commands:
+            yield command
+
+    async def call():
+        replies = [
+            FunctionResponse.FromString(response.reply.payload.value).bar
+            async for response in servicer.handleStreamed(
+                stream(
+                    requests("ReverseStrings", [FunctionRequest(foo=f) for f in "abc"])
+                ),
+                None,
+            )
+        ]
+        total = await servicer.handleStreamedIn(
+            stream(requests("SumStream", [AddToSum(quantity=n) for n in range(5)])),
+            None,
+        )
+        return replies, SumTotal.FromString(total.reply.payload.value).total
+
+    assert asyncio.run(call()) == (["ba", "c"], 10)
@@ -0,0 +1,215 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import asyncio
+from typing import Iterator
+
+import pytest
+from google.protobuf.any_pb2 import Any
+
+from cloudstate.action_context import ActionContext
+from cloudstate.action_pb2 import ActionCommand, ActionResponse
+from cloudstate.action_protocol_entity import Action
+from cloudstate.action_servicer import (
+    CloudStateActionProtocolServicer,
+    create_action_response,
+)
+from cloudstate.aio.action_servicer import (
+    CloudStateActionProtocolServicer as AsyncActionProtocolServicer,
+)
+from cloudstate.entity_pb2 import Forward, SideEffect
+from cloudstate.event_sourced_context import EventContext, EventSourcedCommandContext
+from cloudstate.test.actiondemo.action_definition import definition
+from cloudstate.test.actiondemo.actiondemo_pb2 import FunctionRequest, FunctionResponse
+from cloudstate.utils.payload_utils import type_url
+
+
+def test_allocates_lists_on_first_use():
+    ctx = EventSourcedCommandContext("AddItem", 1, "cart", 0)
+    assert not ctx.has_errors()
+    assert (ctx.events, ctx.errors, ctx.effects) == ([], [], [])
+    ctx.emit("a")
+    ctx.emit("b")
+    ctx.fail("failed")
+    ctx.side_effect("Other", "Effect", FunctionRequest(foo="bar"))
+    assert ctx.events == ["a", "b"]
+    assert ctx.errors == ["failed"] and ctx.has_errors()
+    assert len(ctx.effects) == 1
+
+
+def test_contexts_have_no_instance_dictionary():
+    for ctx in [ActionContext("Command"), EventContext("cart", 1)]:
+        assert not hasattr(ctx, "__dict__")
+        with pytest.raises(AttributeError):
+            ctx.unknown = True
+
+
+def test_compares_and_shows_contexts_by_their_slots():
+    assert EventContext("cart", 1) == EventContext("cart", 1)
+    assert EventContext("cart", 1) != EventContext("cart", 2)
+    assert repr(EventContext("cart", 1)) == (
+        "EventContext(entity_id='cart', sequence_number=1)"
+    )
+
+
+def test_writes_the_response_in_place():
+    response = ActionResponse()
+    ctx = ActionContext("Command", response, response.side_effects)
+    ctx.side_effect("Other", "Effect", FunctionRequest(foo="bar"))
+    assert ctx.write_client_action(FunctionRequest(foo="reply"), False)
+    assert response.WhichOneof("response") == "reply"
+    assert response.reply.payload.type_url == type_url(FunctionRequest)
+    assert FunctionRequest.FromString(response.reply.payload.value).foo == "reply"
+    assert [effect.command_name for effect in response.side_effects] == ["Effect"]
+
+
+def test_writes_the_last_forward_only():
+    response = ActionResponse()
+    ctx = ActionContext("Command", response, response.side_effects)
+    ctx.forward_to("Other", "First", FunctionRequest(foo="first"))
+    ctx.forward_to("Other", "Second", FunctionRequest(foo="second"))
+    assert ctx.write_client_action(None, False)
+    assert response.forward.command_name == "Second"
+    with pytest.raises(Exception):
+        ctx.write_client_action(FunctionRequest(foo="reply"), False)
+
+
+def test_writes_forwards_assigned_by_handlers():
+    def forward() -> Forward:
+        return Forward(service_name="Other", command_name="Assigned")
+
+    response = ActionResponse()
+    ctx = ActionContext("Command", response, response.side_effects)
+    ctx.forward = forward()
+    response = create_action_response(ctx, None)
+    assert response.WhichOneof("response") == "forward"
+    assert response.forward.command_name == "Assigned"
+    # Contexts of streamed responses, and of event sourced commands.
+    ctx = ActionContext("Command")
+    ctx.forward = forward()
+    assert create_action_response(ctx, None).forward.command_name == "Assigned"
+    ctx = EventSourcedCommandContext("AddItem", 1, "cart", 0)
+    ctx.forward = forward()
+    assert ctx.create_client_action(None, False).forward.command_name == "Assigned"
+
+
+def test_drops_the_side_effects_of_failed_commands():
+    response = ActionResponse()
+    ctx = ActionContext("Command", response, response.side_effects)
+    ctx.side_effect("Other", "Effect", FunctionRequest(foo="bar"))
+    ctx.fail("failed")
+    assert ctx.write_client_action(FunctionRequest(foo="reply"), False)
+    assert response.WhichOneof("response") == "failure"
+    assert not response.side_effects
+
+
+def test_handlers_may_append_to_the_lists_of_their_context():
+    ctx = ActionContext("Command")
+    ctx.effects.append(SideEffect(service_name="Other", command_name="Effect"))
+    ctx.errors.append("failed")
+    assert ctx.has_errors() and len(ctx.effects) == 1
+    response = ActionResponse()
+    ctx = ActionContext("Command", response, response.side_effects)
+    ctx.effects.append(SideEffect(service_name="Other", command_name="Effect"))
+    assert [effect.command_name for effect in response.side_effects] == ["Effect"]
+
+
+streamed = Action(definition.service_descriptor, definition.file_descriptors)
+
+
+@streamed.stream_handler("ReverseStrings")
+def reverse_strings(
+    requests: Iterator[FunctionRequest], ctx: ActionContext
+) -> Iterator[FunctionResponse]:
+    for request in requests:
+        if request.foo == "boom":
+            ctx.errors.append("Appended failure.")
+        ctx.effects.append(SideEffect(service_name="Other", command_name=request.foo))
+        yield FunctionResponse(bar=request.foo[::-1])
+
+
+@streamed.stream_out_handler("SillyLetterStream")
+def letters(request: FunctionRequest, ctx: ActionContext) -> Iterator[FunctionResponse]:
+    ctx.effects.append(SideEffect(service_name="Other", command_name="Letters"))
+    for letter in request.foo:
+        yield FunctionResponse(bar=letter)
+
+
+class RequestIterator:
+    def __init__(self, requests):
+        self._requests = iter(requests)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._requests)
+
+    next = __next__
+
+
+def command(name: str, foo: str = None) -> ActionCommand:
+    payload = Any()
+    if foo is not None:
+        payload.Pack(FunctionRequest(foo=foo))
+    return ActionCommand(service_name=streamed.name(), name=name, payload=payload)
+
+
+def stream_requests():
+    return [command("ReverseStrings")] + [
+        command("ReverseStrings", foo) for foo in ["ab", "boom"]
+    ]
+
+
+def check_streamed(responses):
+    assert FunctionResponse.FromString(responses[0].reply.payload.value).bar == "ba"
+    assert [effect.command_name for effect in responses[0].side_effects] == ["ab"]
+    assert responses[1].failure.description == "['Appended failure.']"
+
+
+def check_streamed_out(responses):
+    assert [
+        FunctionResponse.FromString(response.reply.payload.value).bar
+        for response in responses
+    ] == ["a", "b"]
+    assert [effect.command_name for effect in responses[0].side_effects] == ["Letters"]
+
+
+def test_streamed_handlers_may_append_to_the_lists_of_their_context():
+    servicer = CloudStateActionProtocolServicer([streamed])
+    check_streamed(
+        list(servicer.handleStreamed(RequestIterator(stream_requests()), None))
+    )
+    check_streamed_out(
+        list(servicer.handleStreamedOut(command("SillyLetterStream", "ab"), None))
+    )
+
+
+def test_asyncio_streamed_handlers_may_append_to_the_lists_of_their_context():
+    servicer = AsyncActionProtocolServicer([streamed])
+
+    async def stream(requests):
+        for request in requests:
+            yield request
+
+    async def call():
+        check_streamed(
+            [
+                response
+                async for response in servicer.handleStreamed(
+                    stream(stream_requests()), None
+                )
+            ]
+        )
+        check_streamed_out(
+            [
+                response
+                async for response in servicer.handleStreamedOut(
+                    command("SillyLetterStream", "ab"), None
+                )
+            ]
+        )
+
+    asyncio.run(call())
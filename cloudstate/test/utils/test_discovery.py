@@ -0,0 +1,81 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+from google.protobuf.descriptor_pb2 import FileDescriptorSet
+
+from cloudstate.discovery_servicer import (
+    CloudStateEntityDiscoveryServicer,
+    add_entity_discovery_to_server,
+    descriptor_closure,
+)
+from cloudstate.entity_pb2 import EntitySpec, ProxyInfo, UserFunctionError
+from cloudstate.entity_pb2_grpc import EntityDiscoveryStub
+from cloudstate.test.actiondemo.action_definition import definition, definition2
+from cloudstate.test.shoppingcart.shopping_cart_entity import entity
+
+
+def test_serves_the_spec_built_once():
+    discovery = CloudStateEntityDiscoveryServicer([entity], [])
+    spec = discovery.discover(ProxyInfo(proxy_name="test"), None)
+    assert discovery.discover(ProxyInfo(proxy_name="test"), None) is spec
+    assert [e.service_name for e in spec.entities] == [entity.name()]
+
+
+def test_rebuilds_the_spec_of_entities_registered_later():
+    event_sourced_entities = [entity]
+    discovery = CloudStateEntityDiscoveryServicer(event_sourced_entities, [])
+    spec = discovery.entity_spec()
+    event_sourced_entities.append(entity)
+    rebuilt = discovery.entity_spec()
+    assert rebuilt is not spec and len(rebuilt.entities) == 2
+    assert discovery.entity_spec() is rebuilt
+
+
+def test_rebuilds_the_spec_of_entities_replaced_later():
+    action_protocol_entities = [definition]
+    discovery = CloudStateEntityDiscoveryServicer([], action_protocol_entities)
+    serialized = discovery.serialized_entity_spec()
+    assert discovery.serialized_entity_spec() is serialized
+    action_protocol_entities[0] = definition2
+    spec = EntitySpec.FromString(discovery.serialized_entity_spec())
+    assert [e.service_name for e in spec.entities] == [definition2.name()]
+    assert discovery.entity_spec() == spec
+
+
+def test_serves_the_spec_serialized_once():
+    discovery = CloudStateEntityDiscoveryServicer([entity], [definition])
+    server = grpc.server(ThreadPoolExecutor(1))
+    add_entity_discovery_to_server(discovery, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    try:
+        with grpc.insecure_channel(f"127.0.0.1:{port}") as channel:
+            stub = EntityDiscoveryStub(channel)
+            spec = stub.discover(ProxyInfo(proxy_name="test"), timeout=5)
+            stub.reportError(UserFunctionError(message="test"), timeout=5)
+    finally:
+        server.stop(None)
+    assert spec == discovery.entity_spec()
+    assert spec.SerializeToString() == discovery.serialized_entity_spec()
+
+
+def test_sends_each_imported_file_once_after_its_imports():
+    discovery = CloudStateEntityDiscoveryServicer([entity, entity], [])
+    names = [
+        file.name
+        for file in FileDescriptorSet.FromString(discovery.entity_spec().proto).file
+    ]
+    assert len(names) == len(set(names))
+    assert entity.service_descriptor.file.name in names
+    for file in entity.file_descriptors:
+        assert file.name in names
+    for file in descriptor_closure([entity.service_descriptor.file]):
+        for dependency in file.dependencies:
+            assert names.index(dependency.name) < names.index(file.name)
+    # Imported transitively, through google/api/annotations.proto.
+    assert "google/api/http.proto" in names
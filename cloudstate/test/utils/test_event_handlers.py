@@ -0,0 +1,202 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import pytest
+from google.protobuf.any_pb2 import Any
+from google.protobuf.empty_pb2 import Empty
+from google.protobuf.message import Message
+
+from cloudstate.entity_pb2 import Command
+from cloudstate.event_sourced_context import EventContext, EventSourcedCommandContext
+from cloudstate.event_sourced_entity import EventSourcedEntity, EventSourcedHandler
+from cloudstate.event_sourced_pb2 import (
+    EventSourcedEvent,
+    EventSourcedInit,
+    EventSourcedReply,
+)
+from cloudstate.eventsourced_servicer import EventSourcedStream
+from cloudstate.test.shoppingcart.persistence.domain_pb2 import (
+    ItemAdded,
+    ItemRemoved,
+    LineItem,
+)
+from cloudstate.test.shoppingcart.shoppingcart_pb2 import (
+    _SHOPPINGCART,
+    AddLineItem,
+    Cart,
+    GetShoppingCart,
+)
+from cloudstate.test.shoppingcart.shoppingcart_pb2 import DESCRIPTOR as FILE_DESCRIPTOR
+from cloudstate.utils.payload_utils import pack_into, type_url
+
+
+def cart_entity() -> EventSourcedEntity:
+    return EventSourcedEntity(_SHOPPINGCART, [FILE_DESCRIPTOR], lambda entity_id: [])
+
+
+def test_resolves_handlers_by_method_resolution_order():
+    entity = cart_entity()
+
+    @entity.event_handler(ItemAdded)
+    def item_added(state: list, event: ItemAdded):
+        state.append("added")
+
+    @entity.event_handler(Message)
+    def any_event(state: list, event: Message):
+        state.append("other")
+
+    handler = EventSourcedHandler(entity)
+    state = []
+    handler.handle_event(state, ItemAdded(), None)
+    handler.handle_event(state, ItemRemoved(), None)
+    assert state == ["added", "other"]
+    assert entity.resolved_event_handler_plans == {
+        ItemAdded: entity.event_handler_plans[ItemAdded],
+        ItemRemoved: entity.event_handler_plans[Message],
+    }
+
+
+def test_refuses_handlers_of_instances():
+    with pytest.raises(Exception):
+
+        @cart_entity().event_handler(ItemAdded())
+        def item_added(state: list, event: ItemAdded):
+            pass
+
+
+def test_refuses_events_without_handler_when_emitted():
+    entity = cart_entity()
+
+    @entity.event_handler(ItemAdded)
+    def item_added(state: list, event: ItemAdded):
+        pass
+
+    ctx = EventSourcedCommandContext(
+        "RemoveItem", 1, "cart", 0, entity.event_handler_plan
+    )
+    ctx.emit(ItemAdded())
+    with pytest.raises(Exception, match="no event handler"):
+        ctx.emit(ItemRemoved())
+    assert len(ctx.events) == 1
+    assert entity.resolved_event_handler_plans[ItemRemoved] is None
+
+
+def test_emits_serialized_events_without_encoding_them_again():
+    entity = cart_entity()
+
+    @entity.event_handler(ItemAdded)
+    def item_added(state: list, event: ItemAdded):
+        state.append(event.item.productId)
+
+    reply = EventSourcedReply()
+    ctx = EventSourcedCommandContext(
+        "AddItem",
+        1,
+        "cart",
+        0,
+        entity.event_handler_plan,
+        reply.client_action,
+        reply.side_effects,
+        entity.type_registry,
+    )
+    value = ItemAdded(item=LineItem(productId="beer")).SerializeToString()
+    ctx.emit((type_url(ItemAdded), value))
+    state = []
+    EventSourcedHandler(entity).handle_event(state, ctx.events[0], None)
+    assert state == ["beer"]
+    pack_into(reply.events.add(), ctx.events[0])
+    assert reply.events[0].value == value
+    with pytest.raises(Exception, match="no event handler"):
+        ctx.emit((type_url(ItemRemoved), b""))
+
+
+def test_gives_every_event_emitted_its_own_context():
+    entity = cart_entity()
+
+    @entity.command_handler("AddItem")
+    def add_item(item: AddLineItem, ctx: EventSourcedCommandContext):
+        for _ in range(item.quantity):
+            ctx.emit(ItemAdded(item=LineItem(productId=item.product_id)))
+        return Empty()
+
+    contexts = []
+
+    @entity.event_handler(ItemAdded)
+    def item_added(event: ItemAdded, ctx: EventContext):
+        contexts.append(ctx)
+
+    stream = EventSourcedStream({entity.name(): entity})
+    stream.init(EventSourcedInit(service_name=entity.name(), entity_id="cart"))
+    payload = Any()
+    payload.Pack(AddLineItem(product_id="beer", quantity=2))
+    stream.handle_command(
+        Command(entity_id="cart", id=1, name="AddItem", payload=payload)
+    )
+    assert [ctx.sequence_number for ctx in contexts] == [1, 2]
+
+
+class Recorded(list):
+    """The state of the bulk cart entity: the products of every batch of replayed
+    events with the sequence number of its context, and the commands handled."""
+
+
+def bulk_cart_entity(max_batch: int):
+    entity = EventSourcedEntity(
+        _SHOPPINGCART, [FILE_DESCRIPTOR], lambda entity_id: Recorded()
+    )
+
+    @entity.bulk_event_handler(max_batch)
+    def items_added(state: Recorded, events: list, ctx: EventContext):
+        products = [event.item.productId for event in events]
+        state.append((products, ctx.sequence_number))
+
+    @entity.command_handler("GetCart")
+    def get_cart(state: Recorded):
+        state.append("GetCart")
+        return Cart()
+
+    return entity
+
+
+def replay(entity: EventSourcedEntity, events: int) -> EventSourcedStream:
+    stream = EventSourcedStream({entity.name(): entity})
+    stream.init(EventSourcedInit(service_name=entity.name(), entity_id="cart"))
+    for sequence in range(1, events + 1):
+        payload = Any()
+        payload.Pack(ItemAdded(item=LineItem(productId=str(sequence))))
+        stream.apply_event(EventSourcedEvent(sequence=sequence, payload=payload))
+    return stream
+
+
+def get_cart(stream: EventSourcedStream):
+    payload = Any()
+    payload.Pack(GetShoppingCart())
+    stream.handle_command(
+        Command(entity_id="cart", id=1, name="GetCart", payload=payload)
+    )
+
+
+def test_flushes_replayed_events_once_a_batch_is_full():
+    stream = replay(bulk_cart_entity(max_batch=2), 5)
+    assert stream.current_state == [(["1", "2"], 2), (["3", "4"], 4)]
+
+
+def test_flushes_pending_events_before_the_first_command():
+    stream = replay(bulk_cart_entity(max_batch=2), 3)
+    get_cart(stream)
+    get_cart(stream)
+    assert stream.current_state == [
+        (["1", "2"], 2),
+        (["3"], 3),
+        "GetCart",
+        "GetCart",
+    ]
+
+
+def test_flushes_partial_batches_once_recovered():
+    stream = replay(bulk_cart_entity(max_batch=1000), 3)
+    assert stream.current_state == []
+    stream.close()
+    assert stream.current_state == [(["1", "2", "3"], 3)]
@@ -0,0 +1,145 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+from typing import Iterator
+
+import pytest
+from google.protobuf.message import Message
+
+from cloudstate.action_context import ActionContext
+from cloudstate.contexts import Context
+from cloudstate.event_sourced_context import EventContext, EventSourcedCommandContext
+from cloudstate.event_sourced_entity import EventSourcedEntity
+from cloudstate.test.shoppingcart.persistence.domain_pb2 import Cart as DomainCart
+from cloudstate.test.shoppingcart.shopping_cart_entity import ShoppingCartState
+from cloudstate.test.shoppingcart.shopping_cart_entity import entity as cart_entity
+from cloudstate.test.shoppingcart.shoppingcart_pb2 import DESCRIPTOR as FILE_DESCRIPTOR
+from cloudstate.test.shoppingcart.shoppingcart_pb2 import (
+    _SHOPPINGCART,
+    AddLineItem,
+    RemoveLineItem,
+)
+from cloudstate.utils.handler_utils import Slot, compile_handler
+
+SLOTS = [
+    Slot("state", ShoppingCartState),
+    Slot("command", AddLineItem),
+    Slot("context", EventSourcedCommandContext),
+]
+
+
+def test_binds_parameters_by_annotation():
+    def handler(ctx: EventSourcedCommandContext, item: AddLineItem):
+        return ctx, item
+
+    plan = compile_handler(handler, SLOTS)
+    assert plan.indices == (2, 1)
+    assert plan.invoke("state", "item", "ctx") == ("ctx", "item")
+
+
+def test_calls_function_directly_when_parameters_match_slots():
+    def handler(
+        state: ShoppingCartState, item: AddLineItem, ctx: EventSourcedCommandContext
+    ):
+        pass
+
+    assert compile_handler(handler, SLOTS).invoke is handler
+
+
+def test_untyped_slot_is_matched_by_elimination():
+    def handler(commands: Iterator[AddLineItem], ctx: ActionContext):
+        return commands
+
+    plan = compile_handler(handler, [Slot("commands"), Slot("context", ActionContext)])
+    assert plan.invoke("commands", "ctx") == "commands"
+
+
+def test_rejects_missing_annotation():
+    def handler(state, item: AddLineItem):
+        pass
+
+    with pytest.raises(Exception, match="Missing type annotation"):
+        compile_handler(handler, SLOTS)
+
+
+def test_rejects_unmatched_parameter():
+    def handler(item: AddLineItem, other: AddLineItem):
+        pass
+
+    with pytest.raises(Exception, match="No matching value"):
+        compile_handler(handler, SLOTS)
+
+
+def test_rejects_parameters_of_other_types_than_their_slot():
+    slots = [
+        Slot("state"),
+        Slot("command", AddLineItem, Message),
+        Slot("context", EventSourcedCommandContext, Context),
+    ]
+
+    def wrong_command(item: RemoveLineItem):
+        pass
+
+    def wrong_context(item: AddLineItem, ctx: ActionContext):
+        pass
+
+    for handler in [wrong_command, wrong_context]:
+        # Rather than being matched with the state by elimination.
+        with pytest.raises(Exception, match="No matching value"):
+            compile_handler(handler, slots)
+
+    def handler(state: dict, item: AddLineItem):
+        return state
+
+    assert compile_handler(handler, slots).indices == (0, 1)
+
+
+def test_rejects_command_handlers_of_other_commands_at_registration():
+    entity = EventSourcedEntity(_SHOPPINGCART, [FILE_DESCRIPTOR], lambda id: {})
+    with pytest.raises(Exception, match="No matching value"):
+
+        @entity.command_handler("AddItem")
+        def add_item(item: RemoveLineItem):
+            pass
+
+
+def test_shopping_cart_plans():
+    assert cart_entity.command_handler_plans["GetCart"].indices == (0, 1, 2)
+    assert cart_entity.command_handler_plans["AddItem"].indices == (1, 2)
+    assert cart_entity.snapshot_plan.indices == (0,)
+    assert cart_entity.snapshot_handler_plan.indices == (0, 1)
+
+
+def test_binds_snapshots_by_type_whatever_the_order_of_parameters():
+    entity = EventSourcedEntity(
+        _SHOPPINGCART, [FILE_DESCRIPTOR], lambda id: ShoppingCartState(id, {})
+    )
+
+    @entity.snapshot_handler()
+    def handle_snapshot(snapshot: DomainCart, state: ShoppingCartState):
+        return snapshot, state
+
+    assert entity.snapshot_handler_plan.indices == (1, 0)
+    assert entity.snapshot_handler_plan.invoke("state", "snapshot", "ctx") == (
+        "snapshot",
+        "state",
+    )
+
+
+def test_rejects_snapshot_handlers_of_other_contexts():
+    entity = EventSourcedEntity(_SHOPPINGCART, [FILE_DESCRIPTOR], lambda id: {})
+    with pytest.raises(Exception, match="No matching value"):
+
+        @entity.snapshot_handler()
+        def handle_snapshot(snapshot: DomainCart, ctx: EventContext):
+            pass
+
+
+def test_rejects_unknown_command_at_registration():
+    with pytest.raises(Exception, match="unknown command"):
+
+        @cart_entity.command_handler("Checkout")
+        def checkout(item: AddLineItem):
+            pass
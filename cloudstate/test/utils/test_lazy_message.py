@@ -0,0 +1,49 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+from google.protobuf.any_pb2 import Any
+
+from cloudstate.test.shoppingcart.shoppingcart_pb2 import AddLineItem, Cart, LineItem
+from cloudstate.utils.lazy_message import LazyMessage
+from cloudstate.utils.payload_utils import pack_into, type_url
+
+
+def lazy(message) -> LazyMessage:
+    return LazyMessage(type(message), type_url(message), message.SerializeToString())
+
+
+def test_parses_on_first_access():
+    message = lazy(AddLineItem(product_id="beer", quantity=6))
+    assert not message.decoded
+    assert isinstance(message, AddLineItem)
+    assert message.quantity == 6
+    assert message.decoded and message.pristine
+
+
+def test_packs_original_bytes_when_unmodified():
+    # Not a canonical encoding: the bytes are reused rather than re-encoded.
+    value = LineItem(quantity=1).SerializeToString() + b"\x18\x02"
+    message = LazyMessage(LineItem, type_url(LineItem), value)
+    assert message.quantity == 2
+    target = Any()
+    pack_into(target, message)
+    assert target.value == value
+
+
+def test_packs_modifications():
+    message = lazy(AddLineItem(product_id="beer", quantity=6))
+    message.quantity = 12
+    assert not message.pristine
+    target = Any()
+    pack_into(target, message)
+    assert target.Is(AddLineItem.DESCRIPTOR)
+    assert AddLineItem.FromString(target.value).quantity == 12
+
+
+def test_composite_access_counts_as_modification():
+    message = lazy(Cart(items=[LineItem(product_id="beer")]))
+    message.items.add(product_id="wine")
+    assert not message.pristine
+    assert len(Cart.FromString(message.SerializeToString()).items) == 2
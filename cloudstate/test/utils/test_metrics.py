@@ -0,0 +1,62 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+from urllib.request import urlopen
+
+from cloudstate.metrics import Metrics, MetricsServer, Registry
+
+
+def test_exposes_histograms_cumulatively():
+    registry = Registry()
+    histogram = registry.histogram("latency_seconds", "Latency.", ("stage",), (1, 2))
+    value = histogram.labels("decode")
+    for observed in [0.5, 1.5, 3]:
+        value.observe(observed)
+    exposition = registry.exposition()
+    assert 'latency_seconds_bucket{stage="decode",le="1"} 1' in exposition
+    assert 'latency_seconds_bucket{stage="decode",le="2"} 2' in exposition
+    assert 'latency_seconds_bucket{stage="decode",le="+Inf"} 3' in exposition
+    assert 'latency_seconds_sum{stage="decode"} 5' in exposition
+    assert 'latency_seconds_count{stage="decode"} 3' in exposition
+
+
+def test_escapes_label_values():
+    registry = Registry()
+    registry.counter("failures_total", "Failures.", ("command",)).labels('a"b').inc()
+    assert 'failures_total{command="a\\"b"} 1' in registry.exposition()
+
+
+def test_collects_gauge_functions():
+    registry = Registry()
+    registry.gauge("depth", "Depth.").labels().set_function(lambda: 7)
+    assert "depth 7" in registry.exposition()
+
+
+def test_caches_command_metrics():
+    metrics = Metrics()
+    command_metrics = metrics.command("Cart", "AddItem")
+    assert metrics.command("Cart", "AddItem") is command_metrics
+    command_metrics.handler.observe(0.01)
+    command_metrics.failures.inc()
+    exposition = metrics.registry.exposition()
+    assert (
+        'cloudstate_command_stage_seconds_count{entity="Cart",command="AddItem",'
+        'stage="handler"} 1' in exposition
+    )
+    assert (
+        'cloudstate_command_failures_total{entity="Cart",command="AddItem"} 1'
+        in exposition
+    )
+
+
+def test_serves_exposition():
+    registry = Registry()
+    registry.counter("requests_total", "Requests.").labels().inc(2)
+    server = MetricsServer(registry, "127.0.0.1", 0).start()
+    try:
+        with urlopen(f"http://{server.address}/metrics") as response:
+            assert b"requests_total 2" in response.read()
+    finally:
+        server.stop()
@@ -0,0 +1,104 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import random
+import threading
+import time
+from queue import SimpleQueue
+
+from google.protobuf.any_pb2 import Any
+
+from cloudstate.action_context import ActionContext
+from cloudstate.action_pb2 import ActionCommand
+from cloudstate.action_protocol_entity import Action
+from cloudstate.action_servicer import CloudStateActionProtocolServicer
+from cloudstate.test.actiondemo.action_definition import definition
+from cloudstate.test.actiondemo.actiondemo_pb2 import FunctionRequest, FunctionResponse
+from cloudstate.utils.ordered_pool import OrderedPool
+
+
+class RequestIterator:
+    def __init__(self, requests):
+        self._requests = iter(requests)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._requests)
+
+    next = __next__
+
+
+def test_yields_results_in_order_with_a_bounded_window():
+    pool = OrderedPool(4, 6)
+    lock = threading.Lock()
+    in_flight = []
+    most = []
+
+    def elements():
+        for element in range(50):
+            with lock:
+                in_flight.append(element)
+                most.append(len(in_flight))
+            yield element
+
+    def handle(element):
+        time.sleep(random.random() / 1000)
+        return element * 2
+
+    results = []
+    for result in pool.map(handle, elements()):
+        with lock:
+            in_flight.remove(result // 2)
+        results.append(result)
+    assert results == [element * 2 for element in range(50)]
+    assert max(most) <= pool.window + 1
+
+
+def test_yields_results_while_awaiting_the_next_element():
+    # Each element is only sent once the reply to the previous one is received.
+    replies = SimpleQueue()
+
+    def elements():
+        for element in range(5):
+            yield element
+            assert replies.get(timeout=5) == element
+
+    for result in OrderedPool(2).map(lambda element: element, elements()):
+        replies.put(result)
+
+
+def test_handles_stream_elements_concurrently():
+    action = Action(definition.service_descriptor, definition.file_descriptors)
+    threads = set()
+
+    @action.stream_handler("ReverseStrings", parallelism=4)
+    def reverse(element: FunctionRequest, ctx: ActionContext) -> FunctionResponse:
+        threads.add(threading.current_thread().name)
+        time.sleep(random.random() / 1000)
+        if element.foo == "boom":
+            ctx.fail("Intentionally failed.")
+        elif element.foo:
+            return FunctionResponse(bar=element.foo[::-1])
+
+    def command(foo: str) -> ActionCommand:
+        payload = Any()
+        payload.Pack(FunctionRequest(foo=foo))
+        return ActionCommand(payload=payload)
+
+    foos = [f"request {number}" for number in range(20)] + ["", "boom", "last"]
+    requests = [ActionCommand(service_name=action.name(), name="ReverseStrings")]
+    requests.extend(command(foo) for foo in foos)
+    servicer = CloudStateActionProtocolServicer([action])
+    responses = list(servicer.handleStreamed(RequestIterator(requests), None))
+    replies = [
+        FunctionResponse.FromString(response.reply.payload.value).bar
+        for response in responses
+        if response.HasField("reply")
+    ]
+    assert replies == [foo[::-1] for foo in foos if foo and foo != "boom"]
+    assert responses[-2].failure.description == "['Intentionally failed.']"
+    assert len(threads) > 1
@@ -0,0 +1,66 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import pytest
+from google.protobuf.any_pb2 import Any
+
+from cloudstate.test.shoppingcart.persistence.domain_pb2 import Cart as DomainCart
+from cloudstate.test.shoppingcart.persistence.domain_pb2 import ItemAdded
+from cloudstate.test.shoppingcart.shopping_cart_entity import entity
+from cloudstate.test.shoppingcart.shoppingcart_pb2 import AddLineItem
+from cloudstate.utils.payload_utils import pack_into, type_url
+
+
+def pack(message) -> Any:
+    payload = Any()
+    payload.Pack(message)
+    return payload
+
+
+def test_registry_is_built_from_descriptors():
+    registry = entity.type_registry
+    assert registry.input_types["AddItem"] is AddLineItem
+    assert registry.classes[type_url(AddLineItem)] is AddLineItem
+    # registered along with its event handler
+    assert registry.classes[type_url(ItemAdded)] is ItemAdded
+
+
+def test_decode():
+    registry = entity.type_registry
+    item = AddLineItem(user_id="user", product_id="beer", quantity=6)
+    assert registry.decode(pack(item)) == item
+    cart = DomainCart()
+    assert registry.decode(pack(cart)) == cart
+    assert type_url(DomainCart) in registry.classes
+
+
+def test_method_decoder():
+    decode = entity.type_registry.method_decoder("AddItem")
+    item = AddLineItem(user_id="user", product_id="beer", quantity=6)
+    assert decode(pack(item)) == item
+
+
+def test_unknown_type():
+    payload = Any(type_url="type.googleapis.com/com.example.Unknown")
+    with pytest.raises(Exception, match="Unknown payload type"):
+        entity.type_registry.decode(payload)
+
+
+def test_packs_serialized_payloads_as_they_are():
+    item = AddLineItem(user_id="user", product_id="beer", quantity=6)
+    url, value = type_url(AddLineItem), item.SerializeToString()
+    for payload in [pack(item), (url, value), (url, memoryview(value))]:
+        target = Any()
+        pack_into(target, payload)
+        assert (target.type_url, target.value) == (url, value)
+
+
+def test_wraps_serialized_payloads_lazily():
+    item = AddLineItem(user_id="user", product_id="beer", quantity=6)
+    message = entity.type_registry.wrap_serialized(
+        (type_url(AddLineItem), item.SerializeToString())
+    )
+    assert isinstance(message, AddLineItem) and not message.decoded
+    assert message == item
@@ -0,0 +1,103 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import os
+import signal
+import time
+
+import pytest
+from google.protobuf.any_pb2 import Any
+
+from cloudstate.action_context import ActionContext
+from cloudstate.action_pb2 import ActionCommand
+from cloudstate.action_protocol_entity import Action
+from cloudstate.action_servicer import CloudStateActionProtocolServicer
+from cloudstate.entity_pb2 import SideEffect
+from cloudstate.process_pool import PROCESS_POOL
+from cloudstate.test.actiondemo.action_definition import definition
+from cloudstate.test.actiondemo.actiondemo_pb2 import FunctionRequest, FunctionResponse
+
+action = Action(definition.service_descriptor, definition.file_descriptors)
+
+
+@action.unary_handler("ReverseString", executor="process")
+def reverse_string(request: FunctionRequest, ctx: ActionContext) -> FunctionResponse:
+    if request.foo == "boom":
+        ctx.fail("Intentionally failed.")
+    elif request.foo == "append":
+        # Handlers written before side_effect() add them to the list themselves.
+        ctx.effects.append(SideEffect(service_name="Other", command_name="Appended"))
+        ctx.errors.append("Appended failure.")
+    elif request.foo == "forward":
+        ctx.forward_to("Other", "Forwarded", FunctionRequest(foo="forwarded"))
+    else:
+        ctx.side_effect("Other", "Effect", FunctionRequest(foo=str(os.getpid())))
+        return FunctionResponse(bar=request.foo[::-1])
+
+
+def call(foo: str):
+    payload = Any()
+    payload.Pack(FunctionRequest(foo=foo))
+    servicer = CloudStateActionProtocolServicer([action])
+    return servicer.handleUnary(
+        ActionCommand(
+            service_name=action.name(), name="ReverseString", payload=payload
+        ),
+        None,
+    )
+
+
+@pytest.fixture(scope="module", autouse=True)
+def handler_processes():
+    PROCESS_POOL.configure(workers=2)
+    PROCESS_POOL.start()
+    yield
+    PROCESS_POOL.shutdown()
+
+
+def test_replies_from_a_worker_process():
+    response = call("hello")
+    assert FunctionResponse.FromString(response.reply.payload.value).bar == "olleh"
+    (effect,) = response.side_effects
+    assert FunctionRequest.FromString(effect.payload.value).foo != str(os.getpid())
+
+
+def test_carries_failures_and_forwards_over():
+    assert call("boom").failure.description == "['Intentionally failed.']"
+    assert call("forward").forward.command_name == "Forwarded"
+
+
+def test_carries_appended_errors_and_side_effects_over():
+    assert call("append").failure.description == "['Appended failure.']"
+
+
+def test_refuses_handlers_a_worker_process_cannot_import():
+    with pytest.raises(Exception, match="top level"):
+
+        @Action(
+            definition.service_descriptor, definition.file_descriptors
+        ).unary_handler("ReverseString", executor="process")
+        def nested(request: FunctionRequest, ctx: ActionContext):
+            pass
+
+
+def worker_pid() -> int:
+    (effect,) = call("pid").side_effects
+    return int(FunctionRequest.FromString(effect.payload.value).foo)
+
+
+def test_starts_workers_again_once_one_died():
+    pids = {worker_pid() for _ in range(8)}
+    os.kill(pids.pop(), signal.SIGKILL)
+    # Commands submitted once the pool notices fail, the next are served again.
+    deadline = time.monotonic() + 30
+    while not (
+        PROCESS_POOL.context.get_start_method() == "forkserver"
+        and call("again").HasField("reply")
+    ):
+        assert time.monotonic() < deadline
+        call("again")
+        time.sleep(0.05)
+    assert worker_pid() not in pids
@@ -0,0 +1,75 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import threading
+import time
+
+import grpc
+
+from cloudstate.discovery_servicer import CloudStateEntityDiscoveryServicer
+from cloudstate.entity_pb2 import ProxyInfo
+from cloudstate.entity_pb2_grpc import (
+    EntityDiscoveryStub,
+    add_EntityDiscoveryServicer_to_server,
+)
+from cloudstate.metrics import METRICS
+from cloudstate.protocol_executor import MonitoredPool, ProtocolExecutor
+from cloudstate.test.actiondemo.action_definition import definition
+
+
+class Servicer:
+    def handleUnary(self):
+        return threading.current_thread().name
+
+    def handleStreamed(self):
+        return threading.current_thread().name
+
+
+def test_routes_calls_by_servicer_method():
+    executor = ProtocolExecutor(MonitoredPool("default", 1, 1.0))
+    servicer, other = Servicer(), Servicer()
+    executor.route(servicer, MonitoredPool("streamed", 1, 1.0))
+    executor.route(servicer, MonitoredPool("unary", 1, 1.0), "handleUnary")
+
+    def run(behavior):
+        return executor.submit(lambda event, handler: handler(), None, behavior)
+
+    assert run(servicer.handleUnary).result().startswith("unary")
+    assert run(servicer.handleStreamed).result().startswith("streamed")
+    assert run(other.handleUnary).result().startswith("default")
+    executor.shutdown()
+
+
+def test_detects_starvation():
+    pool = MonitoredPool("starving", 1, 0.05)
+    busy = pool.submit(time.sleep, 0.2)
+    waiting = pool.submit(time.sleep, 0)
+    time.sleep(0.1)
+    assert METRICS.executor_saturation.labels("starving").get() == 1
+    busy.result(), waiting.result()
+    assert pool.starved.get() == 1
+    assert pool.queue_seconds.count() == 2
+    assert METRICS.executor_saturation.labels("starving").get() == 0
+    pool.shutdown()
+
+
+def test_serves_discovery_on_its_own_threads():
+    executor = ProtocolExecutor(MonitoredPool("grpc", 1, 1.0))
+    server = grpc.server(executor)
+    discovery = CloudStateEntityDiscoveryServicer([], [definition])
+    add_EntityDiscoveryServicer_to_server(discovery, server)
+    executor.route(discovery, MonitoredPool("discovery", 1, 1.0))
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    try:
+        # Holds the only thread of the default pool.
+        executor.default.submit(time.sleep, 0.5)
+        with grpc.insecure_channel(f"127.0.0.1:{port}") as channel:
+            spec = EntityDiscoveryStub(channel).discover(ProxyInfo(), timeout=0.4)
+        assert [e.service_name for e in spec.entities] == [definition.name()]
+        assert executor.pools["discovery"].queue_seconds.count() == 1
+    finally:
+        server.stop(None)
+        executor.shutdown(wait=False)
@@ -0,0 +1,92 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+from dataclasses import replace
+
+import pytest
+from google.protobuf.any_pb2 import Any
+
+from cloudstate.entity_pb2 import Command
+from cloudstate.event_sourced_pb2 import EventSourcedEvent, EventSourcedInit
+from cloudstate.eventsourced_servicer import EventSourcedStream
+from cloudstate.snapshot_policy import (
+    AfterSlowRecovery,
+    EventBytes,
+    EveryEvents,
+    Interval,
+    SnapshotPolicy,
+    SnapshotStats,
+)
+from cloudstate.test.shoppingcart.persistence.domain_pb2 import ItemAdded
+from cloudstate.test.shoppingcart.shopping_cart_entity import entity
+from cloudstate.test.shoppingcart.shoppingcart_pb2 import AddLineItem, GetShoppingCart
+
+
+def packed(message) -> Any:
+    payload = Any()
+    payload.Pack(message)
+    return payload
+
+
+def stream(snapshot_policy, events=0) -> EventSourcedStream:
+    cart = replace(entity, snapshot_policy=snapshot_policy)
+    stream = EventSourcedStream({cart.name(): cart})
+    stream.init(EventSourcedInit(service_name=cart.name(), entity_id="cart"))
+    for sequence in range(1, events + 1):
+        event = ItemAdded()
+        event.item.productId = str(sequence)
+        event.item.quantity = 1
+        stream.apply_event(EventSourcedEvent(sequence=sequence, payload=packed(event)))
+    return stream
+
+
+def snapshotted(stream: EventSourcedStream, name: str, message) -> bool:
+    command = Command(entity_id="cart", id=1, name=name, payload=packed(message))
+    return stream.handle_command(command).reply.HasField("snapshot")
+
+
+def add_item(stream: EventSourcedStream) -> bool:
+    return snapshotted(
+        stream, "AddItem", AddLineItem(user_id="cart", product_id="p", quantity=1)
+    )
+
+
+def get_cart(stream: EventSourcedStream) -> bool:
+    return snapshotted(stream, "GetCart", GetShoppingCart(user_id="cart"))
+
+
+def test_snapshots_when_an_event_crosses_a_multiple():
+    policy = EveryEvents(4)
+    assert policy.should_snapshot(SnapshotStats(sequence_number=5, emitted=2))
+    assert not policy.should_snapshot(SnapshotStats(sequence_number=3, emitted=2))
+    assert replace(entity, snapshot_every=4).snapshot_policy == policy
+
+
+def test_only_snapshots_changed_state():
+    cart = stream(EventBytes(1))
+    assert add_item(cart)
+    assert not get_cart(cart)
+    assert add_item(cart)
+
+
+def test_snapshots_by_interval():
+    cart = stream(Interval(3600))
+    assert not add_item(cart)
+    cart.snapshot_stats.last_snapshot -= 3600
+    assert add_item(cart)
+    assert not add_item(cart)
+
+
+def test_snapshots_once_after_a_slow_recovery():
+    cart = stream(AfterSlowRecovery(0), events=3)
+    assert get_cart(cart)
+    assert cart.snapshot_stats.events == 0
+    assert not add_item(cart)
+    assert not get_cart(stream(AfterSlowRecovery(3600), events=3))
+
+
+def test_refuses_policies_which_do_not_decide():
+    with pytest.raises(TypeError):
+        SnapshotPolicy()
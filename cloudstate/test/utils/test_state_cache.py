@@ -0,0 +1,127 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+from google.protobuf.any_pb2 import Any
+
+from cloudstate.entity_pb2 import Command
+from cloudstate.event_sourced_pb2 import (
+    EventSourcedEvent,
+    EventSourcedInit,
+    EventSourcedSnapshot,
+)
+from cloudstate.eventsourced_servicer import EventSourcedStream
+from cloudstate.snapshot_policy import SnapshotStats
+from cloudstate.state_cache import StateCache, approximate_size
+from cloudstate.test.shoppingcart.persistence.domain_pb2 import Cart as DomainCart
+from cloudstate.test.shoppingcart.persistence.domain_pb2 import ItemAdded
+from cloudstate.test.shoppingcart.shopping_cart_entity import ShoppingCartState, entity
+from cloudstate.test.shoppingcart.shoppingcart_pb2 import (
+    AddLineItem,
+    LineItem,
+)
+
+UNREADABLE = Any(type_url="type.googleapis.com/Unknown")
+
+
+def packed(message) -> Any:
+    payload = Any()
+    payload.Pack(message)
+    return payload
+
+
+def item_added(sequence: int) -> EventSourcedEvent:
+    event = ItemAdded()
+    event.item.productId = str(sequence)
+    event.item.quantity = 1
+    return EventSourcedEvent(sequence=sequence, payload=packed(event))
+
+
+def open_stream(
+    state_cache: StateCache, events=(), snapshot=None
+) -> EventSourcedStream:
+    stream = EventSourcedStream({entity.name(): entity}, state_cache)
+    init = EventSourcedInit(service_name=entity.name(), entity_id="cart")
+    if snapshot is not None:
+        init.snapshot.CopyFrom(snapshot)
+    stream.init(init)
+    for event in events:
+        stream.apply_event(event)
+    return stream
+
+
+def command(stream: EventSourcedStream, name: str, message):
+    return stream.handle_command(
+        Command(entity_id="cart", id=1, name=name, payload=packed(message))
+    ).reply
+
+
+def cart(stream: EventSourcedStream):
+    return sorted(stream.current_state.cart)
+
+
+def add_items(stream: EventSourcedStream, *product_ids):
+    for product_id in product_ids:
+        command(
+            stream,
+            "AddItem",
+            AddLineItem(user_id="cart", product_id=product_id, quantity=1),
+        )
+
+
+def test_evicts_the_least_recently_used_states():
+    state_cache = StateCache(max_entries=2, size_of=len)
+    for entity_id in "abc":
+        state_cache.store("p", entity_id, "state", 1, SnapshotStats())
+    assert state_cache.take("p", "a") is None
+    assert state_cache.take("p", "c").state == "state"
+    assert (len(state_cache), state_cache.bytes, state_cache.evictions) == (1, 5, 1)
+
+    state_cache = StateCache(max_bytes=10, size_of=len)
+    state_cache.store("p", "a", "12345", 1, SnapshotStats())
+    state_cache.store("p", "b", "123456", 1, SnapshotStats())
+    state_cache.store("p", "c", "12345678901", 1, SnapshotStats())
+    assert [key[1] for key in state_cache.entries] == ["b"]
+
+
+def test_sizes_states_approximately():
+    state = ShoppingCartState("cart")
+    empty = approximate_size(state)
+    state.cart["p"] = LineItem(product_id="p", name="n" * 1000, quantity=1)
+    assert approximate_size(state) > empty + 1000
+
+
+def test_reuses_the_state_when_the_journal_reached_it():
+    state_cache = StateCache()
+    stream = open_stream(state_cache)
+    add_items(stream, "a", "b")
+    stream.close()
+    unreadable = EventSourcedEvent(sequence=1, payload=UNREADABLE)
+    reopened = open_stream(state_cache, [unreadable, item_added(2), item_added(3)])
+    add_items(reopened, "c")
+    assert cart(reopened) == ["3", "a", "b", "c"]
+    assert reopened.start_sequence_number == 4
+
+
+def test_recovers_without_a_state_ahead_of_the_journal():
+    state_cache = StateCache()
+    stream = open_stream(state_cache)
+    add_items(stream, "a", "b")
+    stream.close()
+    behind = open_stream(state_cache, [item_added(1)])
+    add_items(behind, "c")
+    assert cart(behind) == ["1", "c"]
+    behind.close()
+    assert state_cache.take(entity.persistence_id, "cart").sequence_number == 2
+
+
+def test_recovers_without_a_state_behind_the_snapshot():
+    state_cache = StateCache()
+    stream = open_stream(state_cache)
+    add_items(stream, "a")
+    stream.close()
+    snapshot = EventSourcedSnapshot(snapshot_sequence=2, snapshot=packed(DomainCart()))
+    newer = open_stream(state_cache, [item_added(3)], snapshot)
+    add_items(newer, "c")
+    assert cart(newer) == ["3", "c"]
@@ -0,0 +1,97 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from cloudstate import supervisor
+from cloudstate.process_pool import HandlerProcessPool
+from cloudstate.supervisor import WorkerSupervisor
+
+
+class Server:
+    """Stands for the gRPC server of a worker, writing to the log once stopped."""
+
+    def __init__(self, log):
+        self.log = log
+        self.stopped = threading.Event()
+
+    def stop(self, grace):
+        with open(self.log, "a") as log:
+            log.write(f"{os.getpid()}\n")
+        self.stopped.set()
+        return self.stopped
+
+    def wait_for_termination(self, timeout=None):
+        return not self.stopped.wait(timeout)
+
+
+def until(condition, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.02)
+
+
+def worker(supervisor: WorkerSupervisor, index: int):
+    return supervisor.stats()["workers"][index]
+
+
+@pytest.fixture
+def supervised(tmp_path, monkeypatch):
+    monkeypatch.setattr(supervisor, "MIN_RESTART_DELAY", 0.2)
+    sigterm = signal.getsignal(signal.SIGTERM)
+    log = tmp_path / "stopped"
+    workers = WorkerSupervisor(
+        lambda index: Server(log), 2, stats_interval=0.05, grace=5.0
+    ).start()
+    until(lambda: worker(workers, 0)["reported_at"] > 0)
+    yield workers, log
+    workers.stop(0)
+    signal.signal(signal.SIGTERM, sigterm)
+
+
+def test_restarts_workers_with_backoff(supervised):
+    workers, _ = supervised
+    for restarts, delay in [(1, 0.2), (2, 0.4)]:
+        pid = worker(workers, 0)["pid"]
+        killed = time.monotonic()
+        os.kill(pid, signal.SIGKILL)
+        until(lambda: worker(workers, 0)["pid"] != pid)
+        # Workers exiting soon after they start are restarted later every time.
+        assert time.monotonic() - killed >= delay
+        stats = worker(workers, 0)
+        assert stats["alive"]
+        assert (stats["restarts"], stats["last_exit_code"]) == (
+            restarts,
+            -signal.SIGKILL,
+        )
+    assert workers.stats()["restarts"] == 2
+    assert worker(workers, 1)["restarts"] == 0
+
+
+def test_stops_workers_on_sigterm(supervised):
+    workers, log = supervised
+    pids = {stats["pid"] for stats in workers.stats()["workers"]}
+    os.kill(os.getpid(), signal.SIGTERM)
+    assert not workers.wait_for_termination(10)
+    # Every worker stopped its server gracefully, and none was restarted.
+    assert set(map(int, log.read_text().split())) == pids
+    for pid in pids:
+        with pytest.raises(ProcessLookupError):
+            os.kill(pid, 0)
+    assert workers.stats()["restarts"] == 0
+
+
+def test_shares_handler_processes_between_workers():
+    pool = HandlerProcessPool(workers=8)
+    pool.divide(3)
+    assert (pool.workers, pool.max_queue) == (2, 21)
+    pool.divide(4)
+    assert (pool.workers, pool.max_queue) == (1, 5)
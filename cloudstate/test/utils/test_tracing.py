@@ -0,0 +1,233 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import asyncio
+from typing import Iterator
+
+import pytest
+from google.protobuf.any_pb2 import Any
+
+from cloudstate import tracing
+from cloudstate.action_context import ActionContext
+from cloudstate.action_pb2 import ActionCommand
+from cloudstate.action_protocol_entity import Action
+from cloudstate.action_servicer import CloudStateActionProtocolServicer
+from cloudstate.aio.action_servicer import (
+    CloudStateActionProtocolServicer as AsyncActionProtocolServicer,
+)
+from cloudstate.entity_pb2 import Metadata, MetadataEntry
+from cloudstate.test.actiondemo.action_definition import definition
+from cloudstate.test.actiondemo.actiondemo_pb2 import (
+    FunctionRequest,
+    FunctionResponse,
+)
+
+
+class RecordingSpan(tracing.Span):
+    __slots__ = ("name", "carrier", "attributes", "events", "error", "ended", "parent")
+
+    def __init__(self, name, carrier, attributes, parent=None):
+        self.name = name
+        self.carrier = carrier
+        self.attributes = dict(attributes)
+        self.events = []
+        self.error = None
+        self.ended = False
+        self.parent = parent
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def add_event(self, name, attributes=None):
+        self.events.append(name)
+
+    def set_error(self, description):
+        self.error = description
+
+    def end(self):
+        self.ended = True
+
+
+class RecordingTracer(tracing.Tracer):
+    enabled = True
+
+    def __init__(self):
+        self.spans = []
+
+    def start_span(self, name, carrier, attributes):
+        span = RecordingSpan(name, carrier, attributes)
+        self.spans.append(span)
+        return span
+
+    def start_child_span(self, name, parent, attributes):
+        carrier = {"traceparent": f"element-{attributes['cloudstate.element']}"}
+        span = RecordingSpan(name, carrier, attributes, parent)
+        self.spans.append(span)
+        return span
+
+    def inject(self, span):
+        return {"traceparent": "child-of-" + span.carrier.get("traceparent", "")}
+
+
+def metadata(**entries) -> Metadata:
+    return Metadata(
+        entries=[
+            MetadataEntry(key=key, string_value=value) for key, value in entries.items()
+        ]
+    )
+
+
+def test_propagates_trace_context_to_forwards_and_side_effects():
+    tracer = RecordingTracer()
+    ctx = ActionContext("Command")
+    tracing.start_span(tracer, ctx, "Service/Command", metadata(traceparent="1"), {})
+    ctx.forward_to("Other", "Command", FunctionRequest(foo="bar"))
+    ctx.side_effect("Other", "Effect", FunctionRequest(foo="bar"))
+    expected = [MetadataEntry(key="traceparent", string_value="child-of-1")]
+    assert list(ctx.forward.metadata.entries) == expected
+    assert list(ctx.effects[0].metadata.entries) == expected
+
+
+def test_does_not_touch_metadata_when_disabled():
+    ctx = ActionContext("Command")
+    ctx.side_effect("Other", "Effect", FunctionRequest(foo="bar"))
+    assert not ctx.effects[0].HasField("metadata")
+
+
+def test_opens_a_span_per_unary_command():
+    tracer = RecordingTracer()
+    tracing.set_tracer(tracer)
+    try:
+        payload = Any()
+        payload.Pack(FunctionRequest(foo="abc"))
+        CloudStateActionProtocolServicer([definition]).handleUnary(
+            ActionCommand(
+                service_name=definition.name(),
+                name="ReverseString",
+                payload=payload,
+                metadata=metadata(traceparent="1"),
+            ),
+            None,
+        )
+    finally:
+        tracing.set_tracer(tracing.Tracer())
+    [span] = tracer.spans
+    assert span.name == definition.name() + "/ReverseString"
+    assert span.carrier == {"traceparent": "1"}
+    assert span.ended and span.error is None
+
+
+streamed = Action(definition.service_descriptor, definition.file_descriptors)
+
+
+@streamed.stream_handler("ReverseStrings")
+def reverse_strings(requests: Iterator, ctx: ActionContext):
+    for request in requests:
+        ctx.side_effect("Other", "Effect", request)
+        yield FunctionResponse(bar=request.foo[::-1])
+
+
+parallel = Action(definition.service_descriptor, definition.file_descriptors)
+
+
+@parallel.stream_handler("ReverseStrings", parallelism=2)
+def reverse_string(request: FunctionRequest, ctx: ActionContext):
+    if request.foo == "boom":
+        ctx.fail("Intentionally failed.")
+    ctx.side_effect("Other", "Effect", request)
+    return FunctionResponse(bar=request.foo[::-1])
+
+
+def stream_commands(action: Action, *foos):
+    commands = [
+        ActionCommand(
+            service_name=action.name(),
+            name="ReverseStrings",
+            metadata=metadata(traceparent="1"),
+        )
+    ]
+    for foo in foos:
+        payload = Any()
+        payload.Pack(FunctionRequest(foo=foo))
+        commands.append(ActionCommand(payload=payload))
+    return commands
+
+
+class RequestIterator:
+    def __init__(self, requests):
+        self._requests = iter(requests)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._requests)
+
+    next = __next__
+
+
+def handle_streamed(action: Action, asynchronous: bool, *foos):
+    tracer = RecordingTracer()
+    tracing.set_tracer(tracer)
+    commands = stream_commands(action, *foos)
+    try:
+        if asynchronous:
+            servicer = AsyncActionProtocolServicer([action])
+
+            async def requests():
+                for command in commands:
+                    yield command
+
+            async def call():
+                return [r async for r in servicer.handleStreamed(requests(), None)]
+
+            responses = asyncio.run(call())
+        else:
+            servicer = CloudStateActionProtocolServicer([action])
+            responses = list(servicer.handleStreamed(RequestIterator(commands), None))
+    finally:
+        tracing.set_tracer(tracing.Tracer())
+    return tracer.spans, responses
+
+
+def effect_trace_contexts(responses):
+    return [
+        effect.metadata.entries[0].string_value
+        for response in responses
+        for effect in response.side_effects
+    ]
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_opens_a_span_per_element_received_by_stream_handlers(asynchronous):
+    spans, responses = handle_streamed(streamed, asynchronous, "ab", "cd")
+    stream, *elements = spans
+    assert stream.name == definition.name() + "/ReverseStrings"
+    assert [(span.name, span.parent) for span in elements] == [
+        ("ReverseStrings/element", stream)
+    ] * 2
+    assert [span.attributes["cloudstate.element"] for span in elements] == [0, 1]
+    assert all(span.ended for span in spans)
+    assert effect_trace_contexts(responses[:1]) == ["child-of-element-0"]
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_opens_a_span_per_element_handled_on_its_own(asynchronous):
+    spans, responses = handle_streamed(parallel, asynchronous, "ab", "boom", "cd")
+    stream, *elements = spans
+    assert {span.parent for span in elements} == {stream}
+    assert sorted(span.attributes["cloudstate.element"] for span in elements) == [
+        0,
+        1,
+        2,
+    ]
+    assert all(span.ended for span in spans)
+    [failed] = [span for span in elements if span.error is not None]
+    assert failed.attributes["cloudstate.element"] == 1
+    # Side effects carry the trace context of the span of their element.
+    assert effect_trace_contexts(responses) == [
+        "child-of-element-0",
+        "child-of-element-2",
+    ]
@@ -0,0 +1,186 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+from typing import Any, Dict, Optional
+
+from cloudstate.entity_pb2 import Metadata, MetadataEntry
+
+
+class Span:
+    """A span around the handling of a command. This one records nothing."""
+
+    __slots__ = ()
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def add_event(self, name: str, attributes: Optional[Dict[str, Any]] = None):
+        pass
+
+    def record_exception(self, exception: BaseException):
+        pass
+
+    def set_error(self, description: str):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = Span()
+
+
+class Tracer:
+    """Opens spans around command handling. The servicers only call a tracer which
+    is enabled, so the default one, which is not, costs an attribute lookup per
+    command."""
+
+    enabled = False
+
+    def start_span(
+        self, name: str, carrier: Dict[str, str], attributes: Dict[str, Any]
+    ) -> Span:
+        """Start a span, as a child of the trace context found in the carrier, the
+        string entries of the metadata of the command."""
+        return NOOP_SPAN
+
+    def start_child_span(
+        self, name: str, parent: Span, attributes: Dict[str, Any]
+    ) -> Span:
+        """Start a span as a child of the given one, such as the span of an element
+        of a stream within the span of the stream."""
+        return NOOP_SPAN
+
+    def inject(self, span: Span) -> Dict[str, str]:
+        """The trace context of the span, to propagate in the metadata of forwards
+        and side effects."""
+        return {}
+
+
+TRACER = Tracer()
+
+
+def set_tracer(tracer: Tracer):
+    global TRACER
+    TRACER = tracer
+
+
+def get_tracer() -> Tracer:
+    return TRACER
+
+
+def carrier(metadata: Metadata) -> Dict[str, str]:
+    return {
+        entry.key: entry.string_value
+        for entry in metadata.entries
+        if entry.WhichOneof("value") == "string_value"
+    }
+
+
+def start_span(
+    tracer: Tracer,
+    ctx,
+    name: str,
+    metadata: Metadata,
+    attributes: Dict[str, Any],
+) -> Span:
+    """Start the span of a command, and have the context propagate it to the
+    forwards and side effects it creates."""
+    span = tracer.start_span(name, carrier(metadata), attributes)
+    propagate(tracer, span, ctx)
+    return span
+
+
+def start_child_span(
+    tracer: Tracer, parent: Span, ctx, name: str, attributes: Dict[str, Any]
+) -> Span:
+    """Start a child span of the given one, and have the context propagate it to
+    the forwards and side effects it creates."""
+    span = tracer.start_child_span(name, parent, attributes)
+    propagate(tracer, span, ctx)
+    return span
+
+
+def propagate(tracer: Tracer, span: Span, ctx):
+    ctx.trace_context = [
+        MetadataEntry(key=key, string_value=value)
+        for key, value in tracer.inject(span).items()
+    ]
+
+
+def end_span(span: Span, ctx):
+    if ctx.has_errors():
+        span.set_error(str(ctx.errors))
+    span.end()
+
+
+class OpenTelemetrySpan(Span):
+    __slots__ = ("span",)
+
+    def __init__(self, span):
+        self.span = span
+
+    def set_attribute(self, key: str, value: Any):
+        self.span.set_attribute(key, value)
+
+    def add_event(self, name: str, attributes: Optional[Dict[str, Any]] = None):
+        self.span.add_event(name, attributes or {})
+
+    def record_exception(self, exception: BaseException):
+        self.span.record_exception(exception)
+
+    def set_error(self, description: str):
+        from opentelemetry.trace import Status, StatusCode
+
+        self.span.set_status(Status(StatusCode.ERROR, description))
+
+    def end(self):
+        self.span.end()
+
+
+class OpenTelemetryTracer(Tracer):
+    """Reports spans through OpenTelemetry, which must be installed, and
+    propagates trace context with its configured propagators."""
+
+    enabled = True
+
+    def __init__(self, tracer=None):
+        try:
+            from opentelemetry import propagate, trace
+        except ImportError:
+            raise Exception(
+                "OpenTelemetryTracer requires the opentelemetry-api package"
+            )
+        self._propagate = propagate
+        self._trace = trace
+        self.tracer = tracer or trace.get_tracer("cloudstate")
+
+    def start_span(
+        self, name: str, carrier: Dict[str, str], attributes: Dict[str, Any]
+    ) -> Span:
+        span = self.tracer.start_span(
+            name,
+            context=self._propagate.extract(carrier),
+            kind=self._trace.SpanKind.SERVER,
+            attributes=attributes,
+        )
+        return OpenTelemetrySpan(span)
+
+    def start_child_span(
+        self, name: str, parent: Span, attributes: Dict[str, Any]
+    ) -> Span:
+        context = None
+        if isinstance(parent, OpenTelemetrySpan):
+            context = self._trace.set_span_in_context(parent.span)
+        span = self.tracer.start_span(name, context=context, attributes=attributes)
+        return OpenTelemetrySpan(span)
+
+    def inject(self, span: Span) -> Dict[str, str]:
+        carrier: Dict[str, str] = {}
+        if isinstance(span, OpenTelemetrySpan):
+            self._propagate.inject(
+                carrier, context=self._trace.set_span_in_context(span.span)
+            )
+        return carrier
@@ -0,0 +1,166 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import threading
+from collections import deque
+from dataclasses import dataclass
+from itertools import islice
+from queue import Empty, SimpleQueue
+from time import monotonic
+from typing import Iterable, Iterator, List
+
+_END = object()
+_TIMEOUT = object()
+
+
+class _Failure:
+    __slots__ = ("exception",)
+
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+@dataclass(frozen=True)
+class Chunks:
+    """How the elements of a request stream are handed to a handler: in lists of
+    size elements, or of the elements received within ms milliseconds of the first
+    one, whichever is full first.
+
+    With every, chunks slide rather than tumble: a chunk of the last size elements
+    is handed every `every` elements, or one of the elements received in the last
+    ms milliseconds every `every` milliseconds, so that elements belong to several
+    chunks. Sliding chunks are either counted or timed."""
+
+    size: int = 0
+    ms: float = 0
+    every: float = 0
+
+    def __post_init__(self):
+        if self.size < 0 or self.ms < 0 or self.every < 0:
+            raise Exception(f"{self} cannot be negative")
+        if not self.size and not self.ms:
+            raise Exception(f"{self} needs a size or a time")
+        if self.every:
+            if self.size and self.ms:
+                raise Exception(f"Sliding {self} are either counted or timed")
+            if self.every > (self.size or self.ms):
+                raise Exception(f"{self} cannot slide further than their length")
+
+
+def chunked(elements: Iterable, chunks: Chunks) -> Iterator[List]:
+    """The elements in chunks. Elements left over at the end of the stream are
+    handed as a last, smaller chunk."""
+    if chunks.ms:
+        if chunks.every:
+            return _sliding_timed(
+                _read(elements), chunks.ms / 1000, chunks.every / 1000
+            )
+        return _timed(_read(elements), chunks.ms / 1000, chunks.size)
+    if chunks.every:
+        return _sliding(iter(elements), chunks.size, int(chunks.every))
+    return _counted(iter(elements), chunks.size)
+
+
+def _counted(elements: Iterator, size: int) -> Iterator[List]:
+    while True:
+        chunk = list(islice(elements, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _sliding(elements: Iterator, size: int, every: int) -> Iterator[List]:
+    window = deque(maxlen=size)
+    # The elements received since the last chunk.
+    fresh = 0
+    for element in elements:
+        window.append(element)
+        fresh += 1
+        if len(window) == size and fresh >= every:
+            yield list(window)
+            fresh = 0
+    if fresh:
+        yield list(window)
+
+
+def _read(elements: Iterable) -> SimpleQueue:
+    """Read the elements from a thread, for timed chunks to be handed while the
+    next element is awaited."""
+    queue = SimpleQueue()
+
+    def read():
+        try:
+            for element in elements:
+                queue.put(element)
+        except BaseException as ex:
+            queue.put(_Failure(ex))
+        finally:
+            queue.put(_END)
+
+    threading.Thread(target=read, name="chunks-reader", daemon=True).start()
+    return queue
+
+
+def _get(queue: SimpleQueue, deadline):
+    """The next element, or _TIMEOUT once the deadline is passed."""
+    if deadline is None:
+        element = queue.get()
+    else:
+        try:
+            element = queue.get(timeout=max(deadline - monotonic(), 0))
+        except Empty:
+            return _TIMEOUT
+    if element.__class__ is _Failure:
+        raise element.exception
+    return element
+
+
+def _timed(queue: SimpleQueue, seconds: float, size: int) -> Iterator[List]:
+    chunk: List = []
+    deadline = None
+    while True:
+        if deadline is not None and monotonic() >= deadline:
+            yield chunk
+            chunk, deadline = [], None
+        element = _get(queue, deadline)
+        if element is _TIMEOUT:
+            continue
+        if element is _END:
+            break
+        if not chunk:
+            deadline = monotonic() + seconds
+        chunk.append(element)
+        if len(chunk) == size:
+            yield chunk
+            chunk, deadline = [], None
+    if chunk:
+        yield chunk
+
+
+def _sliding_timed(queue: SimpleQueue, seconds: float, every: float) -> Iterator[List]:
+    window = deque()
+    fresh = False
+    tick = None
+    while True:
+        if tick is not None and monotonic() >= tick:
+            expired = monotonic() - seconds
+            while window and window[0][0] <= expired:
+                window.popleft()
+            if window:
+                yield [element for _, element in window]
+                fresh = False
+            # Ticks stop while no element is received.
+            tick = monotonic() + every if window else None
+        element = _get(queue, tick)
+        if element is _TIMEOUT:
+            continue
+        if element is _END:
+            break
+        window.append((monotonic(), element))
+        fresh = True
+        if tick is None:
+            tick = monotonic() + every
+    if fresh:
+        yield [element for _, element in window]
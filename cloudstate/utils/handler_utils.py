@@ -0,0 +1,124 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import inspect
+import typing
+from operator import itemgetter
+from typing import Callable, NamedTuple, Optional, Sequence, Tuple
+
+
+class Slot(NamedTuple):
+    """A value the servicer can inject into a handler, in the order it provides them.
+    A slot without a type (e.g. the user defined state) is matched by elimination.
+    A slot claiming a base class, such as messages for the command, is the only one
+    parameters annotated with its subclasses can be matched with, so that they are
+    refused rather than matched by elimination when they are not of its type. A slot
+    whose type is the base it claims, such as the snapshot, holds values of any of
+    its subclasses, and is matched by parameters annotated with them."""
+
+    name: str
+    type: Optional[type] = None
+    claims: Optional[type] = None
+
+
+class HandlerPlan:
+    """The argument binding of a handler function, resolved once at registration.
+
+    `invoke` takes the slot values positionally and calls the function with the
+    ones it declared, in the order it declared them, without any reflection.
+    `is_async` tells whether it returns a coroutine or an asynchronous generator.
+    `lazy` tells whether it receives its payload as a LazyMessage, and `decode`
+    is the decoder of its payload, for handlers of commands."""
+
+    __slots__ = ("function", "indices", "invoke", "is_async", "lazy", "decode")
+
+    def __init__(self, function: Callable, indices: Tuple[int, ...], arity: int):
+        self.function = function
+        self.indices = indices
+        self.invoke = _bind(function, indices, arity)
+        self.is_async = inspect.iscoroutinefunction(
+            function
+        ) or inspect.isasyncgenfunction(function)
+        self.lazy = False
+        self.decode = None
+
+    def __repr__(self):
+        return f"HandlerPlan({self.function}, {self.indices})"
+
+
+def compile_handler(
+    function: Callable, slots: Sequence[Slot], allow_async: bool = True
+) -> HandlerPlan:
+    """Match every parameter of the function with one of the slots, based on its
+    type annotation. Raises if a parameter cannot be injected."""
+    if not allow_async and (
+        inspect.iscoroutinefunction(function) or inspect.isasyncgenfunction(function)
+    ):
+        raise Exception(
+            f"Function {function} cannot be asynchronous: it has to update the state "
+            "as soon as it is called"
+        )
+    try:
+        hints = typing.get_type_hints(function)
+    except Exception:
+        hints = {}
+    taken = set()
+    indices = []
+    for parameter in inspect.signature(function).parameters.values():
+        if parameter.kind in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD):
+            continue
+        annotation = hints.get(parameter.name, parameter.annotation)
+        if annotation is inspect.Parameter.empty:
+            raise Exception(
+                f"Cannot inject parameter {parameter.name} of function "
+                f"{function}: Missing type annotation"
+            )
+        index = _match_slot(annotation, slots, taken)
+        if index is None:
+            raise Exception(
+                "Cannot inject parameter {} of function {}: No matching value".format(
+                    parameter.name, function
+                )
+            )
+        taken.add(index)
+        indices.append(index)
+    return HandlerPlan(function, tuple(indices), len(slots))
+
+
+def _match_slot(annotation, slots: Sequence[Slot], taken) -> Optional[int]:
+    # Generic aliases such as Iterator[Foo] are matched on their origin.
+    origin = getattr(annotation, "__origin__", None) or annotation
+    if isinstance(origin, type):
+        for index, slot in enumerate(slots):
+            if (
+                index not in taken
+                and slot.type is not None
+                and (
+                    issubclass(slot.type, origin)
+                    or (slot.type is slot.claims and issubclass(origin, slot.type))
+                )
+            ):
+                return index
+        if any(
+            slot.claims is not None and issubclass(origin, slot.claims)
+            for slot in slots
+        ):
+            return None
+    for index, slot in enumerate(slots):
+        if index not in taken and slot.type is None:
+            return index
+    return None
+
+
+def _bind(function: Callable, indices: Tuple[int, ...], arity: int) -> Callable:
+    if indices == tuple(range(arity)):
+        return function
+    if not indices:
+        return lambda *values: function()
+    if len(indices) == 1:
+        (index,) = indices
+        return lambda *values: function(values[index])
+    getter = itemgetter(*indices)
+    return lambda *values: function(*getter(values))
@@ -0,0 +1,97 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+from google.protobuf.any_pb2 import Any
+
+# Methods that neither modify the message nor hand out mutable parts of it.
+_READ_ONLY = frozenset(
+    ["DESCRIPTOR", "HasField", "WhichOneof", "IsInitialized", "ByteSize"]
+)
+_SCALARS = (str, bytes, int, float, bool)
+
+
+class LazyMessage:
+    """Stands in for a payload message, which is only parsed when one of its fields
+    is first accessed.
+
+    As long as the message is known to be unmodified, it is packed back into replies,
+    forwards, side effects and events from the bytes it was received as, without
+    being serialized again. Setting a field, or reading anything that could be
+    modified in place (sub-messages, repeated and map fields, most methods),
+    conservatively marks it as modified."""
+
+    __slots__ = ("_message_type", "_type_url", "_value", "_message", "_pristine")
+
+    def __init__(self, message_type: type, type_url: str, value: bytes):
+        object.__setattr__(self, "_message_type", message_type)
+        object.__setattr__(self, "_type_url", type_url)
+        object.__setattr__(self, "_value", value)
+        object.__setattr__(self, "_message", None)
+        object.__setattr__(self, "_pristine", True)
+
+    @property
+    def __class__(self):
+        # Makes isinstance checks against the message type succeed.
+        return self._message_type
+
+    @property
+    def decoded(self) -> bool:
+        return self._message is not None
+
+    @property
+    def pristine(self) -> bool:
+        return self._pristine
+
+    def _decode(self):
+        message = self._message
+        if message is None:
+            message = self._message_type.FromString(self._value)
+            object.__setattr__(self, "_message", message)
+        return message
+
+    def unwrap(self):
+        """The actual message. It may be modified by the caller, so it is serialized
+        again when packed."""
+        object.__setattr__(self, "_pristine", False)
+        return self._decode()
+
+    def SerializeToString(self, **kwargs) -> bytes:
+        if self._pristine:
+            return self._value
+        return self._message.SerializeToString(**kwargs)
+
+    def pack_into(self, target: Any):
+        if self._pristine:
+            target.type_url = self._type_url
+            target.value = self._value
+        else:
+            target.Pack(self._message)
+
+    def __getattr__(self, name):
+        value = getattr(self._decode(), name)
+        if name not in _READ_ONLY and not isinstance(value, _SCALARS):
+            object.__setattr__(self, "_pristine", False)
+        return value
+
+    def __setattr__(self, name, value):
+        message = self._decode()
+        object.__setattr__(self, "_pristine", False)
+        setattr(message, name, value)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyMessage):
+            other = other._decode()
+        return self._decode() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._decode())
+
+    def __str__(self):
+        return str(self._decode())
@@ -0,0 +1,79 @@
+"""
+Copyright 2020 Lightbend Inc.
+Licensed under the Apache License, Version 2.0.
+"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import SimpleQueue
+from typing import Callable, Iterable, Iterator
+
+_END = object()
+
+
+class OrderedPool:
+    """Applies a function to the elements of streams concurrently, on a pool of
+    threads shared by the streams, and yields the results of each stream in the
+    order of its elements.
+
+    At most window elements of a stream are in flight, either being handled or
+    waiting for the results before them to be consumed. A thread per stream reads
+    its elements, so that results are yielded while the next element is awaited."""
+
+    def __init__(self, parallelism: int, window: int = 0, name: str = "stream"):
+        if parallelism < 1:
+            raise Exception(f"Parallelism of {name} must be at least 1")
+        if window and window < parallelism:
+            raise Exception(
+                f"Window of {name} must be at least its parallelism {parallelism}"
+            )
+        self.parallelism = parallelism
+        self.window = window or 2 * parallelism
+        self.name = name
+        self._executor: ThreadPoolExecutor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """The thread pool, started by the first stream."""
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        self.parallelism, thread_name_prefix=self.name
+                    )
+        return self._executor
+
+    def map(self, function: Callable, elements: Iterable) -> Iterator:
+        executor = self.executor
+        window = threading.Semaphore(self.window)
+        submitted = SimpleQueue()
+        stopped = threading.Event()
+
+        def read():
+            try:
+                for element in elements:
+                    window.acquire()
+                    if stopped.is_set():
+                        return
+                    submitted.put(executor.submit(function, element))
+            except BaseException as ex:
+                failed = Future()
+                failed.set_exception(ex)
+                submitted.put(failed)
+            finally:
+                submitted.put(_END)
+
+        threading.Thread(target=read, name=f"{self.name}-reader", daemon=True).start()
+        try:
+            while True:
+                future = submitted.get()
+                if future is _END:
+                    return
+                result = future.result()
+                window.release()
+                yield result
+        finally:
+            # Lets the reader stop, should it wait for room in the window.
+            stopped.set()
+            window.release()
@@ -3,9 +3,14 @@ Copyright 2020 Lightbend Inc.
 Licensed under the Apache License, Version 2.0.
 """
 
+from typing import Callable, Dict, Iterable
+
+from google.protobuf import descriptor as _descriptor
 from google.protobuf import symbol_database as _symbol_database
 from google.protobuf.any_pb2 import Any
 
+from cloudstate.utils.lazy_message import LazyMessage
+
 _sym_db = _symbol_database.Default()
 
 TYPE_URL_PREFIX = "type.googleapis.com/"
@@ -23,5 +28,170 @@ def get_payload(command):
 
 def pack(event):
     any = Any()
-    any.Pack(event)
+    pack_into(any, event)
     return any
+
+
+# The type URLs of the message classes packed so far.
+_type_urls: Dict[type, str] = {}
+
+
+def is_serialized(payload) -> bool:
+    """Whether the payload is already serialized, as an Any or a (type URL, bytes or
+    memoryview) pair."""
+    return type(payload) is Any or isinstance(payload, tuple)
+
+
+def pack_into(target: Any, message):
+    """Pack the message into the given Any, reusing the original bytes of lazy
+    payloads which have not been modified. Serialized payloads are set as they
+    are."""
+    message_type = type(message)
+    if message_type is LazyMessage:
+        message.pack_into(target)
+        return
+    if message_type is Any:
+        target.type_url = message.type_url
+        target.value = message.value
+        return
+    if isinstance(message, tuple):
+        target.type_url, value = message
+        target.value = bytes(value) if type(value) is memoryview else value
+        return
+    try:
+        url = _type_urls[message_type]
+    except KeyError:
+        url = _type_urls[message_type] = type_url(message_type)
+    target.type_url = url
+    target.value = message.SerializeToString()
+
+
+def message_class(message_descriptor):
+    """The generated class of the given message descriptor, or None when the module
+    defining it has not been imported."""
+    try:
+        return _sym_db.GetSymbol(message_descriptor.full_name)
+    except KeyError:
+        return None
+
+
+def type_url(message_type) -> str:
+    return TYPE_URL_PREFIX + message_type.DESCRIPTOR.full_name
+
+
+class TypeRegistry:
+    """Maps the type URLs of the payloads an entity handles to their message classes,
+    and the methods of its service to their input types.
+
+    Built when the entity is defined, from its service and file descriptors, so that
+    decoding a payload costs a dictionary lookup. Types found nowhere in those, such
+    as events defined in a file the service does not import, are looked up in the
+    symbol database the first time they are seen and remembered."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.classes: Dict[str, type] = {}
+        self.input_types: Dict[str, type] = {}
+
+    @classmethod
+    def for_service(
+        cls,
+        service_descriptor: _descriptor.ServiceDescriptor,
+        file_descriptors: Iterable[_descriptor.FileDescriptor],
+    ) -> "TypeRegistry":
+        registry = cls(service_descriptor.full_name)
+        registry.register_file(service_descriptor.file)
+        for file_descriptor in file_descriptors:
+            registry.register_file(file_descriptor)
+        for method in service_descriptor.methods:
+            input_type = message_class(method.input_type)
+            if input_type:
+                registry.input_types[method.name] = input_type
+        return registry
+
+    def register(self, message_type: type):
+        self.classes[type_url(message_type)] = message_type
+
+    def register_file(self, file_descriptor: _descriptor.FileDescriptor):
+        seen = set()
+        pending = [file_descriptor]
+        while pending:
+            current = pending.pop()
+            if current.name in seen:
+                continue
+            seen.add(current.name)
+            pending.extend(current.dependencies)
+            descriptors = list(current.message_types_by_name.values())
+            while descriptors:
+                descriptor = descriptors.pop()
+                descriptors.extend(descriptor.nested_types)
+                message_type = message_class(descriptor)
+                if message_type:
+                    self.register(message_type)
+
+    def resolve(self, url: str) -> type:
+        """The message class of the given type URL."""
+        try:
+            return self.classes[url]
+        except KeyError:
+            pass
+        try:
+            message_type = _sym_db.GetSymbol(url[url.rfind("/") + 1 :])
+        except KeyError:
+            raise Exception(
+                f"Unknown payload type {url} for {self.name}: its message class has "
+                "not been imported"
+            )
+        self.classes[url] = message_type
+        return message_type
+
+    def decode(self, payload: Any):
+        """Decode the message packed in the given Any."""
+        return self.resolve(payload.type_url).FromString(payload.value)
+
+    def wrap_serialized(self, payload) -> LazyMessage:
+        """Wrap a serialized payload, an Any or a (type URL, bytes) pair, as a
+        message of its type parsed on first access."""
+        if type(payload) is Any:
+            url, value = payload.type_url, payload.value
+        else:
+            url, value = payload
+            value = bytes(value)
+        return LazyMessage(self.resolve(url), url, value)
+
+    def decode_lazily(self, payload: Any) -> LazyMessage:
+        """Wrap the message packed in the given Any, without parsing it yet."""
+        url = payload.type_url
+        return LazyMessage(self.resolve(url), url, payload.value)
+
+    def method_decoder(
+        self, method_name: str, lazy: bool = False
+    ) -> Callable[[Any], object]:
+        """A decoder specialized for the input type of the given method, for decoding
+        every element of a stream without looking its type up."""
+        input_type = self.input_types.get(method_name)
+        if lazy:
+            if input_type is None:
+                return self.decode_lazily
+            input_type_url = type_url(input_type)
+            decode_lazily = self.decode_lazily
+
+            def decode_input_lazily(payload: Any):
+                if payload.type_url == input_type_url:
+                    return LazyMessage(input_type, input_type_url, payload.value)
+                return decode_lazily(payload)
+
+            return decode_input_lazily
+
+        if input_type is None:
+            return self.decode
+        input_type_url = type_url(input_type)
+        from_string = input_type.FromString
+        decode = self.decode
+
+        def decode_input(payload: Any):
+            if payload.type_url == input_type_url:
+                return from_string(payload.value)
+            return decode(payload)
+
+        return decode_input